@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of URL building on a link-heavy page: smart_quote and
+reverse_url, before and after precompiling them.
+
+Run it with ``python benchmarks/urls.py``.
+"""
+
+import timeit
+
+from tornado.web import Application, URLSpec
+from tornado.escape import url_escape
+
+from waterspout.utils import UNQUOTE, smart_quote, URLBuilder
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+LINKS = 300
+
+application = Application([
+    URLSpec('/', None, name='index'),
+    URLSpec('/user/([^/]+)', None, name='user'),
+    URLSpec(r'/post/(\d+)/comment/(\d+)', None, name='comment'),
+])
+builder = URLBuilder(application.named_handlers)
+
+URLS = ['http://whouz.com/post/%d?tag=waterspout' % i for i in range(LINKS)]
+URLS += ['http://whouz.com/喵/%d' % i for i in range(LINKS)]
+
+
+def old_smart_quote(url):
+    return ''.join([s if s in UNQUOTE else quote(s) for s in url])
+
+
+def old_page():
+    for i in range(LINKS):
+        application.reverse_url('index')
+        application.reverse_url('user', 'whtsky')
+        application.reverse_url('comment', i, i)
+
+
+def new_page():
+    for i in range(LINKS):
+        builder('index')
+        builder('user', 'whtsky')
+        builder('comment', i, i)
+
+
+def main():
+    for url in URLS:
+        assert smart_quote(url) == old_smart_quote(url)
+    for i in range(10):
+        assert builder('comment', i, i) == \
+            application.reverse_url('comment', i, i)
+    assert url_escape('a b', plus=False) == builder('user', 'a b')[6:]
+
+    cases = [
+        ('smart_quote', lambda: [old_smart_quote(u) for u in URLS],
+         lambda: [smart_quote(u) for u in URLS]),
+        ('reverse_url', old_page, new_page),
+    ]
+    for name, old, new in cases:
+        old_time = min(timeit.repeat(old, number=20, repeat=5))
+        new_time = min(timeit.repeat(new, number=20, repeat=5))
+        print('%-12s before %8.2fms  after %8.2fms  %5.1fx faster' % (
+            name, old_time / 20 * 1000, new_time / 20 * 1000,
+            old_time / new_time
+        ))
+
+
+if __name__ == '__main__':
+    main()
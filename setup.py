@@ -22,6 +22,9 @@ setup(
     long_description=waterspout.__doc__,
     install_requires=open("requirements.txt").readlines(),
     include_package_data=True,
+    entry_points={
+        'console_scripts': ['waterspout = waterspout.cli:main'],
+    },
     license='MIT License',
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -0,0 +1,155 @@
+import sys
+import json
+import time
+import random
+import logging
+import threading
+
+from collections import deque
+
+try:
+    string_types = basestring
+except NameError:  # Py3k
+    string_types = str
+
+
+class AccessLog(object):
+    """
+    Writes the access log as JSON lines from a background thread, instead
+    of calling ``logging`` on the IOLoop for every request.
+
+    Use it as the ``log_function`` setting of a Tornado application.
+    Records are kept in a buffer of ``buffer_size`` records, and written
+    in batches every ``flush_interval`` seconds, or as soon as
+    ``batch_size`` records are waiting.  Records are dropped when the
+    buffer is full.
+
+    Only ``sample_rate`` of the successful requests are logged; requests
+    answered with a status of 400 or more are always logged.
+
+    It is configured with the ``access_log`` setting, a path or ``-`` for
+    the standard output, and the ``access_log_sample_rate``,
+    ``access_log_buffer_size`` and ``access_log_flush_interval`` settings.
+
+    :param path: the path of the log file, or ``None`` for stdout.
+    """
+
+    def __init__(self, path=None, sample_rate=1.0, buffer_size=10000,
+                 flush_interval=1.0, batch_size=1000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.buffer = deque()
+        self.written = 0
+        self.sampled_out = 0
+        self.dropped = 0
+        self._routes = None
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = None
+        self._file = None
+
+    def __call__(self, handler):
+        status = handler.get_status()
+        if (status < 400 and self.sample_rate < 1 and
+                random.random() >= self.sample_rate):
+            self.sampled_out += 1
+            return
+        if len(self.buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self.buffer.append(self.record(handler))
+        if len(self.buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def record(self, handler):
+        """
+        Return the record of a finished request, as a dictionary.
+        """
+        request = handler.request
+        handler_class = handler.__class__
+        if self._routes is None:
+            self._routes = dict(
+                (spec.handler_class, name)
+                for name, spec in handler.application.named_handlers.items()
+            )
+        user = getattr(handler, '_current_user', None)
+        user_id = getattr(user, 'id', user)
+        if not isinstance(user_id, (int, string_types)):
+            user_id = None
+        length = handler._headers.get("Content-Length")
+        return dict(
+            time=round(time.time(), 3),
+            method=request.method,
+            path=request.path,
+            route=self._routes.get(handler_class),
+            handler=handler_class.__name__,
+            status=handler.get_status(),
+            latency=round(1000.0 * request.request_time(), 2),
+            bytes=int(length) if length else None,
+            user_id=user_id,
+            request_id=getattr(handler, '_request_id', None),
+            ip=request.remote_ip
+        )
+
+    def start(self):
+        """
+        Open the log file and start the writer thread.
+        """
+        if self.path:
+            self._file = open(self.path, 'a')
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='waterspout-access-log')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered records.
+        """
+        lines = []
+        buffer = self.buffer
+        while buffer:
+            lines.append(json.dumps(buffer.popleft(), separators=(',', ':')))
+        if not lines:
+            return
+        out = self._file or sys.stdout
+        try:
+            out.write('\n'.join(lines) + '\n')
+            out.flush()
+        except (IOError, OSError, ValueError):
+            logging.exception("Failed to write the access log")
+            return
+        self.written += len(lines)
+
+    def stop(self):
+        """
+        Stop the writer thread, write the remaining records and close the
+        log file.
+        """
+        self._stopping = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        """
+        Return a dictionary describing the log.
+        """
+        return dict(buffered=len(self.buffer), written=self.written,
+                    sampled_out=self.sampled_out, dropped=self.dropped)
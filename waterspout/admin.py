@@ -0,0 +1,129 @@
+"""
+An admin endpoint describing a running worker.
+
+It is enabled by the ``admin_token`` setting, and served at the
+``admin_path`` setting (``/_waterspout`` by default) ::
+
+    curl -H 'Authorization: Bearer <admin_token>' localhost:8888/_waterspout
+"""
+
+import gc
+import os
+import sys
+import hmac
+import time
+import resource
+
+import tornado.web
+
+from .process import task_id
+from .web import APIHandler
+
+STARTED = time.time()
+
+
+def _compare(a, b):
+    compare_digest = getattr(hmac, 'compare_digest', None)
+    if compare_digest is not None:
+        return compare_digest(a, b)
+    return len(a) == len(b) and not sum(ord(x) ^ ord(y) for x, y in zip(a, b))
+
+
+def memory_usage():
+    """
+    Return the resident memory of the process, and its peak, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        rss = peak
+    return rss, peak
+
+
+def route_table(application):
+    """
+    Return the routes of a Tornado application, in the order they are
+    matched.
+    """
+    routes = []
+    for host, specs in application.handlers:
+        for spec in specs:
+            routes.append(dict(
+                host=host.pattern, pattern=spec.regex.pattern,
+                handler='%s.%s' % (spec.handler_class.__module__,
+                                   spec.handler_class.__name__),
+                name=spec.name
+            ))
+    return routes
+
+
+def _stats(obj):
+    if obj is None:
+        return None
+    return obj.stats()
+
+
+class AdminHandler(APIHandler):
+    """
+    Returns a JSON description of the worker: routes, in-flight requests,
+    connections, IOLoop lag, memory, GC and cache statistics.
+
+    Requests must send the ``admin_token`` setting in the
+    ``Authorization: Bearer`` header, or get a 404 response.  They are
+    never rate limited or shed, so a saturated worker can be inspected.
+    """
+
+    def prepare(self):
+        token = self.settings.get('admin_token')
+        header = self.request.headers.get('Authorization', '')
+        if not (token and header.startswith('Bearer ') and
+                _compare(header[7:].strip(), token)):
+            raise tornado.web.HTTPError(404)
+
+    def get(self):
+        self.set_header('Cache-Control', 'no-store')
+        self.write(self.describe())
+
+    def describe(self):
+        application = self.application
+        admission = application.admission
+        rss, peak = memory_usage()
+        server = getattr(application, 'http_server', None)
+        env = application.env
+        caches = dict((name, cache.stats())
+                      for name, cache in application.caches.items())
+        caches['templates'] = _stats(env.cache)
+        static_handler = self.settings.get('static_handler_class')
+        if hasattr(static_handler, 'hash_stats'):
+            caches['static_files'] = static_handler.hash_stats()
+        gc_stats = dict(counts=gc.get_count(), garbage=len(gc.garbage))
+        if hasattr(gc, 'get_stats'):
+            gc_stats['generations'] = gc.get_stats()
+        return dict(
+            worker=dict(pid=os.getpid(), task_id=task_id(),
+                        uptime=time.time() - STARTED),
+            routes=route_table(application),
+            requests=dict(inflight=admission.inflight,
+                          routes=dict(admission.routes),
+                          shed=admission.shed, limited=admission.limited),
+            connections=dict(
+                http=getattr(server, 'connections', None),
+                websocket=len(application.hub.connections)
+            ),
+            ioloop=_stats(application.loop_monitor),
+            memory=dict(rss=rss, peak_rss=peak),
+            gc=gc_stats,
+            caches=caches,
+            executors=application.executors.stats(),
+            tasks=application.tasks.stats(),
+            bus=application.bus.stats(),
+            websocket=application.hub.stats(),
+            tracer=_stats(application.tracer),
+            memory_profiler=_stats(application.memory_profiler),
+            access_log=_stats(getattr(application, 'access_log', None)),
+            sentry=_stats(getattr(application, 'error_reporter', None))
+        )
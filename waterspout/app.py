@@ -1,18 +1,40 @@
 __all__ = ['Waterspout', 'App']
 
 import os
+import logging
 import inspect
 
 import tornado.web
+import tornado.locale
 import tornado.options
 
 from jinja2 import Environment, FileSystemLoader
 
+from .accesslog import AccessLog
+from .bus import Bus
+from .cache import memoized
 from .config import Config
-from .utils import get_root_path
+from .executor import Executors
+from .limits import AdmissionControl
+from .memory import MemoryProfiler
+from .monitor import LoopMonitor
+from .resources import Resources
+from .tasks import TaskQueue
+from .templating import (FragmentCache, FragmentCacheExtension, TemplateCache,
+                         Translations)
+from .tracing import Tracer, JSONLinesExporter, OTLPExporter
+from .utils import (get_root_path, import_string, LRUCache, SessionCache,
+                    URLBuilder)
+from .web import ETAG_HASHES
+from .websocket import Hub
 
 from tornado.options import define, options
 
+try:
+    string_types = basestring
+except NameError:  # Py3k
+    string_types = str
+
 define('config', default='', help='path to the config file', type=str)
 
 
@@ -49,10 +71,48 @@ class Waterspout(object):
 
         self.config = Config(self.root_path, config)
 
+        translations_path = self.config.get('translations_path', None)
+        if translations_path:
+            self.load_translations(translations_path)
+
         self._user_loader = None
 
         self.filters = {}
 
+        self.executors = Executors(self.config.get('executors', None))
+
+        self._resources = []
+
+        self._subscribers = {}
+        self.bus = Bus(self._subscribers)
+
+        self._lazy_apps = []
+
+    def load_translations(self, directory):
+        """
+        Load the translations of every locale from a directory, once at
+        startup.  The directory either contains CSV translations, like
+        ``zh_CN.csv``, or gettext catalogs, like
+        ``zh_CN/LC_MESSAGES/messages.mo``.
+
+        The gettext domain is the ``translations_domain`` setting,
+        ``messages`` by default.  Set ``default_locale`` to change the
+        locale used when the browser asks for none of them.
+
+        :param directory:
+          path of the directory, relative to the root path.
+        """
+        directory = os.path.join(self.root_path, directory)
+        if any(f.endswith('.csv') for f in os.listdir(directory)):
+            tornado.locale.load_translations(directory)
+        else:
+            tornado.locale.load_gettext_translations(
+                directory, self.config.get('translations_domain', 'messages')
+            )
+        default_locale = self.config.get('default_locale', None)
+        if default_locale:
+            tornado.locale.set_default_locale(default_locale)
+
     def filter(self, f):
         """
         Decorator to add a filter to Waterspout.
@@ -97,56 +157,227 @@ class Waterspout(object):
             urlspec.append(name)
         self.handlers.append(urlspec)
 
-    def register_app(self, app, prefix='', domain=''):
+    def add_executor(self, name, max_workers):
+        """
+        Add a named thread pool to Waterspout.
+
+        Use it in your handlers like ::
+
+            waterspout.add_executor('db', 8)
+
+            class UserHandler(RequestHandler):
+                @run_on_executor('db')
+                def load(self, user_id):
+                    return User.get(user_id)
+
+        :param name: name of the pool.
+        :param max_workers: how many threads the pool may start.
+        """
+        self.executors.add(name, max_workers)
+
+    def add_resource(self, name, setup, teardown=None):
+        """
+        Add an application-scoped resource to Waterspout.
+
+        Resources are created in every worker process after forking,
+        before serving, and destroyed when the worker stops.
+        Access them in your handlers with ``self.resources.<name>``.
+
+        :param name: name of the resource.
+        :param setup:
+          function called without arguments to create the resource.
+          It may return a future.
+        :param teardown:
+          (optional) function called with the resource to destroy it.
+          It may return a future.
+        """
+        self._resources.append((name, setup, teardown))
+
+    def resource(self, name, teardown=None):
+        """
+        Decorator to add an application-scoped resource to Waterspout.
+
+        Example ::
+
+            @waterspout.resource('http', teardown=lambda c: c.close())
+            def http_client():
+                return AsyncHTTPClient(force_instance=True, max_clients=50)
+
+            class FetchHandler(RequestHandler):
+                @tornado.gen.coroutine
+                def get(self):
+                    response = yield self.resources.http.fetch(URL)
+
+        :param name: name of the resource.
+        :param teardown:
+          (optional) function called with the resource to destroy it.
+        """
+        def decorator(f):
+            self.add_resource(name, f, teardown)
+            return f
+        return decorator
+
+    def subscribe(self, channel, callback=None):
+        """
+        Call ``callback(message)`` for every message published on
+        ``channel``, by any worker process.  Can be used as a decorator ::
+
+            @waterspout.subscribe('config')
+            def reload_config(message):
+                settings.update(message)
+
+        :param channel: name of the channel.
+        :param callback: (optional) the subscriber.
+        """
+        if callback is None:
+            def decorator(f):
+                self.subscribe(channel, f)
+                return f
+            return decorator
+        self._subscribers.setdefault(channel, []).append(callback)
+        return callback
+
+    def publish(self, channel, message):
+        """
+        Publish a JSON-serializable message on ``channel`` to every worker
+        process, through the :class:`~waterspout.bus.Bus` of the
+        application.
+
+        :param channel: name of the channel.
+        :param message: the message.
+        """
+        self.bus.publish(channel, message)
+
+    def invalidate(self, cache, key=None):
+        """
+        Remove ``key`` from ``application.caches[cache]`` in every worker
+        process, or clear the cache if ``key`` is ``None``.
+
+        :param cache: name of the cache, like ``fragments``.
+        :param key: (optional) the key to remove.
+        """
+        self.bus.invalidate(cache, key)
+
+    def register_app(self, app, prefix='', domain='', warm_up=False):
         """
         Register an app to waterspout.
 
-        :param app: A Waterspout app.
+        The app may be given as an import string, like
+        ``myproject.admin:app``.  It is then imported on the first request
+        under ``prefix``, which is required, and its handlers are compiled
+        and its templates found from then on ::
+
+            waterspout.register_app('myproject.admin:app', prefix='/admin')
+
+        Until the app is imported, requests under ``prefix`` get a 503
+        response if importing it fails.
+
+        :param app: A Waterspout app, or its import string.
         :param prefix:
           URL prefix for this app.
           Will be ``/<app_name>`` by default
         :param domain:
           Domain for this app.
+        :param warm_up:
+          If ``True``, an app given as an import string is imported in the
+          background once the server listens, instead of on the first
+          request.
         """
+        if isinstance(app, string_types):
+            if not prefix:
+                raise ValueError("An app registered by import string "
+                                 "requires a prefix.")
+            lazy_app = LazyApp(self, app, prefix, warm_up)
+            self._lazy_apps.append(lazy_app)
+            self._add_handlers([lazy_app.placeholder()], domain)
+            return
         if app.parent is not None:
             print("%s has been registered before." % app)
             return
         if not prefix:
             prefix = '/%s' % app.name
-        self.template_paths.append(app.template_path)
+        self._attach_app(app)
+        self._add_handlers(self._app_handlers(app, prefix), domain)
 
+    def _attach_app(self, app):
         if hasattr(app, "_user_loader"):
             if self._user_loader:
                 raise RuntimeError("An user loader already registered"
                                    "But %s app provided another." % app.name)
             self._user_loader = app._user_loader
 
+        if app.template_path not in self.template_paths:
+            self.template_paths.append(app.template_path)
+
+        self.filters.update(app.filters)
+        app.parent = self
+
+    def _app_handlers(self, app, prefix):
         if prefix == '/':
-            handlers = app.handlers
-        else:
-            handlers = []
-            for handler_class in app.handlers:
-                url = '%s%s' % (prefix, handler_class[0])
-                new_handler_class = [url] + list(handler_class[1:])
-                handlers.append(tuple(new_handler_class))
+            return app.handlers
+        handlers = []
+        for handler_class in app.handlers:
+            url = '%s%s' % (prefix, handler_class[0])
+            new_handler_class = [url] + list(handler_class[1:])
+            handlers.append(tuple(new_handler_class))
+        return handlers
+
+    def _add_handlers(self, handlers, domain):
         if domain:
             domain = "^{}$".format(domain.strip("^$"))
             self.handlers += [domain, handlers]
         else:
             self.handlers += handlers
-        self.filters.update(app.filters)
-        app.parent = self
 
     @property
     def application(self):
+        etag_hash = self.config.get('etag_hash', 'sha1')
+        if etag_hash is not None and etag_hash not in ETAG_HASHES:
+            raise ValueError("Unknown etag_hash %r, use one of %s or None." %
+                             (etag_hash, ", ".join(sorted(ETAG_HASHES))))
+        handlers = self.handlers
+        if self.config.get('admin_token', None):
+            from .admin import AdminHandler
+            handlers = [(self.config.get('admin_path', '/_waterspout'),
+                         AdminHandler)] + handlers
         application = tornado.web.Application(
-            handlers=self.handlers,
+            handlers=handlers,
             **self.config
         )
+        application.resources = Resources(self._resources)
+        application.url_builder = URLBuilder(application.named_handlers)
+        application.lazy_apps = list(self._lazy_apps)
         auto_escape = self.config.get('autoescape', False)
         env = Environment(
             autoescape=auto_escape,
-            loader=FileSystemLoader(self.template_paths)
+            loader=FileSystemLoader(self.template_paths),
+            extensions=[FragmentCacheExtension, 'jinja2.ext.i18n']
+        )
+        env.cache = TemplateCache(self.config.get('template_cache_size', 400))
+        env.fragment_cache = FragmentCache(
+            self.config.get('fragment_cache_backend', None),
+            ttl=self.config.get('fragment_cache_ttl', 300)
+        )
+        env.translations = Translations()
+        env.translations.install(env)
+        application.locale_cache = LRUCache(
+            self.config.get('locale_cache_size', 1000)
+        )
+        application.session_cache = SessionCache(
+            self.config.get('session_cache_bytes', 16 * 1024 * 1024)
+        )
+        application.caches = {
+            'fragments': env.fragment_cache,
+            'locales': application.locale_cache,
+            'sessions': application.session_cache
+        }
+        application.caches.update(memoized)
+        self.bus.caches = application.caches
+        application.bus = self.bus
+        application.resources.add(
+            'bus', lambda: application.bus.start(
+                self.config.get('bus_path', None)
+            ), lambda bus: bus.stop()
         )
         sentry_dsn = self.config.get('sentry_dsn', None)
         if sentry_dsn:
@@ -154,16 +385,116 @@ class Waterspout(object):
                 from raven.contrib.tornado import AsyncSentryClient
                 assert AsyncSentryClient
             except ImportError:
-                import logging
                 logging.warning("Sentry support requires raven."
                                 "Run: pip install raven")
                 application.sentry_client = None
             else:
-                application.sentry_client = AsyncSentryClient(sentry_dsn)
+                from .sentry import ErrorReporter
+                client = AsyncSentryClient(sentry_dsn)
+                application.sentry_client = client
+                application.error_reporter = ErrorReporter(
+                    client,
+                    window=self.config.get('sentry_dedup_window', 60),
+                    sample_rate=self.config.get('sentry_sample_rate', 0.0),
+                    queue_size=self.config.get('sentry_queue_size', 1000),
+                    max_sends=self.config.get('sentry_max_sends', 20),
+                    flush_interval=self.config.get('sentry_flush_interval', 1),
+                    max_fingerprints=self.config.get(
+                        'sentry_max_fingerprints', 10000
+                    )
+                )
+                application.resources.add(
+                    'error_reporter', application.error_reporter.start,
+                    lambda reporter: reporter.stop()
+                )
 
         env.filters = self.filters
         application.env = env
         application._user_loader = self._user_loader
+        application.executors = self.executors
+
+        config = self.config
+        if (config.get('loop_monitor', False) or
+                config.get('blocking_threshold', None) or
+                config.get('shed_ioloop_lag', None)):
+            application.loop_monitor = LoopMonitor(
+                config.get('loop_monitor_interval', 0.5),
+                config.get('blocking_threshold', None)
+            )
+            application.resources.add(
+                'loop_monitor', application.loop_monitor.start,
+                lambda monitor: monitor.stop()
+            )
+        else:
+            application.loop_monitor = None
+        application.admission = AdmissionControl(
+            self.config, application.loop_monitor
+        )
+        application.hub = Hub(config.get('websocket_ping_interval', None))
+        application.resources.add(
+            'hub', application.hub.start, lambda hub: hub.stop()
+        )
+        access_log = config.get('access_log', None)
+        if access_log:
+            application.access_log = AccessLog(
+                None if access_log == '-' else access_log,
+                config.get('access_log_sample_rate', 1.0),
+                config.get('access_log_buffer_size', 10000),
+                config.get('access_log_flush_interval', 1.0)
+            )
+            application.settings['log_function'] = application.access_log
+            application.resources.add(
+                'access_log', application.access_log.start,
+                lambda log: log.stop()
+            )
+        tracing_file = config.get('tracing_file', None)
+        tracing_endpoint = config.get('tracing_endpoint', None)
+        if tracing_file or tracing_endpoint:
+            if tracing_endpoint:
+                exporter = OTLPExporter(
+                    tracing_endpoint,
+                    config.get('tracing_service_name', 'waterspout')
+                )
+            else:
+                exporter = JSONLinesExporter(
+                    tracing_file, self.executors['default']
+                )
+            application.tracer = Tracer(
+                exporter, config.get('tracing_sample_rate', 1.0),
+                config.get('tracing_flush_interval', 1.0)
+            )
+            application.resources.add(
+                'tracer', application.tracer.start,
+                lambda tracer: tracer.stop()
+            )
+        else:
+            application.tracer = None
+        if config.get('memory_profile_sample_rate', None):
+            application.memory_profiler = MemoryProfiler(
+                config['memory_profile_sample_rate'],
+                config.get('memory_profile_interval', 300),
+                config.get('memory_profile_top', 10),
+                config.get('memory_profile_frames', 1),
+                config.get('memory_profile_file', None)
+            )
+            application.resources.add(
+                'memory_profiler', application.memory_profiler.start,
+                lambda profiler: profiler.stop()
+            )
+        else:
+            application.memory_profiler = None
+        application.tasks = TaskQueue(
+            config.get('task_concurrency', 10),
+            config.get('task_queue_size', 10000),
+            config.get('task_retries', 0),
+            config.get('task_retry_delay', 1.0),
+            self.executors
+        )
+        application.resources.add(
+            'tasks', application.tasks.start, lambda tasks: tasks.join(
+                float(config.get('shutdown_timeout', 30))
+            )
+        )
 
         return application
 
@@ -197,22 +528,76 @@ class Waterspout(object):
     def run(self):
         """
         Run your Waterspout Application.
+
+        Set ``processes`` in config to fork that many worker processes,
+        ``0`` meaning one per CPU.  Resources are created in each worker.
+
+        Set ``admin_token`` to describe each worker at ``/_waterspout``,
+        see :mod:`waterspout.admin`.
+
+        Set ``loop_monitor`` to measure the IOLoop lag of each worker, and
+        ``blocking_threshold`` to log the stack of any code blocking the
+        IOLoop longer than that many seconds.
+        Set ``memory_profile_sample_rate`` to report the memory retained
+        by the requests of each handler, see :mod:`waterspout.memory`.
+
+        On ``SIGTERM``, Waterspout stops accepting connections and waits up
+        to ``shutdown_timeout`` seconds (30 by default) for in-flight
+        requests, then as long for queued tasks, before tearing down
+        resources.
+        On ``SIGHUP``, a fresh copy of the program is started with the
+        listening sockets inherited, then the old workers are drained once
+        the new ones serve requests.  If they don't within
+        ``reload_timeout`` seconds (60 by default), the new copy is stopped
+        and the old workers keep serving.
+
+        Crashed workers are restarted after 0, 1, 3, 7... seconds, at most
+        ``worker_max_restarts`` times (5 by default) within
+        ``worker_restart_window`` seconds (60 by default).
         """
-        from tornado.httpserver import HTTPServer
         import tornado.ioloop
+        from . import process
         application = self.application
         tornado.options.parse_command_line()
         if options.config:
             tornado.options.parse_config_file(options.config)
-        http_server = HTTPServer(application)
 
         address = self.config.get('address', '127.0.0.1')
         port = int(self.config.get('port', 8888))
+        processes = int(self.config.get('processes', 1))
+        reload_timeout = float(self.config.get('reload_timeout', 60))
+
+        sockets = process.bind_sockets(port, address)
+        if processes != 1:
+            process.fork_workers(
+                processes, sockets,
+                int(self.config.get('worker_max_restarts', 5)),
+                float(self.config.get('worker_restart_window', 60)),
+                reload_timeout
+            )
+
+        io_loop = tornado.ioloop.IOLoop.instance()
+        io_loop.run_sync(application.resources.setup)
+        http_server = application.http_server = process.HTTPServer(
+            application
+        )
+        http_server.add_sockets(sockets)
+        for lazy_app in application.lazy_apps:
+            if lazy_app.warm_up:
+                lazy_app.load_in_background(application)
+        drain = process.Drain(
+            http_server, application.admission, io_loop,
+            float(self.config.get('shutdown_timeout', 30)), reload_timeout
+        )
+        drain.install(sockets if processes == 1 else None)
+        process.notify_ready()
 
-        http_server.listen(port, address)
-        import logging
         logging.info("Start serving at %s:%s" % (address, port))
-        tornado.ioloop.IOLoop.instance().start()
+        try:
+            io_loop.start()
+        finally:
+            io_loop.run_sync(application.resources.teardown)
+            self.executors.shutdown(wait=False)
 
 
 class App(object):
@@ -331,3 +716,94 @@ class App(object):
         """
         self._user_loader = f
         return f
+
+
+class LazyApp(object):
+    """
+    An app registered by import string.  Its prefix is served by a
+    :class:`~waterspout.web.LazyAppHandler` until the first request, which
+    imports the app and replaces the placeholder by the app's handlers.
+
+    :param waterspout: the Waterspout the app is registered to.
+    :param import_name: the import string of the app.
+    :param prefix: URL prefix for this app.
+    :param warm_up: whether to import the app once the server listens.
+    """
+
+    def __init__(self, waterspout, import_name, prefix, warm_up=False):
+        self.waterspout = waterspout
+        self.import_name = import_name
+        self.prefix = prefix
+        self.warm_up = warm_up
+        self.app = None
+        self.retry_at = 0
+
+    def placeholder(self):
+        from .web import LazyAppHandler
+        pattern = '/.*' if self.prefix == '/' else '%s/.*' % self.prefix
+        return (pattern, LazyAppHandler, dict(lazy_app=self))
+
+    def load(self):
+        """
+        Import the app, and register its templates, filters and user
+        loader to the Waterspout.
+        """
+        if self.app is None:
+            app = import_string(self.import_name)
+            self.waterspout._attach_app(app)
+            self.app = app
+        return self.app
+
+    def install(self, application):
+        """
+        Replace the placeholder of ``application`` by the handlers of the
+        app, importing it if needed.
+
+        :return: ``False`` if the app was already installed.
+        """
+        app = self.load()
+        specs = [
+            tornado.web.URLSpec(*spec) if isinstance(spec, (tuple, list))
+            else spec
+            for spec in self.waterspout._app_handlers(app, self.prefix)
+        ]
+        for _, host_specs in application.handlers:
+            for index, spec in enumerate(host_specs):
+                if spec.kwargs.get('lazy_app') is self:
+                    host_specs[index:index + 1] = specs
+                    break
+            else:
+                continue
+            break
+        else:
+            return False
+        for spec in specs:
+            if spec.name:
+                application.named_handlers[spec.name] = spec
+        application.url_builder = URLBuilder(application.named_handlers)
+        search_path = application.env.loader.searchpath
+        if app.template_path not in search_path:
+            search_path.append(app.template_path)
+        if application._user_loader is None:
+            application._user_loader = self.waterspout._user_loader
+        return True
+
+    def load_in_background(self, application):
+        """
+        Import the app in the default executor, then install it in
+        ``application`` on the IOLoop.
+        """
+        from tornado.ioloop import IOLoop
+        future = self.waterspout.executors['default'].submit(
+            import_string, self.import_name
+        )
+
+        def on_import(future):
+            if future.exception() is not None:
+                logging.error("Failed to warm up %s: %s" %
+                              (self.import_name, future.exception()))
+                return
+            self.install(application)
+
+        IOLoop.current().add_future(future, on_import)
+        return future
@@ -0,0 +1,290 @@
+"""
+A message bus between the worker processes of a Waterspout application.
+
+Every worker binds a Unix datagram socket in a directory shared by the
+workers, and sends published messages to the sockets of its siblings.
+No broker is involved.
+"""
+
+import os
+import json
+import stat
+import errno
+import socket
+import logging
+import tempfile
+
+from tornado.escape import utf8, json_decode
+from tornado.ioloop import IOLoop
+
+from .process import task_id
+
+CACHE_CHANNEL = 'waterspout.caches'
+
+
+def invalidate_cache(cache, key=None):
+    """
+    Remove ``key`` from a cache of ``application.caches``, or clear it if
+    ``key`` is ``None``.
+
+    :raise TypeError: if keys can't be removed from the cache.
+    """
+    if key is None:
+        cache.clear()
+        return
+    for name in ('invalidate', 'delete', 'pop'):
+        method = getattr(cache, name, None)
+        if method is not None:
+            method(key)
+            return
+    raise TypeError("%r has no invalidate, delete or pop method" % cache)
+
+
+def check_directory(path):
+    """
+    Raise :exc:`RuntimeError` unless ``path`` is a directory, not a
+    symbolic link, owned by the current user and only accessible to them.
+    """
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        raise RuntimeError(
+            "Refusing to use %s for the bus: it must be a directory owned "
+            "by the current user, with a mode of 0700." % path
+        )
+
+
+class Bus(object):
+    """
+    Publish/subscribe between worker processes ::
+
+        @waterspout.subscribe('config')
+        def reload_config(message):
+            settings.update(message)
+
+        waterspout.publish('config', {'maintenance': True})
+
+    A message is any JSON-serializable value.  Subscribers of the
+    publishing worker are called at once; messages for the other workers
+    are batched, and sent once per IOLoop iteration in as few datagrams
+    as possible.
+
+    When Waterspout runs a single process, and no path is given, messages
+    are only delivered locally.
+
+    :param subscribers:
+      (optional) a dictionary mapping channels to lists of callbacks.
+    :param caches:
+      (optional) the caches which can be invalidated with
+      :meth:`invalidate`, by name.
+    :param max_datagram: the maximum size of a datagram, in bytes.
+    """
+
+    def __init__(self, subscribers=None, caches=None, max_datagram=60000):
+        if subscribers is None:
+            subscribers = {}
+        self.subscribers = subscribers
+        self.caches = caches if caches is not None else {}
+        self.max_datagram = max_datagram
+        self.path = None
+        self.name = None
+        self.io_loop = None
+        self.published = 0
+        self.received = 0
+        self.datagrams = 0
+        self.dropped = 0
+        self._socket = None
+        self._inode = None
+        self._owns_path = False
+        self._queue = []
+        self._flushing = False
+        self._peers = []
+        self._peers_updated = 0
+
+    def subscribe(self, channel, callback):
+        """
+        Call ``callback(message)`` for every message published on
+        ``channel``.
+        """
+        self.subscribers.setdefault(channel, []).append(callback)
+
+    def unsubscribe(self, channel, callback):
+        callbacks = self.subscribers.get(channel)
+        if callbacks and callback in callbacks:
+            callbacks.remove(callback)
+
+    def publish(self, channel, message):
+        """
+        Publish a message on ``channel`` to every worker.
+        """
+        self.published += 1
+        self._dispatch(channel, message)
+        if self._socket is None:
+            return
+        self._queue.append(utf8(json.dumps([channel, message],
+                                           separators=(',', ':'))))
+        if not self._flushing:
+            self._flushing = True
+            self.io_loop.add_callback(self.flush)
+
+    def invalidate(self, cache, key=None):
+        """
+        Remove ``key`` from the cache named ``cache`` in every worker, or
+        clear it if ``key`` is ``None``.
+        """
+        self.publish(CACHE_CHANNEL, [cache, key])
+
+    def _dispatch(self, channel, message):
+        if channel == CACHE_CHANNEL:
+            cache = self.caches.get(message[0])
+            if cache is not None:
+                try:
+                    invalidate_cache(cache, message[1])
+                except Exception:
+                    logging.exception("Failed to invalidate %s" % message[0])
+        for callback in list(self.subscribers.get(channel, ())):
+            try:
+                callback(message)
+            except Exception:
+                logging.exception("Error in subscriber of %s" % channel)
+
+    def start(self, path=None, name=None, io_loop=None):
+        """
+        Bind the socket of this worker and start receiving messages.
+
+        The directory must belong to the user running Waterspout, and be
+        private to them; otherwise :exc:`RuntimeError` is raised, since
+        other users could read and forge messages.
+
+        :param path:
+          (optional) the directory of the sockets.  By default, a
+          directory named after the user and the master process, in
+          ``$XDG_RUNTIME_DIR`` or the temporary directory, which is
+          removed by the last worker to stop.
+        :param name:
+          (optional) the name of this worker, its task id by default.
+        """
+        if self._socket is not None:
+            return self
+        if name is None:
+            name = task_id()
+        if path is None:
+            if name is None:
+                return self
+            path = os.path.join(
+                os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(),
+                'waterspout-%d-%d' % (os.getuid(), os.getppid())
+            )
+            self._owns_path = True
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        check_directory(path)
+        self.path = os.path.join(path, '%s.sock' % (name or 0))
+        self.name = name
+        self.io_loop = io_loop or IOLoop.current()
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock.bind(self.path)
+        self._inode = os.stat(self.path).st_ino
+        self._socket = sock
+        self.io_loop.add_handler(sock.fileno(), self._on_read, IOLoop.READ)
+        return self
+
+    def stop(self):
+        """
+        Send the pending messages, and close the socket.
+        """
+        if self._socket is None:
+            return
+        self.flush()
+        self.io_loop.remove_handler(self._socket.fileno())
+        self._socket.close()
+        self._socket = None
+        try:
+            # A reloaded worker may have replaced the socket already.
+            if os.stat(self.path).st_ino == self._inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+        if self._owns_path:
+            try:
+                # Fails while other workers still have their socket.
+                os.rmdir(os.path.dirname(self.path))
+            except OSError:
+                pass
+
+    def _update_peers(self):
+        now = self.io_loop.time()
+        if now - self._peers_updated < 1:
+            return
+        directory = os.path.dirname(self.path)
+        self._peers = [
+            os.path.join(directory, f) for f in os.listdir(directory)
+            if f.endswith('.sock') and os.path.join(directory, f) != self.path
+        ]
+        self._peers_updated = now
+
+    def _batches(self):
+        batch, size = [], 0
+        for item in self._queue:
+            if batch and size + len(item) + 1 > self.max_datagram:
+                yield b'\n'.join(batch)
+                batch, size = [], 0
+            batch.append(item)
+            size += len(item) + 1
+        if batch:
+            yield b'\n'.join(batch)
+
+    def flush(self):
+        """
+        Send the pending messages to the other workers.
+        """
+        self._flushing = False
+        if not self._queue or self._socket is None:
+            return
+        self._update_peers()
+        for datagram in self._batches():
+            for peer in list(self._peers):
+                try:
+                    self._socket.sendto(datagram, peer)
+                except socket.error as e:
+                    self.dropped += 1
+                    if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                        self._peers.remove(peer)
+                    elif e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        logging.warning("Failed to send to %s: %s" %
+                                        (peer, e))
+                else:
+                    self.datagrams += 1
+        self._queue = []
+
+    def _on_read(self, fd, events):
+        while self._socket is not None:
+            try:
+                datagram = self._socket.recv(65536)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            for line in datagram.split(b'\n'):
+                try:
+                    channel, message = json_decode(line)
+                except ValueError:
+                    logging.warning("Invalid bus message: %r" % line[:100])
+                    continue
+                self.received += 1
+                self._dispatch(channel, message)
+
+    def stats(self):
+        """
+        Return a dictionary describing the bus.
+        """
+        return dict(published=self.published, received=self.received,
+                    datagrams=self.datagrams, dropped=self.dropped,
+                    peers=len(self._peers))
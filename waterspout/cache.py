@@ -0,0 +1,347 @@
+"""
+Cache backends shared by Waterspout's caches.
+
+A backend stores values under string keys with an optional TTL in
+seconds, and provides ``get``, ``set``, ``add``, ``delete`` and ``clear``.
+"""
+
+import time
+import inspect
+import hashlib
+import logging
+import functools
+
+import tornado.gen
+
+from tornado.concurrent import Future, is_future
+from tornado.ioloop import IOLoop
+
+from .utils import LRUCache, to_unicode
+
+#: Every memoized function, by name.
+memoized = {}
+
+
+class MemoryCache(object):
+    """
+    An in-process LRU cache backend.
+
+    :param capacity: the maximum number of entries.
+    """
+
+    def __init__(self, capacity=1024):
+        self._data = LRUCache(capacity)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires is not None and expires <= time.time():
+            self._data.pop(key)
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        self._data[key] = (value, expires)
+
+    def add(self, key, value, ttl=None):
+        """
+        Set ``key`` only if it is not set yet.
+
+        :return: ``True`` if ``key`` is set.
+        """
+        if self.get(key) is not None:
+            return False
+        self.set(key, value, ttl)
+        return True
+
+    def delete(self, key):
+        self._data.pop(key)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return self._data.stats()
+
+
+class MemcacheCache(object):
+    """
+    A backend for memcached-like clients, such as ``python-memcached`` or
+    ``pymemcache``, whose ``get``, ``set``, ``add`` and ``delete`` methods
+    take the expiration time as their third argument ::
+
+        import memcache
+        backend = MemcacheCache(memcache.Client(['127.0.0.1:11211']))
+
+    Keys are namespaced with a version stored in memcached, and
+    :meth:`clear` increments it instead of flushing the whole server:
+    entries of the previous version are left to expire.  Every instance
+    reads the version again after ``version_ttl`` seconds.
+
+    :param client: the memcached client.
+    :param prefix: prefix of every key.
+    :param version_ttl: how many seconds the version is kept in memory.
+    """
+
+    def __init__(self, client, prefix='waterspout:', version_ttl=1):
+        self.client = client
+        self.prefix = prefix
+        self.version_ttl = version_ttl
+        self._version = None
+        self._version_expires = 0
+
+    @property
+    def version(self):
+        now = time.time()
+        if self._version is None or now >= self._version_expires:
+            version_key = str(self.prefix + 'version')
+            version = self.client.get(version_key)
+            if version is None:
+                self.client.add(version_key, int(now), 0)
+                version = self.client.get(version_key) or int(now)
+            self._version = int(version)
+            self._version_expires = now + self.version_ttl
+        return self._version
+
+    def _key(self, key):
+        prefix = '%s%d:' % (self.prefix, self.version)
+        key = prefix + to_unicode(key)
+        if len(key) > 200 or any(c.isspace() for c in key):
+            key = prefix + hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return str(key)
+
+    def get(self, key):
+        return self.client.get(self._key(key))
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), value, int(ttl or 0))
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.add(self._key(key), value, int(ttl or 0)))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        version_key = str(self.prefix + 'version')
+        incr = getattr(self.client, 'incr', None)
+        version = incr(version_key, 1) if incr is not None else None
+        if not version:
+            version = self.version + 1
+            self.client.set(version_key, version, 0)
+        self._version = int(version)
+        self._version_expires = time.time() + self.version_ttl
+
+
+def is_coroutine_function(fn):
+    """
+    Return whether ``fn`` is decorated with ``tornado.gen.coroutine``.
+
+    Tornado 4.5 and later mark coroutines; with older versions, the
+    wrapped generator function is only known on Python 3.
+    """
+    detect = getattr(tornado.gen, 'is_coroutine_function', None)
+    if detect is not None:
+        return detect(fn)
+    wrapped = getattr(fn, '__wrapped__', None)
+    return wrapped is not None and inspect.isgeneratorfunction(wrapped)
+
+
+def default_key(*args, **kwargs):
+    """
+    Build a cache key from the arguments of a call.
+    """
+    if kwargs:
+        return repr((args, sorted(kwargs.items())))
+    return repr(args)
+
+
+class Memoized(object):
+    """
+    A function whose results are cached.  See :func:`memoize`.
+    """
+
+    def __init__(self, fn, ttl=60, maxsize=1024, key=None, stale=0,
+                 backend=None, name=None, coroutine=None):
+        functools.update_wrapper(self, fn)
+        self.fn = fn
+        self.ttl = ttl
+        self.stale = stale
+        self.key = key or default_key
+        if backend is None:
+            backend = MemoryCache(maxsize)
+        self.backend = backend
+        self.name = name or '%s.%s' % (fn.__module__, fn.__name__)
+        if coroutine is None:
+            coroutine = is_coroutine_function(fn)
+        self.coroutine = coroutine
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._flights = {}
+        memoized[self.name] = self
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        # The repr of an instance holds its address, which can be reused
+        # by another instance once it is freed.
+        if self.key is default_key:
+            raise TypeError("%s is a method: memoize it with a key function "
+                            "taking the instance" % self.name)
+        return functools.partial(self, obj)
+
+    def make_key(self, args, kwargs):
+        return '%s:%s' % (self.name, self.key(*args, **kwargs))
+
+    def __call__(self, *args, **kwargs):
+        key = self.make_key(args, kwargs)
+        entry = self.backend.get(key)
+        if entry is not None:
+            value, fresh_until = entry
+            if fresh_until is None or time.time() < fresh_until:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+                self._refresh(key, args, kwargs)
+            return self._result(value)
+        self.misses += 1
+        return self._call(key, args, kwargs)
+
+    def _result(self, value):
+        if self.coroutine:
+            future = Future()
+            future.set_result(value)
+            return future
+        return value
+
+    def _store(self, key, value):
+        if self.ttl is None:
+            self.backend.set(key, (value, None))
+        else:
+            self.backend.set(key, (value, time.time() + self.ttl),
+                             self.ttl + self.stale)
+
+    def _call(self, key, args, kwargs):
+        if self.coroutine and key in self._flights:
+            return self._flights[key]
+        result = self.fn(*args, **kwargs)
+        if not self.coroutine:
+            if is_future(result):
+                logging.warning("%s returned a Future, which isn't cached: "
+                                "memoize it with coroutine=True" % self.name)
+            else:
+                self._store(key, result)
+            return result
+        self._flights[key] = result
+
+        def done(future):
+            self._flights.pop(key, None)
+            if future.exception() is None:
+                self._store(key, future.result())
+        IOLoop.current().add_future(result, done)
+        return result
+
+    def _refresh(self, key, args, kwargs):
+        if key in self._flights:
+            return
+        if self.coroutine:
+            future = self._call(key, args, kwargs)
+            IOLoop.current().add_future(future, self._log_failure)
+            return
+
+        def refresh():
+            try:
+                self._store(key, self.fn(*args, **kwargs))
+            except Exception:
+                logging.exception("Failed to refresh %s" % key)
+            finally:
+                self._flights.pop(key, None)
+        self._flights[key] = True
+        IOLoop.current().add_callback(refresh)
+
+    def _log_failure(self, future):
+        if future.exception() is not None:
+            logging.warning("Failed to refresh %s: %r" %
+                            (self.name, future.exception()))
+
+    def invalidate(self, *args, **kwargs):
+        """
+        Remove the cached result of a call with these arguments.
+        """
+        self.backend.delete(self.make_key(args, kwargs))
+
+    def clear(self):
+        """
+        Remove every cached result, by clearing the backend.
+        """
+        self.backend.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of hit and miss counters.
+        """
+        total = self.hits + self.misses + self.stale_hits
+        stats = dict(hits=self.hits, misses=self.misses,
+                     stale=self.stale_hits,
+                     hit_rate=float(self.hits + self.stale_hits) / total
+                     if total else 0.0)
+        if hasattr(self.backend, '__len__'):
+            stats['size'] = len(self.backend)
+        return stats
+
+
+def memoize(ttl=60, maxsize=1024, key=None, stale=0, backend=None,
+            name=None, coroutine=None):
+    """
+    Decorator caching the results of a function, or of a coroutine ::
+
+        @memoize(ttl=300, stale=60)
+        @tornado.gen.coroutine
+        def load_user(user_id):
+            user = yield db.get_user(user_id)
+            raise tornado.gen.Return(user)
+
+    Concurrent calls of a coroutine with the same arguments share one
+    call.  For ``stale`` seconds after a result expires, it is still
+    returned while a single call refreshes it in the background.
+
+    Every memoized function is listed in :data:`memoized`, and in
+    ``application.caches``, so a result can be removed from handlers with
+    ``load_user.invalidate(user_id)``, or from every worker with
+    ``waterspout.invalidate('myapp.users.load_user', user_id)``.
+
+    :param ttl: seconds a result is fresh, or ``None`` to keep it forever.
+    :param maxsize: how many results are kept by the default backend.
+    :param key:
+      (optional) function building a key from the arguments,
+      :func:`default_key` by default.  Methods must be memoized with a
+      key function, which is passed the instance first, as the ``repr``
+      of an instance isn't a stable key ::
+
+          class User(object):
+              @memoize(key=lambda self, size: '%d:%d' % (self.id, size))
+              def avatar(self, size):
+                  ...
+    :param stale: seconds an expired result may still be returned.
+    :param backend:
+      (optional) a cache backend, a :class:`MemoryCache` of ``maxsize``
+      results by default.
+    :param name:
+      (optional) name of the cache, the qualified name of the function by
+      default.
+    :param coroutine:
+      (optional) whether the function is a coroutine, detected with
+      :func:`is_coroutine_function` by default.  Pass ``True`` for
+      coroutines on Python 2 with Tornado older than 4.5.
+    """
+    def decorator(fn):
+        return Memoized(fn, ttl, maxsize, key, stale, backend, name,
+                        coroutine)
+    return decorator
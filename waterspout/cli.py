@@ -0,0 +1,339 @@
+"""
+The ``waterspout`` command.
+
+``waterspout bench`` starts an application and measures it under load ::
+
+    waterspout bench myproject.app:waterspout --processes 4 \\
+        --concurrency 50 --duration 30 --url / --url /posts --url /posts \\
+        --output 0.4.json
+
+Repeat an URL to request it more often.  The results saved with
+``--output`` can be compared between releases.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import random
+import signal
+import socket
+import optparse
+import platform
+import traceback
+
+import tornado
+import tornado.gen
+
+from tornado.ioloop import IOLoop
+from tornado.httpclient import AsyncHTTPClient
+
+import waterspout
+
+from waterspout.app import Waterspout
+from waterspout.utils import import_string
+
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
+
+USAGE = """usage: waterspout <command> [options]
+
+Commands:
+  bench    start an application and measure it under load
+
+Run "waterspout <command> --help" for the options of a command."""
+
+
+def percentile(samples, percent):
+    """
+    Return the given percentile of sorted samples.
+
+    :param samples: a sorted list of numbers.
+    :param percent: a number between 0 and 100.
+    """
+    if not samples:
+        return 0.0
+    index = int(round(percent / 100.0 * (len(samples) - 1)))
+    return samples[index]
+
+
+def _latency(samples):
+    samples = sorted(samples)
+    mean = sum(samples) / len(samples) if samples else 0.0
+    return dict(
+        mean=round(mean, 3), p50=round(percentile(samples, 50), 3),
+        p90=round(percentile(samples, 90), 3),
+        p99=round(percentile(samples, 99), 3),
+        max=round(samples[-1], 3) if samples else 0.0
+    )
+
+
+def summarize(results, elapsed):
+    """
+    Return the statistics of a benchmark.
+
+    :param results: a list of ``(url, status, latency)`` tuples, the
+      latency in milliseconds.  Failed requests have a status of 599.
+    :param elapsed: the duration of the benchmark, in seconds.
+    """
+    statuses = {}
+    urls = {}
+    for url, status, latency in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        urls.setdefault(url, []).append((status, latency))
+    errors = sum(1 for _, status, _ in results if status >= 400)
+    return dict(
+        requests=len(results),
+        errors=errors,
+        elapsed=round(elapsed, 3),
+        throughput=round(len(results) / elapsed, 2) if elapsed else 0.0,
+        latency=_latency([latency for _, _, latency in results]),
+        statuses=statuses,
+        urls=dict((url, dict(
+            requests=len(samples),
+            errors=sum(1 for status, _ in samples if status >= 400),
+            latency=_latency([latency for _, latency in samples])
+        )) for url, samples in urls.items())
+    )
+
+
+class Bench(object):
+    """
+    Requests URLs with ``concurrency`` concurrent clients, for
+    ``duration`` seconds or until ``requests`` requests were made.
+
+    Connections are kept alive when ``pycurl`` is installed; Tornado's
+    simple HTTP client opens a connection per request.
+
+    :param base_url: the URL of the server, like ``http://127.0.0.1:8888``.
+    :param paths: the paths requested, picked at random.
+    """
+
+    def __init__(self, base_url, paths, concurrency=10, duration=10,
+                 requests=None, timeout=20, io_loop=None):
+        self.base_url = base_url.rstrip('/')
+        self.paths = paths
+        self.concurrency = concurrency
+        self.duration = duration
+        self.requests = requests
+        self.timeout = timeout
+        self.io_loop = io_loop or IOLoop.current()
+        self.results = []
+        self._issued = 0
+        self._deadline = None
+
+    def client(self):
+        kwargs = dict(io_loop=self.io_loop, force_instance=True,
+                      max_clients=self.concurrency)
+        if CurlAsyncHTTPClient is not None:
+            return CurlAsyncHTTPClient(**kwargs)
+        return AsyncHTTPClient(**kwargs)
+
+    @tornado.gen.coroutine
+    def run(self):
+        """
+        Run the benchmark, and return its :func:`summarize`\\ d results.
+        """
+        client = self.client()
+        started = time.time()
+        self._deadline = self.io_loop.time() + self.duration
+        try:
+            yield [self._worker(client) for _ in range(self.concurrency)]
+        finally:
+            client.close()
+        raise tornado.gen.Return(
+            summarize(self.results, time.time() - started)
+        )
+
+    @tornado.gen.coroutine
+    def _worker(self, client):
+        while self.io_loop.time() < self._deadline:
+            if self.requests is not None and self._issued >= self.requests:
+                break
+            self._issued += 1
+            path = random.choice(self.paths)
+            start = time.time()
+            response = yield tornado.gen.Task(
+                client.fetch, self.base_url + path,
+                request_timeout=self.timeout
+            )
+            self.results.append(
+                (path, response.code, 1000.0 * (time.time() - start))
+            )
+
+
+def start_server(app, port, processes=1):
+    """
+    Fork a process running ``app`` on ``127.0.0.1:port``, with
+    ``processes`` worker processes.
+
+    :return: the pid of the process.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        sys.argv = sys.argv[:1]
+        IOLoop.clear_current()
+        if IOLoop.initialized():
+            IOLoop.clear_instance()
+        app.config.update(address='127.0.0.1', port=port,
+                          processes=processes)
+        app.run()
+    except SystemExit as e:
+        status = e.code or 0
+    except BaseException:
+        traceback.print_exc()
+        status = 1
+    finally:
+        os._exit(status)
+
+
+def wait_for_server(port, pid, timeout=30):
+    """
+    Wait until the server of ``pid`` accepts connections.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if os.waitpid(pid, os.WNOHANG)[0]:
+            raise RuntimeError("The server exited before listening")
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+    raise RuntimeError("The server didn't listen in %d seconds" % timeout)
+
+
+def stop_server(pid):
+    """
+    Ask the server to drain, and wait for it to exit.
+    """
+    try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    except OSError as e:
+        if e.errno not in (errno.ESRCH, errno.ECHILD):
+            raise
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _print_summary(summary):
+    latency = summary['latency']
+    print("%d requests in %.2fs, %.2f requests/s, %d errors" % (
+        summary['requests'], summary['elapsed'], summary['throughput'],
+        summary['errors']
+    ))
+    print("Latency (ms): mean %(mean).2f, p50 %(p50).2f, p90 %(p90).2f, "
+          "p99 %(p99).2f, max %(max).2f" % latency)
+    print("Statuses: %s" % ", ".join(
+        "%s: %d" % item for item in sorted(summary['statuses'].items())
+    ))
+    for url, stats in sorted(summary['urls'].items()):
+        print("  %s: %d requests, %d errors, p50 %.2fms, p99 %.2fms" % (
+            url, stats['requests'], stats['errors'],
+            stats['latency']['p50'], stats['latency']['p99']
+        ))
+
+
+def bench(args):
+    """
+    The ``waterspout bench`` command.
+
+    :return: the benchmark report, as a dictionary.
+    """
+    parser = optparse.OptionParser(
+        usage="waterspout bench <module:waterspout> [options]"
+    )
+    parser.add_option('-p', '--processes', type='int', default=1,
+                      help="worker processes of the server, 0 for one "
+                           "per CPU [default: %default]")
+    parser.add_option('-c', '--concurrency', type='int', default=10,
+                      help="concurrent connections [default: %default]")
+    parser.add_option('-d', '--duration', type='float', default=10,
+                      help="seconds to run for [default: %default]")
+    parser.add_option('-n', '--requests', type='int', default=None,
+                      help="stop after that many requests")
+    parser.add_option('-u', '--url', action='append', dest='urls',
+                      help="path to request, repeat it to weigh it "
+                           "[default: /]")
+    parser.add_option('--port', type='int', default=0,
+                      help="port of the server [default: a free port]")
+    parser.add_option('--timeout', type='float', default=20,
+                      help="seconds before a request fails "
+                           "[default: %default]")
+    parser.add_option('-o', '--output',
+                      help="save the results to this JSON file")
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error("an import string like myproject.app:waterspout "
+                     "is required")
+    app = import_string(args[0])
+    if not isinstance(app, Waterspout):
+        parser.error("%s is not a Waterspout application" % args[0])
+    urls = options.urls or ['/']
+    port = options.port or _free_port()
+
+    pid = start_server(app, port, options.processes)
+    try:
+        wait_for_server(port, pid)
+        io_loop = IOLoop()
+        runner = Bench(
+            'http://127.0.0.1:%d' % port, urls, options.concurrency,
+            options.duration, options.requests, options.timeout, io_loop
+        )
+        summary = io_loop.run_sync(runner.run)
+        io_loop.close()
+    finally:
+        stop_server(pid)
+
+    report = dict(
+        app=args[0],
+        time=round(time.time(), 3),
+        waterspout=waterspout.__version__,
+        tornado=tornado.version,
+        python=platform.python_version(),
+        client='curl' if CurlAsyncHTTPClient is not None else 'simple',
+        processes=options.processes,
+        concurrency=options.concurrency,
+        duration=options.duration,
+        urls=urls,
+        results=summary
+    )
+    _print_summary(summary)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+COMMANDS = {
+    'bench': bench,
+}
+
+
+def main(argv=None):
+    """
+    Entry point of the ``waterspout`` command.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or argv[0] not in COMMANDS:
+        print(USAGE)
+        sys.exit(2)
+    COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import time
+import functools
+import threading
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    assert ThreadPoolExecutor
+except ImportError:  # Py2 without the ``futures`` backport
+    ThreadPoolExecutor = None
+
+
+class ExecutorPool(object):
+    """
+    A named thread pool which keeps track of its own saturation.
+
+    Use it like ::
+
+        pool = ExecutorPool('db', max_workers=8)
+        future = pool.submit(blocking_query, 'SELECT 1')
+
+    The returned future can be yielded inside a ``tornado.gen.coroutine``.
+
+    :param name: name of the pool.
+    :param max_workers: how many threads the pool may start.
+    """
+
+    def __init__(self, name, max_workers=4):
+        if ThreadPoolExecutor is None:
+            raise RuntimeError("Thread pools require concurrent.futures."
+                               "Run: pip install futures")
+        self.name = name
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run ``fn(*args, **kwargs)`` in the pool and return a future.
+        """
+        queued_at = time.time()
+        with self._lock:
+            self.submitted += 1
+
+        def run():
+            wait = time.time() - queued_at
+            with self._lock:
+                self.running += 1
+                self.total_wait += wait
+                if wait > self.max_wait:
+                    self.max_wait = wait
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+
+        return self._executor.submit(run)
+
+    @property
+    def queue_depth(self):
+        """
+        Number of calls waiting for a free thread.
+        """
+        return self.submitted - self.completed - self.running
+
+    def stats(self):
+        """
+        Return a dictionary describing the saturation of this pool.
+        """
+        with self._lock:
+            started = self.completed + self.running
+            return dict(
+                max_workers=self.max_workers,
+                submitted=self.submitted,
+                running=self.running,
+                completed=self.completed,
+                queue_depth=self.submitted - started,
+                avg_wait=self.total_wait / started if started else 0.0,
+                max_wait=self.max_wait
+            )
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __repr__(self):
+        return '<ExecutorPool %s>' % self.name
+
+
+class Executors(object):
+    """
+    Named thread pools owned by a Waterspout.
+
+    Pools are configured with the ``executors`` setting, a dictionary
+    mapping pool names to their sizes ::
+
+        waterspout = Waterspout(__name__, executors={'db': 8})
+
+    A ``default`` pool of 4 threads is always available.
+    Threads are only started on the first call, so it is safe to create
+    the pools before forking.
+
+    :param sizes: a dictionary mapping pool names to their sizes.
+    """
+
+    def __init__(self, sizes=None):
+        self.sizes = {'default': 4}
+        if sizes:
+            self.sizes.update(sizes)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        pool = self._pools.get(name)
+        if pool is None:
+            if name not in self.sizes:
+                raise KeyError("Executor %s is not configured." % name)
+            with self._lock:
+                pool = self._pools.get(name)
+                if pool is None:
+                    pool = ExecutorPool(name, self.sizes[name])
+                    self._pools[name] = pool
+        return pool
+
+    def __contains__(self, name):
+        return name in self.sizes
+
+    def add(self, name, max_workers):
+        """
+        Add a named pool.
+
+        :param name: name of the pool.
+        :param max_workers: how many threads the pool may start.
+        """
+        self.sizes[name] = max_workers
+
+    def stats(self):
+        """
+        Return the stats of every started pool, keyed by pool name.
+        """
+        return dict((name, pool.stats())
+                    for name, pool in self._pools.items())
+
+    def shutdown(self, wait=True):
+        """
+        Shutdown every started pool.
+        """
+        for pool in list(self._pools.values()):
+            pool.shutdown(wait=wait)
+        self._pools = {}
+
+
+def run_on_executor(name='default'):
+    """
+    Decorator to run a handler method on a named thread pool.
+
+    The decorated method returns a future which can be yielded ::
+
+        class ReportHandler(RequestHandler):
+            @run_on_executor('db')
+            def load_report(self, report_id):
+                return Report.get(report_id)
+
+            @tornado.gen.coroutine
+            def get(self, report_id):
+                report = yield self.load_report(report_id)
+                self.render('report.html', report=report)
+
+    :param name: name of the pool. ``default`` if not provided.
+    """
+    if callable(name):
+        return run_on_executor()(name)
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            pool = self.application.executors[name]
+            return pool.submit(method, self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,161 @@
+import time
+
+from .utils import LRUCache, SESSION_COOKIE
+
+
+class TokenBucket(object):
+    """
+    A token bucket refilled with ``rate`` tokens per second, holding at
+    most ``burst`` tokens.
+    """
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter(object):
+    """
+    Per-client rate limiter.  Every client has its own token bucket,
+    kept in a bounded LRU so memory use doesn't grow with the number of
+    clients ::
+
+        limiter = RateLimiter(10, burst=20)
+        allowed, retry_after = limiter.allow(request.remote_ip)
+
+    :param rate: tokens added to a bucket per second.
+    :param burst: size of a bucket.  Same as ``rate`` if not provided.
+    :param max_clients: how many buckets are kept.
+    """
+
+    def __init__(self, rate, burst=None, max_clients=10000):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.buckets = LRUCache(max_clients)
+
+    def allow(self, key, now=None):
+        """
+        Take one token from the bucket of ``key``.
+
+        :return:
+          a ``(allowed, retry_after)`` tuple. ``retry_after`` is the number
+          of seconds to wait before a token is available.
+        """
+        if now is None:
+            now = time.time()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+            self.buckets[key] = bucket
+        else:
+            bucket.tokens = min(
+                self.burst, bucket.tokens + (now - bucket.updated) * self.rate
+            )
+            bucket.updated = now
+        if bucket.tokens >= 1:
+            bucket.tokens -= 1
+            return True, 0
+        return False, (1 - bucket.tokens) / self.rate
+
+
+def _route(handler):
+    cls = handler.__class__
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+class AdmissionControl(object):
+    """
+    Decides whether a request is served, before any work is done for it.
+
+    It is configured with these settings:
+
+    ``rate_limit``
+      requests per second allowed for every client.
+    ``rate_limit_burst``
+      how many requests a client may send at once.
+    ``rate_limit_by``
+      ``ip`` (the default) or ``session``.
+    ``rate_limit_clients``
+      how many clients are tracked. 10000 by default.
+    ``max_inflight_requests``
+      shed requests while this many requests are in flight.
+    ``shed_ioloop_lag``
+      shed requests while the IOLoop lags more than this many seconds.
+
+    Handlers can set ``max_concurrency`` to cap their own in-flight
+    requests.
+
+    :param config: a Waterspout config.
+    :param monitor:
+      (optional) a :class:`~waterspout.monitor.LoopMonitor` used to read
+      the IOLoop lag.
+    """
+
+    def __init__(self, config, monitor=None):
+        rate = config.get('rate_limit', None)
+        if rate:
+            self.limiter = RateLimiter(
+                rate, config.get('rate_limit_burst', None),
+                config.get('rate_limit_clients', 10000)
+            )
+        else:
+            self.limiter = None
+        self.limit_by = config.get('rate_limit_by', 'ip')
+        self.max_inflight = config.get('max_inflight_requests', None)
+        self.max_lag = config.get('shed_ioloop_lag', None)
+        self.monitor = monitor
+        self.inflight = 0
+        self.routes = {}
+        self.shed = 0
+        self.limited = 0
+
+    def client_key(self, handler):
+        if self.limit_by == 'session':
+            session = handler.get_cookie(SESSION_COOKIE)
+            if session:
+                return session
+        return handler.request.remote_ip
+
+    def admit(self, handler):
+        """
+        Admit a request.
+
+        :return:
+          ``None`` if the request is admitted, or a ``(status, headers)``
+          tuple for the response to send instead.
+        """
+        if self.max_inflight and self.inflight >= self.max_inflight:
+            self.shed += 1
+            return 503, {}
+        if (self.max_lag and self.monitor is not None and
+                self.monitor.lag > self.max_lag):
+            self.shed += 1
+            return 503, {}
+
+        route = _route(handler)
+        running = self.routes.get(route, 0)
+        max_concurrency = getattr(handler, 'max_concurrency', None)
+        if max_concurrency and running >= max_concurrency:
+            self.shed += 1
+            return 503, {}
+
+        if self.limiter is not None:
+            allowed, retry_after = self.limiter.allow(
+                self.client_key(handler)
+            )
+            if not allowed:
+                self.limited += 1
+                return 429, {"Retry-After": str(int(retry_after) + 1)}
+
+        self.inflight += 1
+        self.routes[route] = running + 1
+        return None
+
+    def release(self, handler):
+        """
+        Release a request admitted by :meth:`admit`.
+        """
+        route = _route(handler)
+        self.inflight -= 1
+        self.routes[route] -= 1
@@ -0,0 +1,222 @@
+"""
+Attribution of memory growth to routes, with :mod:`tracemalloc`.
+
+A few sampled requests are surrounded by two ``tracemalloc`` snapshots.
+The allocations made during the request and still alive when it is
+finished are charged to its handler, and a report of the handlers whose
+requests retained the most memory is written periodically.
+
+Only one request is sampled at a time, but allocations of concurrent
+requests are charged to it too: the report is meaningful over many
+samples.  Taking a snapshot blocks the IOLoop for a time proportional to
+the number of allocations, so keep the sample rate low in production.
+
+``tracemalloc`` requires Python 3.4 or later.
+"""
+
+import os
+import json
+import time
+import random
+import logging
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+
+class MemoryProfiler(object):
+    """
+    Charges the memory retained by sampled requests to their handlers.
+
+    It is configured with these settings:
+
+    ``memory_profile_sample_rate``
+      the share of requests sampled, like ``0.001``.  Setting it enables
+      the profiler.
+    ``memory_profile_interval``
+      seconds between two reports, 300 by default.
+    ``memory_profile_top``
+      how many handlers, and lines of each handler, are reported.
+    ``memory_profile_frames``
+      how many frames of each allocation are stored by ``tracemalloc``.
+    ``memory_profile_file``
+      (optional) a path reports are appended to as JSON lines, instead of
+      being logged.
+
+    :param sample_rate: the share of requests sampled.
+    :param interval: seconds between two reports.
+    :param top: how many handlers, and lines per handler, are reported.
+    :param frames: how many frames ``tracemalloc`` stores per allocation.
+    :param path: (optional) the path of the report file.
+    """
+
+    def __init__(self, sample_rate=0.001, interval=300, top=10, frames=1,
+                 path=None):
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.top = top
+        self.frames = frames
+        self.path = path
+        self.routes = {}
+        self.sampled = 0
+        self.reports = 0
+        self._names = None
+        self._sampling = False
+        self._started_tracing = False
+        self._periodic = None
+
+    @property
+    def enabled(self):
+        return tracemalloc is not None and tracemalloc.is_tracing()
+
+    def begin(self, handler):
+        """
+        Return the snapshot starting the sample of a request, or ``None``
+        when the request isn't sampled.
+        """
+        if (self._sampling or not self.enabled or
+                random.random() >= self.sample_rate):
+            return None
+        self._sampling = True
+        return self._snapshot()
+
+    def end(self, handler, snapshot):
+        """
+        Charge the memory allocated since ``snapshot`` and still alive to
+        the handler of the request.
+        """
+        self._sampling = False
+        if not self.enabled:
+            return
+        differences = self._snapshot().compare_to(snapshot, 'traceback')
+        handler_class = handler.__class__
+        key = '%s.%s' % (handler_class.__module__, handler_class.__name__)
+        route = self.routes.get(key)
+        if route is None:
+            route = self.routes[key] = dict(
+                handler=key, route=self._route_name(handler),
+                samples=0, growth=0, lines={}
+            )
+        route['samples'] += 1
+        lines = route['lines']
+        for difference in differences:
+            if difference.size_diff <= 0:
+                continue
+            route['growth'] += difference.size_diff
+            frame = difference.traceback[0]
+            location = '%s:%s' % (frame.filename, frame.lineno)
+            lines[location] = lines.get(location, 0) + difference.size_diff
+        if len(lines) > self.top * 20:
+            route['lines'] = dict(self._largest(lines, self.top * 10))
+        self.sampled += 1
+
+    def discard(self):
+        """
+        Abandon the sample of a request which won't be finished.
+        """
+        self._sampling = False
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ))
+
+    def _route_name(self, handler):
+        if self._names is None:
+            self._names = dict(
+                (spec.handler_class, name)
+                for name, spec in handler.application.named_handlers.items()
+            )
+        return self._names.get(handler.__class__)
+
+    @staticmethod
+    def _largest(sizes, count):
+        return sorted(sizes.items(), key=lambda item: -item[1])[:count]
+
+    def report(self):
+        """
+        Return the handlers whose requests retained the most memory since
+        the profiler started, with the lines which allocated it.
+        """
+        routes = sorted(self.routes.values(), key=lambda r: -r['growth'])
+        return [dict(
+            handler=route['handler'], route=route['route'],
+            samples=route['samples'], growth=route['growth'],
+            growth_per_request=route['growth'] // route['samples'],
+            lines=self._largest(route['lines'], self.top)
+        ) for route in routes[:self.top]]
+
+    def write_report(self):
+        """
+        Write the report to the report file, or to the log.
+        """
+        report = self.report()
+        if not report:
+            return
+        self.reports += 1
+        if self.path:
+            record = dict(time=round(time.time(), 3), pid=os.getpid(),
+                          traced=tracemalloc.get_traced_memory()[0],
+                          routes=report)
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            except (IOError, OSError):
+                logging.exception("Failed to write the memory report")
+            return
+        lines = ["Memory retained by sampled requests:"]
+        for route in report:
+            lines.append("%s: %d bytes in %d samples (%d per request)" % (
+                route['handler'], route['growth'], route['samples'],
+                route['growth_per_request']
+            ))
+            for location, size in route['lines']:
+                lines.append("    %s: %d bytes" % (location, size))
+        logging.info("\n".join(lines))
+
+    def start(self, io_loop=None):
+        """
+        Start tracing allocations, and writing reports periodically.
+        """
+        if tracemalloc is None:
+            logging.warning("Memory profiling requires Python 3.4 or later.")
+            return self
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._started_tracing = True
+        self._periodic = PeriodicCallback(
+            self.write_report, self.interval * 1000,
+            io_loop=io_loop or IOLoop.current()
+        )
+        self._periodic.start()
+        return self
+
+    def stop(self):
+        """
+        Write a last report, and stop tracing allocations.
+        """
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+            self.write_report()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def stats(self):
+        """
+        Return a dictionary describing the profiler.
+        """
+        stats = dict(sampled=self.sampled, routes=len(self.routes),
+                     reports=self.reports)
+        if self.enabled:
+            stats['traced'], stats['traced_peak'] = \
+                tracemalloc.get_traced_memory()
+        return stats
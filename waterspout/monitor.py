@@ -0,0 +1,157 @@
+import sys
+import logging
+import threading
+import traceback
+
+from collections import deque
+
+import tornado.web
+
+from tornado.ioloop import IOLoop
+
+
+class LoopMonitor(object):
+    """
+    Measures the scheduling lag of an IOLoop and detects blocking calls.
+
+    A timeout is scheduled every ``interval`` seconds; the lag is how late
+    the IOLoop ran it.  A busy or blocked IOLoop has a high lag.
+
+    If ``threshold`` is set, the IOLoop refreshes a heartbeat every
+    ``threshold / 2`` seconds, and a watchdog thread checks its age.  When
+    a callback keeps the IOLoop from refreshing it for more than
+    ``threshold`` seconds, the stack of the blocking code is logged along
+    with the route and the request ID of the handler running it.
+
+    :param interval: seconds between two measurements.
+    :param threshold: (optional) seconds before a blocked IOLoop is logged.
+    :param samples: how many measurements are kept for percentiles.
+    """
+
+    def __init__(self, interval=0.5, threshold=None, samples=1024):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0
+        self.samples = deque(maxlen=samples)
+        self.blocked = 0
+        self.io_loop = None
+        self._expected = None
+        self._timeout = None
+        self._heartbeat = None
+        self._heartbeat_timeout = None
+        self._thread_id = None
+        self._reported = None
+        self._stopped = threading.Event()
+        self._watchdog = None
+
+    def start(self, io_loop=None):
+        """
+        Start measuring the lag of ``io_loop``, the current IOLoop by
+        default.  Must be called in the thread running the IOLoop.
+        """
+        self.io_loop = io_loop or IOLoop.current()
+        self._schedule()
+        if self.threshold:
+            self._beat()
+            self._thread_id = threading.current_thread().ident
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch)
+            self._watchdog.daemon = True
+            self._watchdog.start()
+        return self
+
+    def stop(self):
+        if self._timeout is not None:
+            self.io_loop.remove_timeout(self._timeout)
+            self._timeout = None
+        if self._heartbeat_timeout is not None:
+            self.io_loop.remove_timeout(self._heartbeat_timeout)
+            self._heartbeat_timeout = None
+        if self._watchdog is not None:
+            self._stopped.set()
+            self._watchdog.join()
+            self._watchdog = None
+
+    def percentile(self, percent):
+        """
+        Return the given percentile of the measured lags, in seconds.
+
+        :param percent: a number between 0 and 100.
+        """
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        index = int(round(percent / 100.0 * (len(samples) - 1)))
+        return samples[index]
+
+    def stats(self):
+        """
+        Return a dictionary describing the lag of the IOLoop.
+        """
+        return dict(
+            lag=self.lag,
+            p50=self.percentile(50),
+            p90=self.percentile(90),
+            p99=self.percentile(99),
+            max=max(self.samples) if self.samples else 0.0,
+            blocked=self.blocked
+        )
+
+    def _schedule(self):
+        self._expected = self.io_loop.time() + self.interval
+        self._timeout = self.io_loop.add_timeout(self._expected, self._tick)
+
+    def _tick(self):
+        self.lag = max(0.0, self.io_loop.time() - self._expected)
+        self.samples.append(self.lag)
+        self._schedule()
+
+    def _beat(self):
+        self._heartbeat = self.io_loop.time()
+        self._heartbeat_timeout = self.io_loop.add_timeout(
+            self._heartbeat + self.threshold / 2.0, self._beat
+        )
+
+    def _watch(self):
+        check_interval = self.threshold / 4.0
+        while not self._stopped.wait(check_interval):
+            heartbeat = self._heartbeat
+            blocked = self.io_loop.time() - heartbeat
+            if blocked > self.threshold and heartbeat != self._reported:
+                self._reported = heartbeat
+                self.blocked += 1
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is not None:
+                    self.report(frame, blocked)
+
+    def report(self, frame, late):
+        """
+        Log the stack of a blocked IOLoop.
+
+        :param frame: the frame running in the IOLoop thread.
+        :param late: how long the IOLoop is blocked, in seconds.
+        """
+        stack = ''.join(traceback.format_stack(frame))
+        handler = find_handler(frame)
+        if handler is None:
+            logging.warning("IOLoop blocked for %.3fs\n%s" % (late, stack))
+        else:
+            logging.warning(
+                "IOLoop blocked for %.3fs by %s %s (route %s, request %s)\n%s"
+                % (late, handler.request.method, handler.request.path,
+                   handler.__class__.__name__,
+                   getattr(handler, 'request_id', None), stack)
+            )
+
+
+def find_handler(frame):
+    """
+    Return the RequestHandler running in the given frame or in one of
+    its callers, or ``None``.
+    """
+    while frame is not None:
+        obj = frame.f_locals.get('self')
+        if isinstance(obj, tornado.web.RequestHandler):
+            return obj
+        frame = frame.f_back
+    return None
@@ -0,0 +1,200 @@
+"""
+Incremental ``multipart/form-data`` parser.
+
+Unlike ``tornado.httputil.parse_multipart_form_data``, the body is parsed
+while it is received, and file parts are spooled to temporary files
+instead of being kept in memory.
+"""
+
+import io
+import tempfile
+
+from tornado.httputil import HTTPHeaders, _parse_header
+
+PREAMBLE, AFTER_DELIMITER, HEADERS, BODY, DONE = range(5)
+
+MAX_HEADERS_SIZE = 16 * 1024
+
+
+class UploadedFile(object):
+    """
+    A file uploaded in a multipart body.  Works like a file object ::
+
+        upload = handler.files['avatar'][0]
+        upload.filename  # 'me.png'
+        upload.read()
+
+    :param name: name of the form field.
+    :param filename: name of the file on the client.
+    :param content_type: Content-Type of the file.
+    :param headers: headers of the part.
+    :param file: file object holding the content.
+    :param size: size of the content in bytes.
+    """
+
+    def __init__(self, name, filename, content_type, headers, file, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers
+        self.file = file
+        self.size = size
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __repr__(self):
+        return '<UploadedFile %s (%d bytes)>' % (self.filename, self.size)
+
+
+class _Part(object):
+    def __init__(self, name, filename, headers, file):
+        self.name = name
+        self.filename = filename
+        self.headers = headers
+        self.file = file
+        self.size = 0
+
+    def write(self, data):
+        if self.file is not None and data:
+            self.file.write(data)
+            self.size += len(data)
+
+
+class MultipartParser(object):
+    """
+    Parse a ``multipart/form-data`` body fed chunk by chunk ::
+
+        parser = MultipartParser(boundary)
+        parser.feed(chunk)
+        ...
+        assert parser.complete
+        parser.arguments  # {'name': [b'value']}
+        parser.files  # {'avatar': [<UploadedFile me.png>]}
+
+    :param boundary: the boundary from the Content-Type header, as bytes.
+    :param spool_size:
+      file parts larger than this many bytes are moved to disk.
+    :param tmp_dir:
+      (optional) directory of the temporary files.
+    """
+
+    def __init__(self, boundary, spool_size=1024 * 1024, tmp_dir=None):
+        if boundary.startswith(b'"') and boundary.endswith(b'"'):
+            boundary = boundary[1:-1]
+        self.delimiter = b'--' + boundary
+        self.spool_size = spool_size
+        self.tmp_dir = tmp_dir
+        self.arguments = {}
+        self.files = {}
+        self.complete = False
+        self._buffer = b''
+        self._state = PREAMBLE
+        self._part = None
+
+    def feed(self, data):
+        """
+        Parse a chunk of the body.
+
+        :raise ValueError: if the body is malformed.
+        """
+        self._buffer += data
+        while self._parse():
+            pass
+
+    def close(self):
+        """
+        Close the temporary files of every parsed file.
+        """
+        if self._part is not None and self._part.file is not None:
+            self._part.file.close()
+        for files in self.files.values():
+            for f in files:
+                f.close()
+
+    def _parse(self):
+        buf = self._buffer
+        state = self._state
+        if state == PREAMBLE:
+            i = buf.find(self.delimiter)
+            if i == -1:
+                self._buffer = buf[-len(self.delimiter):]
+                return False
+            self._buffer = buf[i + len(self.delimiter):]
+            self._state = AFTER_DELIMITER
+            return True
+        if state == AFTER_DELIMITER:
+            if len(buf) < 2:
+                return False
+            if buf[:2] == b'--':
+                self._buffer = b''
+                self._state = DONE
+                self.complete = True
+                return False
+            if buf[:2] != b'\r\n':
+                raise ValueError("Invalid multipart boundary")
+            self._buffer = buf[2:]
+            self._state = HEADERS
+            return True
+        if state == HEADERS:
+            i = buf.find(b'\r\n\r\n')
+            if i == -1:
+                if len(buf) > MAX_HEADERS_SIZE:
+                    raise ValueError("Multipart headers too long")
+                return False
+            headers = HTTPHeaders.parse(buf[:i].decode('utf-8'))
+            self._start_part(headers)
+            self._buffer = buf[i + 4:]
+            self._state = BODY
+            return True
+        if state == BODY:
+            delimiter = b'\r\n' + self.delimiter
+            i = buf.find(delimiter)
+            if i == -1:
+                safe = len(buf) - len(delimiter) + 1
+                if safe > 0:
+                    self._part.write(buf[:safe])
+                    self._buffer = buf[safe:]
+                return False
+            self._part.write(buf[:i])
+            self._end_part()
+            self._buffer = buf[i + len(delimiter):]
+            self._state = AFTER_DELIMITER
+            return True
+        self._buffer = b''
+        return False
+
+    def _start_part(self, headers):
+        disposition, params = _parse_header(
+            headers.get("Content-Disposition", "")
+        )
+        name = params.get("name")
+        filename = params.get("filename")
+        if disposition != "form-data" or not name:
+            f = None
+        elif filename is not None:
+            f = tempfile.SpooledTemporaryFile(max_size=self.spool_size,
+                                              dir=self.tmp_dir)
+        else:
+            f = io.BytesIO()
+        self._part = _Part(name, filename, headers, f)
+
+    def _end_part(self):
+        part, self._part = self._part, None
+        if part.file is None:
+            return
+        part.file.seek(0)
+        if part.filename is None:
+            value = part.file.getvalue()
+            self.arguments.setdefault(part.name, []).append(value)
+            return
+        content_type = part.headers.get(
+            "Content-Type", "application/octet-stream"
+        )
+        self.files.setdefault(part.name, []).append(UploadedFile(
+            part.name, part.filename, content_type, part.headers,
+            part.file, part.size
+        ))
@@ -0,0 +1,440 @@
+"""
+Worker processes, graceful shutdown and zero-downtime reload.
+
+Listening sockets are handed over to re-executed processes through the
+``WATERSPOUT_FDS`` environment variable, so they are never closed.  The
+re-executed process writes to the pipe given in ``WATERSPOUT_READY_FD``
+once it serves requests, and only then are the old workers drained.
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import signal
+import random
+import socket
+import logging
+import binascii
+
+from collections import deque
+
+import tornado.netutil
+import tornado.process
+import tornado.httpserver
+
+ENVIRON_KEY = 'WATERSPOUT_FDS'
+READY_KEY = 'WATERSPOUT_READY_FD'
+
+_task_id = None
+_ready_fd = None
+
+
+def task_id():
+    """
+    Return the index of the current worker process, or ``None`` if
+    Waterspout runs a single process.
+    """
+    return _task_id
+
+
+def _reseed_random():
+    # Forked workers would share the random state of the master, and make
+    # the same sampling decisions and trace IDs.
+    try:
+        seed = int(binascii.hexlify(os.urandom(16)), 16)
+    except NotImplementedError:
+        seed = int(time.time() * 1000) ^ os.getpid()
+    random.seed(seed)
+
+
+def bind_sockets(port, address=None):
+    """
+    Like ``tornado.netutil.bind_sockets``, but reuses the sockets inherited
+    from a reloaded process if there are any.
+    """
+    fds = os.environ.pop(ENVIRON_KEY, None)
+    if not fds:
+        return tornado.netutil.bind_sockets(port, address)
+    sockets = []
+    for pair in fds.split(','):
+        fd, family = [int(x) for x in pair.split(':')]
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        os.close(fd)
+        sock.setblocking(0)
+        _set_inheritable(sock.fileno(), False)
+        sockets.append(sock)
+    return sockets
+
+
+def _set_inheritable(fd, inheritable):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if inheritable:
+        flags &= ~fcntl.FD_CLOEXEC
+    else:
+        flags |= fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+
+def reexec(sockets):
+    """
+    Replace the current process with a fresh copy of the program, which
+    inherits the given listening sockets.
+    """
+    for sock in sockets:
+        _set_inheritable(sock.fileno(), True)
+    os.environ[ENVIRON_KEY] = ','.join(
+        '%d:%d' % (sock.fileno(), sock.family) for sock in sockets
+    )
+    logging.info("Reloading %s" % ' '.join(sys.argv))
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+
+def spawn(sockets):
+    """
+    Start a fresh copy of the program in a new process, which inherits the
+    given listening sockets.  The current process keeps running.
+
+    :return: the pid of the new process, and a file descriptor which
+      becomes readable when the new process serves requests, or closes if
+      it exits before.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(r)
+            _set_inheritable(w, True)
+            os.environ[READY_KEY] = str(w)
+            reexec(sockets)
+        finally:
+            os._exit(1)
+    os.close(w)
+    return pid, r
+
+
+def _pop_ready_fd():
+    fd = os.environ.pop(READY_KEY, None)
+    if not fd:
+        return None
+    fd = int(fd)
+    _set_inheritable(fd, False)
+    return fd
+
+
+def _notify(fd):
+    try:
+        os.write(fd, b'.')
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def notify_ready():
+    """
+    Tell the process waiting for this one that it serves requests: the
+    master process of a worker, or the process which reloaded this one.
+    """
+    global _ready_fd
+    fd, _ready_fd = _ready_fd, None
+    if fd is None:
+        fd = _pop_ready_fd()
+    if fd is not None:
+        _notify(fd)
+
+
+class RestartBudget(object):
+    """
+    Limits how often crashed workers are restarted.
+
+    A worker may be restarted ``max_restarts`` times within ``window``
+    seconds.  The restarts are delayed by 0, 1, 3, 7... seconds, up to
+    ``max_delay``.
+    """
+
+    def __init__(self, max_restarts=5, window=60, max_delay=30):
+        self.max_restarts = max_restarts
+        self.window = window
+        self.max_delay = max_delay
+        self.history = {}
+
+    def delay(self, worker, now=None):
+        """
+        Return in how many seconds ``worker`` may be restarted, or
+        ``None`` if it crashed too often.
+        """
+        if now is None:
+            now = time.time()
+        history = self.history.setdefault(worker, deque())
+        while history and history[0] <= now - self.window:
+            history.popleft()
+        if len(history) >= self.max_restarts:
+            return None
+        delay = min(2 ** len(history) - 1, self.max_delay)
+        history.append(now + delay)
+        return delay
+
+
+def fork_workers(num_processes, sockets, max_restarts=5, restart_window=60,
+                 reload_timeout=60):
+    """
+    Start ``num_processes`` worker processes, ``0`` meaning one per CPU.
+
+    Return the task id in each worker.  The master process never returns:
+    it restarts crashed workers within a :class:`RestartBudget`, forwards
+    ``SIGTERM`` to the workers and exits when all of them are gone.
+
+    On ``SIGHUP`` it starts a fresh copy of the program, which keeps the
+    listening sockets open, and asks its own workers to drain once the
+    workers of the new copy serve requests.  If they don't within
+    ``reload_timeout`` seconds, the new copy is stopped instead.
+    """
+    global _task_id
+    if num_processes is None or num_processes <= 0:
+        num_processes = tornado.process.cpu_count()
+    ready_r, ready_w = os.pipe()
+    budget = RestartBudget(max_restarts, restart_window)
+    children = {}
+    pending = {}
+    state = dict(stopping=False, failed=False, ready=0, reload=None,
+                 parent=_pop_ready_fd())
+
+    def start_child(i):
+        global _ready_fd
+        pid = os.fork()
+        if pid == 0:
+            _reseed_random()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            os.close(ready_r)
+            for fd in (state['parent'], state['reload'] and
+                       state['reload'][1]):
+                if fd is not None:
+                    os.close(fd)
+            _ready_fd = ready_w
+            return i
+        children[pid] = i
+        return None
+
+    def stop():
+        state['stopping'] = True
+        pending.clear()
+        for pid in children:
+            _kill(pid, signal.SIGTERM)
+
+    def on_term(sig, frame):
+        stop()
+
+    def on_hup(sig, frame):
+        if state['reload'] is None and not state['stopping']:
+            pid, fd = spawn(sockets)
+            state['reload'] = (pid, fd, time.time() + reload_timeout)
+
+    signal.signal(signal.SIGTERM, on_term)
+    signal.signal(signal.SIGHUP, on_hup)
+
+    for i in range(num_processes):
+        task = start_child(i)
+        if task is not None:
+            _task_id = task
+            return task
+
+    while children or pending:
+        reload = state['reload']
+        fds = [ready_r] + ([reload[1]] if reload else [])
+        try:
+            readable = select.select(fds, [], [], 0.5)[0]
+        except (select.error, OSError) as e:
+            if _errno(e) != errno.EINTR:
+                raise
+            readable = []
+
+        if ready_r in readable:
+            state['ready'] += len(os.read(ready_r, 1024))
+            if state['parent'] is not None and \
+                    state['ready'] >= num_processes:
+                _notify(state['parent'])
+                state['parent'] = None
+
+        if reload is not None:
+            pid, fd, deadline = reload
+            ready = None
+            if fd in readable:
+                ready = bool(os.read(fd, 1))
+            elif time.time() > deadline:
+                ready = False
+            if ready is not None:
+                os.close(fd)
+                state['reload'] = None
+                if ready:
+                    logging.info("New workers are ready, draining the "
+                                 "old ones")
+                    stop()
+                else:
+                    logging.error("Reloading failed, keeping the current "
+                                  "workers")
+                    _kill(pid, signal.SIGTERM)
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if _errno(e) == errno.EINTR:
+                    continue
+                if _errno(e) == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            if pid not in children:
+                continue
+            i = children.pop(pid)
+            if state['stopping']:
+                continue
+            if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+                delay = budget.delay(i)
+                if delay is None:
+                    logging.error("Worker %d (pid %d) crashed %d times in "
+                                  "%d seconds, not restarting it" %
+                                  (i, pid, max_restarts, restart_window))
+                    state['failed'] = True
+                    continue
+                logging.warning("Worker %d (pid %d) exited with status %d, "
+                                "restarting in %d seconds" %
+                                (i, pid, status, delay))
+                pending[i] = time.time() + delay
+
+        now = time.time()
+        for i, at in sorted(pending.items()):
+            if at <= now:
+                del pending[i]
+                task = start_child(i)
+                if task is not None:
+                    _task_id = task
+                    return task
+    sys.exit(1 if state['failed'] else 0)
+
+
+def _errno(e):
+    if hasattr(e, 'errno'):
+        return e.errno
+    return e.args[0] if e.args else None
+
+
+def _kill(pid, sig):
+    try:
+        os.kill(pid, sig)
+    except OSError as e:
+        if _errno(e) != errno.ESRCH:
+            raise
+
+
+class HTTPServer(tornado.httpserver.HTTPServer):
+    """
+    An HTTPServer counting its open connections in ``connections``.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(HTTPServer, self).__init__(*args, **kwargs)
+        self.connections = 0
+
+    def handle_stream(self, stream, address):
+        self.connections += 1
+        super(HTTPServer, self).handle_stream(stream, address)
+
+    def on_close(self, server_conn):
+        self.connections -= 1
+        super(HTTPServer, self).on_close(server_conn)
+
+
+class Drain(object):
+    """
+    Stops an HTTPServer from accepting connections, then stops the IOLoop
+    once in-flight requests are finished or ``timeout`` seconds passed.
+
+    :param http_server: the HTTPServer to stop.
+    :param admission:
+      the :class:`~waterspout.limits.AdmissionControl` counting in-flight
+      requests.
+    :param io_loop: the IOLoop to stop.
+    :param timeout: seconds to wait for in-flight requests.
+    :param reload_timeout: seconds to wait for a reloaded copy of the
+      program to serve requests.
+    """
+
+    def __init__(self, http_server, admission, io_loop, timeout=30,
+                 reload_timeout=60):
+        self.http_server = http_server
+        self.admission = admission
+        self.io_loop = io_loop
+        self.timeout = timeout
+        self.reload_timeout = reload_timeout
+        self.deadline = None
+        self._reloading = False
+
+    def __call__(self):
+        if self.deadline is not None:
+            return
+        logging.info("Draining %d in-flight requests" %
+                     self.admission.inflight)
+        self.http_server.stop()
+        self.deadline = self.io_loop.time() + self.timeout
+        self._check()
+
+    def _check(self):
+        if self.admission.inflight <= 0:
+            self.io_loop.stop()
+        elif self.io_loop.time() >= self.deadline:
+            logging.warning("Shutting down with %d in-flight requests" %
+                            self.admission.inflight)
+            self.io_loop.stop()
+        else:
+            self.io_loop.add_timeout(self.io_loop.time() + 0.05, self._check)
+
+    def reload(self, sockets):
+        """
+        Start a fresh copy of the program which inherits ``sockets``, and
+        drain once it serves requests.  If it exits or doesn't serve within
+        ``reload_timeout`` seconds, keep serving.
+        """
+        if self._reloading or self.deadline is not None:
+            return
+        self._reloading = True
+        pid, fd = spawn(sockets)
+
+        def done(ready):
+            self.io_loop.remove_handler(fd)
+            self.io_loop.remove_timeout(timeout)
+            os.close(fd)
+            self._reloading = False
+            if ready:
+                self()
+            else:
+                logging.error("Reloading failed, keeping this process")
+                _kill(pid, signal.SIGTERM)
+
+        timeout = self.io_loop.add_timeout(
+            self.io_loop.time() + self.reload_timeout, lambda: done(False)
+        )
+        self.io_loop.add_handler(
+            fd, lambda fd, events: done(bool(os.read(fd, 1))),
+            self.io_loop.READ
+        )
+
+    def install(self, sockets=None):
+        """
+        Drain on ``SIGTERM``.  If ``sockets`` are given, also :meth:`reload`
+        on ``SIGHUP``.
+        """
+        def on_term(sig, frame):
+            self.io_loop.add_callback_from_signal(self)
+
+        def on_hup(sig, frame):
+            self.io_loop.add_callback_from_signal(self.reload, sockets)
+
+        signal.signal(signal.SIGTERM, on_term)
+        if sockets is not None:
+            signal.signal(signal.SIGHUP, on_hup)
@@ -0,0 +1,92 @@
+import logging
+
+import tornado.gen
+
+from tornado.concurrent import is_future
+
+
+class Resources(object):
+    """
+    Application-scoped resources, like database pools, cache clients or
+    configured ``AsyncHTTPClient`` instances.
+
+    Resources are created by :meth:`setup` once per worker process, after
+    forking, and destroyed by :meth:`teardown` when the worker stops.
+    Access them like attributes ::
+
+        resources.db.execute('SELECT 1')
+
+    :param definitions:
+      (optional) a list of ``(name, setup, teardown)`` tuples.
+    """
+
+    def __init__(self, definitions=None):
+        self._definitions = list(definitions or [])
+        self._values = {}
+
+    def add(self, name, setup, teardown=None):
+        """
+        Add a resource.
+
+        :param name: name of the resource.
+        :param setup:
+          function called without arguments to create the resource.
+          It may return a future.
+        :param teardown:
+          (optional) function called with the resource to destroy it.
+          It may return a future.
+        """
+        self._definitions.append((name, setup, teardown))
+
+    @tornado.gen.coroutine
+    def setup(self):
+        """
+        Create every resource which is not created yet, in the order they
+        were added.
+        """
+        for name, setup, _ in self._definitions:
+            if name in self._values:
+                continue
+            value = setup()
+            if is_future(value):
+                value = yield value
+            self._values[name] = value
+
+    @tornado.gen.coroutine
+    def teardown(self):
+        """
+        Destroy every created resource, in the reverse order they were
+        added.  Errors are logged and don't stop other resources from being
+        destroyed.
+        """
+        for name, _, teardown in reversed(self._definitions):
+            if name not in self._values:
+                continue
+            value = self._values.pop(name)
+            if teardown is None:
+                continue
+            try:
+                result = teardown(value)
+                if is_future(result):
+                    yield result
+            except Exception:
+                logging.exception("Failed to teardown resource %s" % name)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self._values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __repr__(self):
+        return '<Resources %s>' % ', '.join(
+            name for name, _, _ in self._definitions
+        )
@@ -0,0 +1,160 @@
+import sys
+import time
+import random
+import logging
+
+from collections import deque
+
+from tornado.concurrent import is_future
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from .utils import LRUCache
+
+EVENT_TYPES = {
+    'captureException': 'raven.events.Exception',
+    'captureMessage': 'raven.events.Message',
+    'captureQuery': 'raven.events.Query',
+}
+
+
+def fingerprint(call_name, kwargs):
+    """
+    Return a string identifying similar events: the exception type and
+    the line raising it, or the message.
+    """
+    if call_name == 'captureException':
+        exc_info = kwargs.get('exc_info') or sys.exc_info()
+        exc_type, _, tb = exc_info
+        if exc_type is None:
+            return call_name
+        if tb is not None:
+            while tb.tb_next is not None:
+                tb = tb.tb_next
+            code = tb.tb_frame.f_code
+            return '%s.%s:%s:%s' % (exc_type.__module__, exc_type.__name__,
+                                    code.co_filename, tb.tb_lineno)
+        return '%s.%s' % (exc_type.__module__, exc_type.__name__)
+    return '%s:%s' % (call_name, kwargs.get('message', kwargs.get('query')))
+
+
+class ErrorReporter(object):
+    """
+    An error pipeline between Waterspout and a raven client, so an
+    incident can't turn into an outbound request per error.
+
+    - The first event of a fingerprint is sent, then similar events are
+      deduplicated for ``window`` seconds.  Only ``sample_rate`` of them
+      are sent, carrying the number of suppressed events in
+      ``extra['waterspout_suppressed']``.  The ``max_fingerprints`` most
+      recently seen fingerprints are remembered.
+    - Events wait in a queue of at most ``queue_size`` events; events are
+      dropped when it is full.
+    - Every ``flush_interval`` seconds, up to ``max_sends`` events are
+      sent, unless the previous ones are still being sent.  Sentry takes
+      one event per request, so this bounds the outbound requests rather
+      than batching them.
+
+    It is configured with the ``sentry_dedup_window``,
+    ``sentry_sample_rate``, ``sentry_queue_size``, ``sentry_max_sends``,
+    ``sentry_flush_interval`` and ``sentry_max_fingerprints`` settings.
+
+    :param client: a raven client.
+    """
+
+    def __init__(self, client, window=60, sample_rate=0.0, queue_size=1000,
+                 max_sends=20, flush_interval=1.0, max_fingerprints=10000):
+        self.client = client
+        self.window = window
+        self.sample_rate = sample_rate
+        self.max_sends = max_sends
+        self.flush_interval = flush_interval
+        self.queue = deque()
+        self.queue_size = queue_size
+        self.fingerprints = LRUCache(max_fingerprints)
+        self.pending = 0
+        self.sent = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self._periodic = None
+
+    def capture(self, call_name, **kwargs):
+        """
+        Queue an event, like ``client.<call_name>(**kwargs)`` would send it.
+
+        :return: ``True`` if the event is queued.
+        """
+        key = fingerprint(call_name, kwargs)
+        now = time.time()
+        seen = self.fingerprints.get(key)
+        if seen is None or now - seen[0] > self.window:
+            suppressed = seen[1] if seen else 0
+            self.fingerprints[key] = [now, 0]
+        elif random.random() < self.sample_rate:
+            suppressed = seen[1]
+            seen[1] = 0
+        else:
+            seen[1] += 1
+            self.suppressed += 1
+            return False
+
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+        if suppressed:
+            extra = dict(kwargs.get('extra') or {})
+            extra['waterspout_suppressed'] = suppressed
+            kwargs['extra'] = extra
+        event_type = EVENT_TYPES.get(call_name, call_name)
+        self.queue.append(self.client.build_msg(event_type, **kwargs))
+        return True
+
+    def flush(self):
+        """
+        Send the next ``max_sends`` events.
+        """
+        if not self.pending:
+            self._send(self.max_sends)
+
+    def _send(self, count):
+        for _ in range(min(count, len(self.queue))):
+            data = self.queue.popleft()
+            try:
+                result = self.client.send(**data)
+            except Exception:
+                logging.exception("Failed to send event to Sentry")
+                continue
+            self.sent += 1
+            if is_future(result):
+                self.pending += 1
+                IOLoop.current().add_future(result, self._sent)
+
+    def _sent(self, future):
+        self.pending -= 1
+
+    def start(self, io_loop=None):
+        """
+        Start flushing events periodically.
+        """
+        self._periodic = PeriodicCallback(
+            self.flush, self.flush_interval * 1000,
+            io_loop=io_loop or IOLoop.current()
+        )
+        self._periodic.start()
+        return self
+
+    def stop(self):
+        """
+        Stop flushing events periodically, and send the remaining events.
+        """
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+        self._send(len(self.queue))
+
+    def stats(self):
+        """
+        Return a dictionary describing the pipeline.
+        """
+        return dict(queued=len(self.queue), sent=self.sent,
+                    suppressed=self.suppressed, dropped=self.dropped,
+                    fingerprints=len(self.fingerprints))
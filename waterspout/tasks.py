@@ -0,0 +1,222 @@
+import time
+import heapq
+import logging
+import itertools
+
+import tornado.gen
+
+from tornado.concurrent import Future, is_future
+from tornado.ioloop import IOLoop
+
+
+def task(priority=0, retries=None, executor=None):
+    """
+    Decorator to set how a function runs in a :class:`TaskQueue` ::
+
+        @task(priority=10, retries=3)
+        @tornado.gen.coroutine
+        def send_email(address, body):
+            yield mailer.send(address, body)
+
+    :param priority: tasks with a higher priority run first.
+    :param retries:
+      (optional) how many times a failed task is retried.  The default of
+      the queue if not provided.
+    :param executor:
+      (optional) name of the thread pool blocking tasks run on.
+    """
+    def decorator(fn):
+        fn.task_priority = priority
+        fn.task_retries = retries
+        fn.task_executor = executor
+        return fn
+    return decorator
+
+
+class Task(object):
+    __slots__ = ('fn', 'args', 'kwargs', 'priority', 'retries', 'attempts',
+                 'queued_at')
+
+    def __init__(self, fn, args, kwargs, priority, retries):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.retries = retries
+        self.attempts = 0
+        self.queued_at = time.time()
+
+    def __repr__(self):
+        return '<Task %s>' % getattr(self.fn, '__name__', self.fn)
+
+
+class TaskQueue(object):
+    """
+    A bounded priority queue of tasks run on the IOLoop, at most
+    ``concurrency`` at a time.
+
+    A task is a function, which may be a coroutine.  Functions decorated
+    with :func:`task` may run on a thread pool of ``executors`` instead.
+    Failed tasks are retried after ``retry_delay`` seconds, doubled on
+    every attempt.  Tasks put when ``max_size`` tasks are waiting are
+    dropped.
+
+    It is configured with the ``task_concurrency``, ``task_queue_size``,
+    ``task_retries`` and ``task_retry_delay`` settings.
+
+    :param concurrency: how many tasks may run at once.
+    :param max_size: how many tasks may wait.
+    :param retries: how many times a failed task is retried by default.
+    :param retry_delay: seconds to wait before the first retry.
+    :param executors: (optional) the :class:`~waterspout.executor.Executors`.
+    """
+
+    def __init__(self, concurrency=10, max_size=10000, retries=0,
+                 retry_delay=1.0, executors=None):
+        self.concurrency = concurrency
+        self.max_size = max_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.executors = executors
+        self.io_loop = None
+        self.running = 0
+        self.scheduled = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self._heap = []
+        self._counter = itertools.count()
+        self._scheduled_run = False
+        self._idle = []
+
+    def start(self, io_loop=None):
+        """
+        Start running tasks on the IOLoop.
+        """
+        self.io_loop = io_loop or IOLoop.current()
+        self._schedule()
+        return self
+
+    def put(self, fn, args=(), kwargs=None, priority=None, retries=None):
+        """
+        Queue ``fn(*args, **kwargs)``.
+
+        :param priority:
+          (optional) tasks with a higher priority run first.
+        :param retries:
+          (optional) how many times the task is retried if it fails.
+        :return: ``False`` if the queue is full and the task is dropped.
+        """
+        if len(self._heap) >= self.max_size:
+            self.dropped += 1
+            logging.warning("Task queue is full, dropping %r" % fn)
+            return False
+        if priority is None:
+            priority = getattr(fn, 'task_priority', 0)
+        if retries is None:
+            retries = getattr(fn, 'task_retries', None)
+            if retries is None:
+                retries = self.retries
+        self._push(Task(fn, args, kwargs or {}, priority, retries))
+        return True
+
+    def _push(self, task):
+        heapq.heappush(self._heap, (-task.priority, next(self._counter), task))
+        self._schedule()
+
+    def _schedule(self):
+        if self.io_loop is not None and not self._scheduled_run:
+            self._scheduled_run = True
+            self.io_loop.add_callback(self._run_next)
+
+    def _run_next(self):
+        self._scheduled_run = False
+        # Start at most ``concurrency`` tasks per IOLoop iteration, so
+        # synchronous tasks don't hold the IOLoop.
+        for _ in range(self.concurrency):
+            if not self._heap or self.running >= self.concurrency:
+                break
+            _, _, task = heapq.heappop(self._heap)
+            self.running += 1
+            self.total_wait += time.time() - task.queued_at
+            self._run(task)
+        if self._heap and self.running < self.concurrency:
+            self._schedule()
+        self._check_idle()
+
+    @tornado.gen.coroutine
+    def _run(self, task):
+        task.attempts += 1
+        try:
+            executor = getattr(task.fn, 'task_executor', None)
+            if executor is not None:
+                result = self.executors[executor].submit(
+                    task.fn, *task.args, **task.kwargs
+                )
+            else:
+                result = task.fn(*task.args, **task.kwargs)
+            if is_future(result):
+                yield result
+        except Exception:
+            if task.attempts <= task.retries:
+                self.retried += 1
+                self.scheduled += 1
+                delay = self.retry_delay * 2 ** (task.attempts - 1)
+                logging.warning("Task %r failed, retrying in %.1fs" %
+                                (task, delay), exc_info=True)
+                self.io_loop.add_timeout(self.io_loop.time() + delay,
+                                         lambda: self._retry(task))
+            else:
+                self.failed += 1
+                logging.exception("Task %r failed" % task)
+        else:
+            self.completed += 1
+        finally:
+            self.running -= 1
+            self._schedule()
+
+    def _retry(self, task):
+        self.scheduled -= 1
+        task.queued_at = time.time()
+        self._push(task)
+        self._check_idle()
+
+    def _check_idle(self):
+        if self._idle and not (self._heap or self.running or self.scheduled):
+            idle, self._idle = self._idle, []
+            for future in idle:
+                future.set_result(None)
+
+    def join(self, timeout=None):
+        """
+        Return a future resolved once every task, including the retries,
+        is finished, or after ``timeout`` seconds.
+        """
+        future = Future()
+        self._idle.append(future)
+        if self.io_loop is None:
+            self.start()
+        self._check_idle()
+        if timeout is not None and not future.done():
+            def expire():
+                if not future.done():
+                    logging.warning("Shutting down with %d queued tasks" %
+                                    (len(self._heap) + self.running +
+                                     self.scheduled))
+                    self._idle.remove(future)
+                    future.set_result(None)
+            self.io_loop.add_timeout(self.io_loop.time() + timeout, expire)
+        return future
+
+    def stats(self):
+        """
+        Return a dictionary describing the queue.
+        """
+        started = self.completed + self.failed + self.retried + self.running
+        return dict(queued=len(self._heap), running=self.running,
+                    scheduled=self.scheduled, completed=self.completed,
+                    failed=self.failed, retried=self.retried,
+                    dropped=self.dropped,
+                    avg_wait=self.total_wait / started if started else 0.0)
@@ -0,0 +1,188 @@
+import time
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from jinja2.utils import LRUCache
+from markupsafe import Markup
+
+try:
+    from jinja2 import pass_context
+except ImportError:  # Jinja2 < 3.0
+    from jinja2 import contextfunction as pass_context
+
+from .cache import MemoryCache
+from .utils import to_unicode
+
+
+class TemplateCache(LRUCache):
+    """
+    The cache of compiled templates of a Jinja environment, counting its
+    hits and misses.  Jinja stores a template only after a miss.
+
+    :param capacity: how many templates are cached.
+    """
+
+    def __init__(self, capacity):
+        super(TemplateCache, self).__init__(capacity)
+        self.lookups = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        self.lookups += 1
+        return super(TemplateCache, self).get(key, default)
+
+    def __setitem__(self, key, value):
+        self.misses += 1
+        super(TemplateCache, self).__setitem__(key, value)
+
+    def stats(self):
+        """
+        Return a dictionary of hit and miss counters.
+        """
+        hits = max(self.lookups - self.misses, 0)
+        return dict(size=len(self), capacity=self.capacity, hits=hits,
+                    misses=self.misses,
+                    hit_rate=float(hits) / self.lookups
+                    if self.lookups else 0.0)
+
+
+class FragmentCache(object):
+    """
+    Caches rendered template fragments in a backend.
+
+    A fragment is fresh for its TTL, then kept ``grace`` more seconds.
+    When a stale fragment is read, only one renderer (the one taking a
+    lock in the backend) renders it again; the others keep using the
+    stale fragment, so a popular fragment expiring doesn't cause a
+    stampede.
+
+    :param backend:
+      (optional) a cache backend, a
+      :class:`~waterspout.cache.MemoryCache` of 1024 fragments by default.
+    :param ttl: default TTL of a fragment, in seconds.
+    :param grace: seconds a stale fragment is kept.
+    """
+
+    def __init__(self, backend=None, ttl=300, grace=60):
+        if backend is None:
+            backend = MemoryCache(1024)
+        self.backend = backend
+        self.ttl = ttl
+        self.grace = grace
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def get_or_render(self, key, ttl, render):
+        """
+        Return the fragment cached under ``key``, or render it with
+        ``render()`` and cache it for ``ttl`` seconds.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        key = 'fragment:%s' % to_unicode(key)
+        now = time.time()
+        entry = self.backend.get(key)
+        if entry is not None:
+            html, fresh_until = entry
+            if now < fresh_until:
+                self.hits += 1
+                return html
+            if not self.backend.add(key + ':lock', 1, self.grace):
+                self.stale += 1
+                return html
+        self.misses += 1
+        html = to_unicode(render())
+        self.backend.set(key, (html, now + ttl), ttl + self.grace)
+        if entry is not None:
+            self.backend.delete(key + ':lock')
+        return html
+
+    def invalidate(self, key):
+        """
+        Remove the fragment cached under ``key``.
+        """
+        self.backend.delete('fragment:%s' % to_unicode(key))
+
+    def clear(self):
+        """
+        Remove every cached fragment.
+        """
+        self.backend.clear()
+
+    def stats(self):
+        """
+        Return a dictionary of hit and miss counters.
+        """
+        total = self.hits + self.misses + self.stale
+        return dict(hits=self.hits, misses=self.misses, stale=self.stale,
+                    hit_rate=float(self.hits + self.stale) / total
+                    if total else 0.0)
+
+
+class FragmentCacheExtension(Extension):
+    """
+    Adds the ``cache`` tag to Jinja ::
+
+        {% cache 'sidebar', 600 %}
+            {{ expensive_sidebar() }}
+        {% endcache %}
+
+    The TTL is optional.  Fragments are stored in the
+    :class:`FragmentCache` of ``environment.fragment_cache``.
+    """
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        if parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+        else:
+            args.append(nodes.Const(None))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_render', args), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, key, ttl, caller):
+        cache = self.environment.fragment_cache
+        return Markup(cache.get_or_render(key, ttl, caller))
+
+
+class Translations(object):
+    """
+    Gettext callables for the Jinja i18n extension, translating with the
+    ``locale`` of the template context ::
+
+        {% trans %}Hello{% endtrans %}
+        {{ _("Hello") }}
+
+    Catalogs are loaded once at startup, so a lookup is a dictionary
+    access and the messages are not cached again.
+    """
+
+    def install(self, environment):
+        """
+        Install the callables in a Jinja environment using the
+        ``jinja2.ext.i18n`` extension.
+        """
+        environment.install_gettext_callables(self.gettext, self.ngettext)
+
+    @pass_context
+    def gettext(self, context, message, plural_message=None, count=None):
+        locale = context.get('locale')
+        if locale is None:
+            return message
+        return locale.translate(message, plural_message, count)
+
+    @pass_context
+    def ngettext(self, context, singular, plural, count):
+        locale = context.get('locale')
+        if locale is None:
+            return singular if count == 1 else plural
+        return locale.translate(singular, plural, count)
@@ -2,11 +2,11 @@ import sys
 import time
 
 from tornado.ioloop import IOLoop
-from tornado.httpserver import HTTPServer
 from tornado.httpclient import HTTPRequest, AsyncHTTPClient
 from tornado.testing import bind_unused_port
 from tornado.util import raise_exc_info
 
+from waterspout.process import HTTPServer
 from waterspout.utils import to_unicode, smart_quote
 
 
@@ -43,9 +43,14 @@ class TestClient(object):
         self.io_loop = self.get_new_ioloop()
         self.io_loop.make_current()
         self.http_server = HTTPServer(self.application, io_loop=self.io_loop)
+        self.application.http_server = self.http_server
         self.http_client = AsyncHTTPClient(io_loop=self.io_loop)
         self.http_server.add_sockets([sock])
 
+        resources = getattr(self.application, 'resources', None)
+        if resources is not None:
+            self.io_loop.run_sync(resources.setup)
+
     def get_new_ioloop(self):
         """Creates a new `.IOLoop` for this test.  May be overridden in
         subclasses for tests that require a specific `.IOLoop` (usually
@@ -139,6 +144,9 @@ class TestClient(object):
         It is suggested to be called in `TestCase.tearDown`
         """
         self.http_server.stop()
+        resources = getattr(self.application, 'resources', None)
+        if resources is not None:
+            self.io_loop.run_sync(resources.teardown)
         if (not IOLoop.initialized() or
                 self.http_client.io_loop is not IOLoop.instance()):
             self.http_client.close()
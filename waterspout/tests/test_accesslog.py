@@ -0,0 +1,58 @@
+import os
+import json
+import tempfile
+
+from waterspout.app import Waterspout
+from waterspout.web import RequestHandler
+
+
+class HelloHandler(RequestHandler):
+    def get(self):
+        self.write('Hello')
+
+
+def test_access_log():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    waterspout = Waterspout(
+        __name__, handlers=[('/', HelloHandler, None, 'hello')],
+        access_log=path, access_log_sample_rate=0
+    )
+    client = waterspout.TestClient()
+    client.get('/')
+    client.get('/missing')
+    client.get('/?oops', headers={'X-Request-Id': 'abc'})
+    stats = client.application.access_log.stats()
+    client.close()
+    try:
+        with open(path) as f:
+            records = [json.loads(line) for line in f]
+    finally:
+        os.remove(path)
+    assert stats['sampled_out'] == 2
+    assert len(records) == 1
+    record = records[0]
+    assert record['status'] == 404
+    assert record['path'] == '/missing'
+    assert record['handler'] == 'ErrorHandler'
+
+
+def test_access_log_record():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    waterspout = Waterspout(
+        __name__, handlers=[('/', HelloHandler, None, 'hello')],
+        access_log=path
+    )
+    client = waterspout.TestClient()
+    client.get('/')
+    client.close()
+    try:
+        with open(path) as f:
+            record = json.loads(f.read())
+    finally:
+        os.remove(path)
+    assert record['route'] == 'hello'
+    assert record['handler'] == 'HelloHandler'
+    assert record['status'] == 200
+    assert record['bytes'] == 5
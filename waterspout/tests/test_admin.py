@@ -0,0 +1,55 @@
+import json
+
+from waterspout.app import Waterspout
+from waterspout.web import RequestHandler
+
+
+class HelloHandler(RequestHandler):
+    def get(self):
+        self.session['name'] = 'whtsky'
+        self.write('Hello')
+
+
+class PageHandler(RequestHandler):
+    def get(self):
+        self.render('test.html', name='whtsky')
+
+
+waterspout = Waterspout(__name__, handlers=[('/', HelloHandler),
+                                            ('/page', PageHandler)],
+                        cookie_secret='..', admin_token='secret')
+
+
+def test_admin():
+    client = waterspout.TestClient()
+    client.get('/')
+    for _ in range(2):
+        client.get('/page')
+        client.get('/robots.txt')
+    assert client.get('/_waterspout').code == 404
+    assert client.get('/_waterspout', headers={
+        'Authorization': 'Bearer wrong'
+    }).code == 404
+    response = client.get('/_waterspout', headers={
+        'Authorization': 'Bearer secret'
+    })
+    assert response.headers['Cache-Control'] == 'no-store'
+    description = json.loads(response.body)
+    client.close()
+    handlers = [route['handler'] for route in description['routes']]
+    assert handlers.index('waterspout.admin.AdminHandler') < \
+        handlers.index('%s.HelloHandler' % __name__)
+    assert description['requests']['inflight'] == 0
+    assert description['connections']['http'] >= 1
+    caches = description['caches']
+    assert 'sessions' in caches
+    assert caches['templates']['hits'] >= 1
+    assert caches['templates']['misses'] == 1
+    assert caches['static_files']['hits'] >= 1
+    assert description['memory']['rss'] > 0
+
+
+def test_disabled():
+    client = Waterspout(__name__, handlers=[('/', HelloHandler)]).TestClient()
+    assert client.get('/_waterspout').code == 404
+    client.close()
@@ -30,3 +30,65 @@ def test_domain():
     waterspout.register_app(app, domain='miao.com')
 
     assert waterspout.handlers == ['^miao.com$', []]
+
+
+class LazyHandler(RequestHandler):
+    def get(self, name):
+        self.write(self.reverse_url('lazy', name))
+
+    def post(self, name):
+        self.write('posted')
+
+
+lazy = App('lazy', __name__, [(r'/(\w+)', LazyHandler, None, 'lazy')])
+
+
+def test_lazy_app():
+    waterspout = Waterspout(__name__, xsrf_cookies=False)
+    waterspout.register_app('%s:lazy' % __name__, prefix='/lazy')
+    client = waterspout.TestClient()
+    lazy_app, = client.application.lazy_apps
+    assert lazy_app.app is None
+    assert client.get('/lazyfoo').code == 404
+    assert lazy_app.app is None
+    assert client.get('/lazy/foo').body == '/lazy/foo'
+    assert lazy_app.app is lazy
+    assert client.post('/lazy/bar', body='').body == 'posted'
+    assert client.get('/lazy/').code == 404
+    client.close()
+
+
+conflicting = App('conflicting', __name__, [])
+conflicting.user_loader(lambda session: None)
+
+
+def test_lazy_app_unavailable():
+    waterspout = Waterspout(__name__)
+    waterspout.user_loader(lambda session: None)
+    waterspout.register_app('%s:missing' % __name__, prefix='/missing')
+    waterspout.register_app('%s:conflicting' % __name__, prefix='/conflict')
+    client = waterspout.TestClient()
+    template_paths = list(waterspout.template_paths)
+    for path in ['/missing/foo', '/conflict/foo']:
+        response = client.get(path)
+        assert response.code == 503
+        assert int(response.headers['Retry-After']) > 0
+        client.application.lazy_apps[0].retry_at = 0
+        client.application.lazy_apps[1].retry_at = 0
+        assert client.post(path, body='x' * 100000).code == 503
+    assert waterspout.template_paths == template_paths
+    client.close()
+
+
+def test_lazy_app_warm_up():
+    waterspout = Waterspout(__name__)
+    waterspout.register_app('%s:lazy' % __name__, prefix='/lazy',
+                            warm_up=True)
+    client = waterspout.TestClient()
+    lazy_app, = client.application.lazy_apps
+    client.io_loop.add_future(lazy_app.load_in_background(client.application),
+                              client.stop)
+    client.wait()
+    assert client.get('/lazy/foo').body == '/lazy/foo'
+    assert not lazy_app.install(client.application)
+    client.close()
@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from tornado.ioloop import IOLoop
+from tornado.web import create_signed_value
+
+from waterspout.app import Waterspout
+from waterspout.bus import Bus, invalidate_cache
+from waterspout.utils import LRUCache, ObjectDict, SessionCache
+from waterspout.web import RequestHandler
+
+
+class PublishHandler(RequestHandler):
+    def get(self):
+        self.application.bus.publish('greeting', self.get_argument('name'))
+        self.write('ok')
+
+
+waterspout = Waterspout(__name__, handlers=[('/', PublishHandler)])
+received = []
+
+
+@waterspout.subscribe('greeting')
+def greeting(message):
+    received.append(message)
+
+
+def test_local_publish():
+    client = waterspout.TestClient()
+    assert client.get('/?name=whtsky').body == 'ok'
+    assert received == ['whtsky']
+    client.close()
+
+
+def test_publish_before_build():
+    app = Waterspout(__name__)
+    messages = []
+    app.subscribe('greeting', messages.append)
+    app.publish('greeting', 'hi')
+    app.invalidate('fragments')
+    assert messages == ['hi']
+    application = app.application
+    assert application.bus is app.bus
+    assert app.bus.caches is application.caches
+
+
+def test_shared_directory():
+    path = tempfile.mkdtemp()
+    try:
+        os.chmod(path, 0o777)
+        with pytest.raises(RuntimeError):
+            Bus().start(path, 0)
+        link = os.path.join(path, 'link')
+        os.symlink(tempfile.gettempdir(), link)
+        with pytest.raises(RuntimeError):
+            Bus().start(link, 0)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_workers():
+    path = tempfile.mkdtemp()
+    io_loop = IOLoop()
+    cache = LRUCache(10)
+    cache['a'] = 1
+    cache['b'] = 2
+    messages = []
+    try:
+        first = Bus().start(path, 0, io_loop)
+        second = Bus(caches={'test': cache}).start(path, 1, io_loop)
+        second.subscribe('greeting', messages.append)
+        for i in range(3):
+            first.publish('greeting', i)
+        first.invalidate('test', 'a')
+
+        io_loop.add_timeout(io_loop.time() + 0.1, io_loop.stop)
+        io_loop.start()
+        assert messages == [0, 1, 2]
+        assert 'a' not in cache and 'b' in cache
+        assert first.stats()['datagrams'] == 1
+        assert second.stats()['received'] == 4
+        first.stop()
+        second.stop()
+    finally:
+        io_loop.close(all_fds=True)
+        shutil.rmtree(path)
+
+
+def test_invalidate_sessions():
+    cache = SessionCache()
+    handler = ObjectDict(settings={'cookie_secret': '..'},
+                         get_cookie=lambda name: None)
+    raw = create_signed_value('..', 'session', 'x').decode('utf-8')
+    cache.set(handler, raw, ('x', 1))
+    assert cache.get(handler, raw) == ('x', 1)
+    invalidate_cache(cache, raw)
+    assert cache.get(handler, raw) is None
+    with pytest.raises(TypeError):
+        invalidate_cache(object(), 'a')
+
+
+def test_default_directory():
+    runtime_dir = tempfile.mkdtemp()
+    saved = os.environ.get('XDG_RUNTIME_DIR')
+    os.environ['XDG_RUNTIME_DIR'] = runtime_dir
+    io_loop = IOLoop()
+    try:
+        first = Bus().start(name=0, io_loop=io_loop)
+        second = Bus().start(name=1, io_loop=io_loop)
+        path = os.path.dirname(first.path)
+        assert os.path.dirname(path) == runtime_dir
+        first.stop()
+        assert os.path.isdir(path)
+        second.stop()
+        assert not os.path.exists(path)
+    finally:
+        if saved is None:
+            del os.environ['XDG_RUNTIME_DIR']
+        else:
+            os.environ['XDG_RUNTIME_DIR'] = saved
+        io_loop.close(all_fds=True)
+        shutil.rmtree(runtime_dir)
@@ -0,0 +1,183 @@
+import time
+
+import pytest
+
+from waterspout.cache import MemoryCache, MemcacheCache
+
+
+class StandInMemcache(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, time=0):
+        self.data[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        if key in self.data:
+            return False
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def incr(self, key, delta=1):
+        if key not in self.data:
+            return None
+        self.data[key] += delta
+        return self.data[key]
+
+
+def test_memory_cache():
+    cache = MemoryCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=0.01)
+    assert cache.get('a') == 1
+    assert not cache.add('a', 2)
+    time.sleep(0.02)
+    assert cache.get('b') is None
+    assert cache.add('b', 3)
+    cache.set('c', 4)
+    assert cache.get('a') is None
+    assert len(cache) == 2
+
+
+def test_memcache_cache():
+    client = StandInMemcache()
+    cache = MemcacheCache(client)
+    cache.set('a', 1, 10)
+    version = cache.version
+    assert client.data == {'waterspout:version': version,
+                           'waterspout:%d:a' % version: 1}
+    assert cache.get('a') == 1
+    assert not cache.add('a', 2)
+    cache.set('a b' * 100, 1)
+    assert all(' ' not in key and len(key) < 250 for key in client.data)
+    cache.delete('a')
+    assert cache.get('a') is None
+
+
+def test_memcache_cache_clear():
+    client = StandInMemcache()
+    client.data['other'] = 1
+    cache = MemcacheCache(client, version_ttl=0)
+    sibling = MemcacheCache(client, version_ttl=0)
+    cache.set('a', 1)
+    assert sibling.get('a') == 1
+    cache.clear()
+    assert cache.get('a') is None
+    assert sibling.get('a') is None
+    assert client.data['other'] == 1
+    version = cache.version
+    client.incr = None
+    cache.clear()
+    assert sibling.version == cache.version == version + 1
+
+
+def test_memoize():
+    from waterspout.cache import memoize, memoized
+    calls = []
+
+    @memoize(ttl=60, name='test.square')
+    def square(x):
+        calls.append(x)
+        return x * x
+
+    assert square(3) == 9 and square(3) == 9
+    assert square(x=3) == 9
+    assert calls == [3, 3]
+    square.invalidate(3)
+    assert square(3) == 9
+    assert calls == [3, 3, 3]
+    assert memoized['test.square'] is square
+    assert square.stats()['hits'] == 1
+
+
+def test_memoize_method():
+    from waterspout.cache import memoize
+
+    class User(object):
+        def __init__(self, id):
+            self.id = id
+
+        @memoize(key=lambda self, size: '%d:%d' % (self.id, size))
+        def avatar(self, size):
+            return '%d-%d.png' % (self.id, size)
+
+        @memoize()
+        def name(self):
+            return 'user%d' % self.id
+
+    assert User(1).avatar(32) == '1-32.png'
+    assert User(2).avatar(32) == '2-32.png'
+    assert User.avatar.stats()['misses'] == 2
+    assert User(1).avatar(32) == '1-32.png'
+    assert User.avatar.stats()['hits'] == 1
+    with pytest.raises(TypeError):
+        User(1).name()
+
+
+def test_memoize_coroutine():
+    import tornado.gen
+    from tornado.ioloop import IOLoop
+    from waterspout.cache import memoize
+    calls = []
+
+    @memoize(ttl=60, stale=60)
+    @tornado.gen.coroutine
+    def load(x):
+        calls.append(x)
+        yield tornado.gen.moment
+        raise tornado.gen.Return(x)
+
+    @tornado.gen.coroutine
+    def run():
+        values = yield [load(1), load(1)]
+        assert values == [1, 1]
+        assert calls == [1]
+        key = load.make_key((1,), {})
+        value, _ = load.backend.get(key)
+        load.backend.set(key, (value, time.time() - 1), 60)
+        value = yield load(1)
+        assert value == 1
+        yield tornado.gen.moment
+        yield tornado.gen.moment
+        assert calls == [1, 1]
+        assert load.stats()['stale'] == 1
+
+    io_loop = IOLoop()
+    io_loop.run_sync(run)
+    io_loop.close()
+
+
+def test_memoize_shared_backend():
+    import tornado.gen
+    from tornado.concurrent import is_future
+    from tornado.ioloop import IOLoop
+    from waterspout.cache import Memoized
+
+    @tornado.gen.coroutine
+    def load(x):
+        yield tornado.gen.moment
+        raise tornado.gen.Return(x)
+
+    backend = MemoryCache()
+    first = Memoized(load, backend=backend, name='test.shared')
+    second = Memoized(load, backend=backend, name='test.shared')
+    assert first.coroutine and second.coroutine
+    io_loop = IOLoop()
+    assert io_loop.run_sync(lambda: first(1)) == 1
+    result = second(1)
+    assert is_future(result) and result.result() == 1
+    assert second.stats()['hits'] == 1
+    value, _ = backend.get(second.make_key((1,), {}))
+    assert value == 1
+
+    third = Memoized(load, name='test.undetected', coroutine=False)
+    io_loop.run_sync(lambda: third(1))
+    assert len(third.backend) == 0
+    io_loop.close()
@@ -0,0 +1,49 @@
+import os
+import json
+import tempfile
+
+from waterspout.app import Waterspout
+from waterspout.cli import bench, percentile, summarize
+from waterspout.web import RequestHandler
+
+
+class HelloHandler(RequestHandler):
+    def get(self):
+        self.write('Hello')
+
+
+waterspout = Waterspout(__name__, handlers=[('/', HelloHandler)])
+
+
+def test_percentile():
+    samples = list(range(1, 101))
+    assert percentile(samples, 50) == 51
+    assert percentile(samples, 99) == 99
+    assert percentile([], 50) == 0.0
+
+
+def test_summarize():
+    summary = summarize([('/', 200, 1.0), ('/', 200, 3.0),
+                         ('/missing', 404, 2.0)], 2)
+    assert summary['requests'] == 3
+    assert summary['errors'] == 1
+    assert summary['throughput'] == 1.5
+    assert summary['latency']['max'] == 3.0
+    assert summary['statuses'] == {'200': 2, '404': 1}
+    assert summary['urls']['/']['latency']['mean'] == 2.0
+
+
+def test_bench():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        bench(['%s:waterspout' % __name__, '-c', '4', '-n', '40',
+               '-u', '/', '-u', '/missing', '-o', path])
+        with open(path) as f:
+            report = json.load(f)
+    finally:
+        os.remove(path)
+    results = report['results']
+    assert results['requests'] == 40
+    assert results['errors'] == results['urls']['/missing']['requests']
+    assert report['concurrency'] == 4
@@ -0,0 +1,54 @@
+import time
+import threading
+
+import pytest
+import tornado.gen
+
+from waterspout.app import Waterspout
+from waterspout.web import RequestHandler
+from waterspout.executor import Executors, run_on_executor
+
+
+class ThreadHandler(RequestHandler):
+    @run_on_executor('slow')
+    def current_thread(self):
+        time.sleep(0.01)
+        return threading.current_thread().name
+
+    @tornado.gen.coroutine
+    def get(self):
+        name = yield self.current_thread()
+        same = yield self.run_in_executor(lambda: name)
+        self.write(same)
+
+
+waterspout = Waterspout(__name__, handlers=[('/', ThreadHandler)],
+                        executors={'slow': 2})
+
+
+def test_run_on_executor():
+    client = waterspout.TestClient()
+    body = client.get('/').body
+    assert body
+    assert body != threading.current_thread().name
+    stats = waterspout.executors.stats()
+    assert stats['slow']['completed'] == 1
+    assert stats['default']['completed'] == 1
+
+
+def test_executor_stats():
+    executors = Executors({'io': 1})
+    pool = executors['io']
+    futures = [pool.submit(time.sleep, 0.01) for _ in range(3)]
+    for future in futures:
+        future.result()
+    stats = pool.stats()
+    assert stats['submitted'] == stats['completed'] == 3
+    assert stats['queue_depth'] == 0
+    assert stats['max_wait'] > 0
+    executors.shutdown()
+
+
+def test_unknown_executor():
+    with pytest.raises(KeyError):
+        Executors()['missing']
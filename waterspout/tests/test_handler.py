@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import os
+import binascii
+
+import pytest
+
 from waterspout import server_name
 
 from waterspout.app import Waterspout
-from waterspout.web import RequestHandler, APIHandler
+from waterspout.web import RequestHandler, APIHandler, conditional
 from waterspout.utils import to_unicode
 
 
@@ -33,6 +38,15 @@ class SessionHandler(RequestHandler):
         assert self.session.miao
 
 
+class BigSessionHandler(RequestHandler):
+    def get(self):
+        size = self.get_argument('size', None)
+        if size:
+            data = binascii.hexlify(os.urandom(int(size)))
+            self.session.data = to_unicode(data)
+        self.write(str(len(self.session.data or '')))
+
+
 class MessageFlashingHandler(RequestHandler):
     def get(self):
         assert not self.get_flashed_messages()
@@ -44,12 +58,39 @@ class MessageFlashingHandler(RequestHandler):
         assert self.get_flashed_messages(True) == [('message', 'aa')]
 
 
+class CartHandler(RequestHandler):
+    def get(self):
+        if self.session.cart is None:
+            self.session.cart = ['a']
+        self.write(','.join(self.session.cart))
+        self.session.cart.append('b')
+
+
+class VersionHandler(RequestHandler):
+    rendered = 0
+
+    @conditional(etag=lambda self, name: 'v1-%s' % name,
+                 last_modified=lambda self, name: 1400000000)
+    def get(self, name):
+        VersionHandler.rendered += 1
+        self.write(name)
+
+
+class ReverseURLHandler(RequestHandler):
+    def get(self, name):
+        self.write(self.reverse_url('reverse', name + ' !'))
+
+
 handlers = [
     ('/', HelloWorldHandler),
     ('/post', PostHandler),
     ('/api', APIHandler),
     ('/session', SessionHandler),
-    ('/message', MessageFlashingHandler)
+    ('/message', MessageFlashingHandler),
+    ('/big_session', BigSessionHandler),
+    ('/cart', CartHandler),
+    ('/version/(.*)', VersionHandler),
+    ('/reverse/(.*)', ReverseURLHandler, None, 'reverse')
 ]
 
 waterspout = Waterspout(__name__, handlers=handlers, cookie_secret="..")
@@ -96,3 +137,93 @@ def test_api():
 def test_message_flashing():
     client = waterspout.TestClient()
     assert client.get('/message').code == 200
+
+
+def test_conditional():
+    client = waterspout.TestClient()
+    response = client.get('/version/a')
+    assert response.body == 'a'
+    assert response.headers["Etag"] == '"v1-a"'
+    assert VersionHandler.rendered == 1
+    last_modified = response.headers["Last-Modified"]
+    response = client.get('/version/a', headers={"If-None-Match": '"v1-a"'})
+    assert response.code == 304
+    response = client.get('/version/a', headers={
+        "If-Modified-Since": last_modified
+    })
+    assert response.code == 304
+    assert VersionHandler.rendered == 1
+    response = client.get('/version/a', headers={"If-None-Match": '"v0-a"'})
+    assert response.code == 200
+    assert VersionHandler.rendered == 2
+
+
+def test_etag_hash():
+    fast = Waterspout(__name__, handlers=handlers, etag_hash='crc32')
+    client = fast.TestClient()
+    etag = client.get('/').headers["Etag"]
+    assert len(etag) == 10
+    assert client.get('/', headers={"If-None-Match": etag}).code == 304
+    disabled = Waterspout(__name__, handlers=handlers, etag_hash=None)
+    assert "Etag" not in disabled.TestClient().get('/').headers
+    with pytest.raises(ValueError):
+        Waterspout(__name__, handlers=handlers, etag_hash='md5').application
+
+
+def test_reverse_url():
+    client = waterspout.TestClient()
+    assert client.get('/reverse/a').body == '/reverse/a%20%21'
+
+
+def session_cookies(response):
+    cookies = response.headers.get_list("Set-Cookie")
+    return dict(c.split(';')[0].split('=', 1) for c in cookies)
+
+
+def test_split_session():
+    client = waterspout.TestClient()
+    response = client.get('/big_session?size=5000')
+    cookies = session_cookies(response)
+    assert len(cookies) > 1
+    assert all(len(value) < 4096 for value in cookies.values())
+    header = '; '.join('%s=%s' % cookie for cookie in cookies.items())
+    response = client.get('/big_session', headers={"Cookie": header})
+    assert response.body == '10000'
+
+    response = client.get('/big_session?size=1', headers={"Cookie": header})
+    cleared = session_cookies(response)
+    assert len(cleared) == len(cookies)
+    assert cleared['__waterspout_sessions__1'] == '""'
+
+
+def test_session_cache():
+    client = waterspout.TestClient()
+    cache = client.application.session_cache
+    cookies = session_cookies(client.get('/message'))
+    header = '; '.join('%s=%s' % cookie for cookie in cookies.items())
+    response = client.get('/big_session?size=1', headers={"Cookie": header})
+    assert len(cache) == 1
+    assert cache.stats()['misses'] == 1
+
+    cookies = session_cookies(response)
+    header = '; '.join('%s=%s' % cookie for cookie in cookies.items())
+    response = client.get('/big_session', headers={"Cookie": header})
+    assert response.body == '2'
+    assert not response.headers.get_list("Set-Cookie")
+    response = client.get('/big_session', headers={"Cookie": header})
+    assert response.body == '2'
+    assert cache.stats()['hits'] == 1
+
+    client.application.settings['cookie_secret'] = 'rotated'
+    response = client.get('/big_session', headers={"Cookie": header})
+    assert response.body == '0'
+
+
+def test_session_cache_copies():
+    client = waterspout.TestClient()
+    cookies = session_cookies(client.get('/cart'))
+    header = '; '.join('%s=%s' % cookie for cookie in cookies.items())
+    for _ in range(3):
+        response = client.get('/cart', headers={"Cookie": header})
+        assert response.body == 'a,b'
+    assert client.application.session_cache.stats()['hits'] == 2
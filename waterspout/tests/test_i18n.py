@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from waterspout.app import Waterspout
+from waterspout.web import RequestHandler
+from waterspout.utils import to_unicode
+
+
+class I18nHandler(RequestHandler):
+    def get(self):
+        self.render("i18n.html")
+
+
+waterspout = Waterspout(__name__, handlers=[('/', I18nHandler)],
+                        translations_path="translations",
+                        locale_cache_size=1)
+
+
+def test_translations():
+    client = waterspout.TestClient()
+    body = client.get('/', headers={"Accept-Language": "zh-CN"}).body
+    assert body.strip() == to_unicode("你好 你好 2 个苹果")
+    body = client.get('/', headers={"Accept-Language": "fr"}).body
+    assert body.strip() == "Hello Hello 2 apples"
+
+
+def test_caches():
+    client = waterspout.TestClient()
+    for language in ["zh-CN", "zh-CN", "fr"]:
+        client.get('/', headers={"Accept-Language": language})
+    caches = client.application.caches
+    assert caches['locales'].stats() == dict(
+        size=1, capacity=1, hits=1, misses=2
+    )
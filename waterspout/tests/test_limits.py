@@ -0,0 +1,74 @@
+from waterspout.app import Waterspout
+from waterspout.web import RequestHandler
+from waterspout.limits import RateLimiter, AdmissionControl
+from waterspout.utils import ObjectDict
+
+
+class HelloHandler(RequestHandler):
+    def get(self):
+        self.write('Hello')
+
+
+class SlowHandler(RequestHandler):
+    max_concurrency = 1
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(1, burst=2, max_clients=2)
+    assert limiter.allow('a', now=0)[0]
+    assert limiter.allow('a', now=0)[0]
+    allowed, retry_after = limiter.allow('a', now=0)
+    assert not allowed
+    assert retry_after == 1
+    assert limiter.allow('a', now=1)[0]
+    limiter.allow('b', now=1)
+    limiter.allow('c', now=1)
+    assert len(limiter.buckets) == 2
+
+
+def test_rate_limit():
+    waterspout = Waterspout(__name__, handlers=[('/', HelloHandler)],
+                            rate_limit=0.01, rate_limit_burst=1)
+    client = waterspout.TestClient()
+    assert client.get('/').code == 200
+    response = client.get('/')
+    assert response.code == 429
+    assert response.headers["Retry-After"]
+
+
+def test_max_inflight_requests():
+    admission = AdmissionControl({'max_inflight_requests': 1})
+    handler = HelloHandler.__new__(HelloHandler)
+    assert admission.admit(handler) is None
+    assert admission.admit(handler) == (503, {})
+    admission.release(handler)
+    assert admission.inflight == 0
+    assert admission.admit(handler) is None
+
+
+def test_max_concurrency():
+    admission = AdmissionControl({})
+    slow = SlowHandler.__new__(SlowHandler)
+    assert admission.admit(slow) is None
+    assert admission.admit(slow) == (503, {})
+    assert admission.admit(HelloHandler.__new__(HelloHandler)) is None
+    assert admission.routes == {__name__ + '.SlowHandler': 1,
+                                __name__ + '.HelloHandler': 1}
+
+
+def test_max_concurrency_same_name():
+    other = type('SlowHandler', (RequestHandler,),
+                 {'max_concurrency': 1, '__module__': 'other'})
+    admission = AdmissionControl({})
+    assert admission.admit(SlowHandler.__new__(SlowHandler)) is None
+    assert admission.admit(other.__new__(other)) is None
+    assert admission.routes == {__name__ + '.SlowHandler': 1,
+                                'other.SlowHandler': 1}
+
+
+def test_shed_ioloop_lag():
+    monitor = ObjectDict(lag=1.0)
+    admission = AdmissionControl({'shed_ioloop_lag': 0.5}, monitor)
+    assert admission.admit(HelloHandler.__new__(HelloHandler)) == (503, {})
+    monitor.lag = 0.1
+    assert admission.admit(HelloHandler.__new__(HelloHandler)) is None
@@ -0,0 +1,87 @@
+import os
+import json
+import tempfile
+
+import pytest
+
+from waterspout.app import Waterspout
+from waterspout.memory import MemoryProfiler, tracemalloc
+from waterspout.web import RequestHandler
+
+leaked = []
+
+
+class LeakHandler(RequestHandler):
+    def get(self):
+        leaked.append(bytearray(100000))
+        self.write('Hello')
+
+
+class HelloHandler(RequestHandler):
+    def get(self):
+        self.write('Hello')
+
+
+handlers = [('/leak', LeakHandler, None, 'leak'), ('/', HelloHandler)]
+
+
+def test_memory_profiler():
+    if tracemalloc is None:
+        pytest.skip("tracemalloc requires Python 3.4")
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    waterspout = Waterspout(__name__, handlers=handlers,
+                            memory_profile_sample_rate=1,
+                            memory_profile_file=path)
+    client = waterspout.TestClient()
+    for _ in range(3):
+        client.get('/leak')
+        client.get('/')
+    stats = client.application.memory_profiler.stats()
+    client.close()
+    try:
+        with open(path) as f:
+            report = json.loads(f.read())
+    finally:
+        os.remove(path)
+    assert not tracemalloc.is_tracing()
+    assert stats['sampled'] == 6
+    route = report['routes'][0]
+    assert route['handler'].endswith('.LeakHandler')
+    assert route['route'] == 'leak'
+    assert route['samples'] == 3
+    assert route['growth_per_request'] >= 100000
+    location, size = route['lines'][0]
+    assert location.endswith('test_memory.py:16')
+
+
+def test_websocket_not_sampled():
+    if tracemalloc is None:
+        pytest.skip("tracemalloc requires Python 3.4")
+    from tornado.websocket import websocket_connect
+    from waterspout.websocket import WebSocketHandler
+
+    class EchoHandler(WebSocketHandler):
+        def on_message(self, message):
+            self.write_message(message)
+
+    waterspout = Waterspout(__name__, handlers=handlers + [
+        ('/ws', EchoHandler)
+    ], memory_profile_sample_rate=1)
+    client = waterspout.TestClient()
+    url = client.get_url('/ws').replace('http', 'ws', 1)
+    websocket_connect(url, io_loop=client.io_loop, callback=client.stop)
+    client.wait().result().close()
+    client.io_loop.add_timeout(client.io_loop.time() + 0.05, client.stop)
+    client.wait()
+    for _ in range(3):
+        client.get('/')
+    stats = client.application.memory_profiler.stats()
+    client.close()
+    assert stats['sampled'] == 3
+
+
+def test_not_sampled():
+    profiler = MemoryProfiler(sample_rate=0)
+    assert profiler.begin(None) is None
+    assert profiler.report() == []
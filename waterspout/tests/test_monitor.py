@@ -0,0 +1,77 @@
+import time
+import logging
+
+from tornado.ioloop import IOLoop
+
+from waterspout.app import Waterspout
+from waterspout.web import RequestHandler
+from waterspout.monitor import LoopMonitor
+
+
+class BlockingHandler(RequestHandler):
+    def get(self):
+        time.sleep(0.2)
+        self.write(self.request_id)
+
+
+class LogRecorder(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_percentile():
+    monitor = LoopMonitor()
+    assert monitor.percentile(99) == 0.0
+    monitor.samples.extend([0.01 * i for i in range(101)])
+    assert monitor.percentile(50) == 0.5
+    assert monitor.percentile(100) == 1.0
+    assert monitor.stats()['max'] == 1.0
+
+
+def test_lag():
+    io_loop = IOLoop()
+    monitor = LoopMonitor(interval=0.01).start(io_loop)
+    io_loop.add_timeout(io_loop.time() + 0.005, lambda: time.sleep(0.05))
+    io_loop.add_timeout(io_loop.time() + 0.1, io_loop.stop)
+    io_loop.start()
+    monitor.stop()
+    io_loop.close()
+    assert monitor.samples
+    assert monitor.percentile(100) >= 0.03
+
+
+def test_watchdog():
+    io_loop = IOLoop()
+    monitor = LoopMonitor(threshold=0.05)
+    monitor.report = lambda frame, blocked: None
+    monitor.start(io_loop)
+    io_loop.add_timeout(io_loop.time() + 0.01, lambda: time.sleep(0.15))
+    io_loop.add_timeout(io_loop.time() + 0.3, io_loop.stop)
+    io_loop.start()
+    monitor.stop()
+    io_loop.close()
+    assert monitor.blocked == 1
+    assert not monitor.samples
+
+
+def test_blocking_threshold():
+    waterspout = Waterspout(__name__, handlers=[('/', BlockingHandler)],
+                            blocking_threshold=0.05)
+    recorder = LogRecorder()
+    logging.getLogger().addHandler(recorder)
+    try:
+        client = waterspout.TestClient()
+        response = client.get('/', headers={'X-Request-Id': 'miao'})
+        client.close()
+    finally:
+        logging.getLogger().removeHandler(recorder)
+    assert response.body == 'miao'
+    blocked = [m for m in recorder.messages if 'IOLoop blocked' in m]
+    assert blocked
+    assert 'BlockingHandler' in blocked[0]
+    assert 'request miao' in blocked[0]
+    assert 'time.sleep' in blocked[0]
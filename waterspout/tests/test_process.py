@@ -0,0 +1,129 @@
+import os
+import signal
+import subprocess
+
+import tornado.netutil
+
+from tornado.ioloop import IOLoop
+
+from waterspout import process
+from waterspout.utils import ObjectDict
+
+
+class FakeServer(object):
+    stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+def test_reseed_random():
+    import random
+    random.seed(0)
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        process._reseed_random()
+        os.write(w, str(random.random()).encode('ascii'))
+        os._exit(0)
+    os.waitpid(pid, 0)
+    os.close(w)
+    child = float(os.read(r, 64))
+    os.close(r)
+    assert child != random.random()
+
+
+def test_bind_inherited_sockets():
+    sock = tornado.netutil.bind_sockets(0, '127.0.0.1')[0]
+    fd = os.dup(sock.fileno())
+    os.environ[process.ENVIRON_KEY] = '%d:%d' % (fd, sock.family)
+    sockets = process.bind_sockets(0, '127.0.0.1')
+    assert process.ENVIRON_KEY not in os.environ
+    assert len(sockets) == 1
+    assert sockets[0].getsockname() == sock.getsockname()
+    sockets[0].close()
+    sock.close()
+
+
+def test_drain():
+    io_loop = IOLoop()
+    server = FakeServer()
+    admission = ObjectDict(inflight=1)
+    drain = process.Drain(server, admission, io_loop, timeout=5)
+
+    def finish_request():
+        admission.inflight = 0
+
+    io_loop.add_callback(drain)
+    io_loop.add_timeout(io_loop.time() + 0.1, finish_request)
+    io_loop.start()
+    io_loop.close()
+    assert server.stopped
+    assert io_loop.time() < drain.deadline
+
+
+def test_drain_timeout():
+    io_loop = IOLoop()
+    admission = ObjectDict(inflight=1)
+    drain = process.Drain(FakeServer(), admission, io_loop, timeout=0.1)
+    io_loop.add_callback(drain)
+    io_loop.start()
+    io_loop.close()
+    assert io_loop.time() >= drain.deadline
+
+
+def test_restart_budget():
+    budget = process.RestartBudget(max_restarts=3, window=60)
+    assert [budget.delay(0, now=0) for _ in range(3)] == [0, 1, 3]
+    assert budget.delay(0, now=0) is None
+    assert budget.delay(1, now=0) == 0
+    assert budget.delay(0, now=100) == 0
+
+
+def test_notify_ready():
+    r, w = os.pipe()
+    process._ready_fd = w
+    process.notify_ready()
+    assert os.read(r, 1) == b'.'
+    assert os.read(r, 1) == b''
+    os.close(r)
+    process.notify_ready()
+
+
+def test_reload_waits_for_new_process():
+    io_loop = IOLoop()
+    server = FakeServer()
+    r, w = os.pipe()
+    spawn = process.spawn
+    process.spawn = lambda sockets: (os.getpid() + 10 ** 6, r)
+    try:
+        drain = process.Drain(server, ObjectDict(inflight=0), io_loop)
+        io_loop.add_callback(drain.reload, [])
+        io_loop.add_timeout(io_loop.time() + 0.1,
+                            lambda: server.stopped or process._notify(w))
+        io_loop.start()
+    finally:
+        process.spawn = spawn
+        io_loop.close()
+    assert server.stopped
+
+
+def test_failed_reload_keeps_serving():
+    io_loop = IOLoop()
+    server = FakeServer()
+    r, w = os.pipe()
+    child = subprocess.Popen(['sleep', '10'])
+    spawn = process.spawn
+    process.spawn = lambda sockets: (child.pid, r)
+    try:
+        drain = process.Drain(server, ObjectDict(inflight=0), io_loop,
+                              reload_timeout=0.1)
+        io_loop.add_callback(drain.reload, [])
+        io_loop.add_timeout(io_loop.time() + 0.3, io_loop.stop)
+        io_loop.start()
+    finally:
+        process.spawn = spawn
+        io_loop.close()
+        os.close(w)
+    assert not server.stopped
+    assert child.wait() == -signal.SIGTERM
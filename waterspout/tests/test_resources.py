@@ -0,0 +1,39 @@
+import tornado.gen
+
+from waterspout.app import Waterspout
+from waterspout.web import RequestHandler
+from waterspout.resources import Resources
+
+
+class ResourceHandler(RequestHandler):
+    def get(self):
+        self.write(self.resources.greeting)
+
+
+waterspout = Waterspout(__name__, handlers=[('/', ResourceHandler)])
+closed = []
+
+
+@waterspout.resource('greeting', teardown=closed.append)
+@tornado.gen.coroutine
+def greeting():
+    raise tornado.gen.Return('Hello Resource')
+
+
+def test_resource():
+    client = waterspout.TestClient()
+    assert client.get('/').body == 'Hello Resource'
+    client.close()
+    assert closed == ['Hello Resource']
+
+
+def test_resources_order():
+    calls = []
+    resources = Resources()
+    resources.add('a', lambda: 1, lambda v: calls.append(('a', v)))
+    resources.add('b', lambda: 2, lambda v: calls.append(('b', v)))
+    resources.setup().result()
+    assert resources.a == 1 and resources['b'] == 2
+    resources.teardown().result()
+    assert calls == [('b', 2), ('a', 1)]
+    assert 'a' not in resources
@@ -0,0 +1,80 @@
+from waterspout.sentry import ErrorReporter, fingerprint
+
+
+class StandInClient(object):
+    def __init__(self):
+        self.sent = []
+
+    def build_msg(self, event_type, **kwargs):
+        return dict(event_type=event_type, **kwargs)
+
+    def send(self, **data):
+        self.sent.append(data)
+
+
+def raise_error(message):
+    try:
+        raise ValueError(message)
+    except ValueError:
+        import sys
+        return sys.exc_info()
+
+
+def test_fingerprint():
+    a = fingerprint('captureException', {'exc_info': raise_error('a')})
+    b = fingerprint('captureException', {'exc_info': raise_error('b')})
+    assert a == b
+    assert a.startswith('%s.ValueError:' % ValueError.__module__)
+    assert fingerprint('captureMessage', {'message': 'hi'}) != a
+    assert fingerprint('captureException', {}) == 'captureException'
+
+
+def test_deduplicate():
+    client = StandInClient()
+    reporter = ErrorReporter(client, window=60)
+    for i in range(100):
+        reporter.capture('captureException', exc_info=raise_error(i))
+    assert reporter.capture('captureMessage', message='hi')
+    reporter.flush()
+    assert len(client.sent) == 2
+    assert client.sent[0]['event_type'] == 'raven.events.Exception'
+    assert reporter.stats()['suppressed'] == 99
+
+
+def test_sample():
+    client = StandInClient()
+    reporter = ErrorReporter(client, window=60, sample_rate=1.0)
+    for i in range(3):
+        reporter.capture('captureException', exc_info=raise_error(i))
+    reporter.flush()
+    assert len(client.sent) == 3
+
+    reporter = ErrorReporter(client, window=0)
+    reporter.capture('captureMessage', message='hi')
+    reporter.fingerprints['captureMessage:hi'][1] = 5
+    reporter.fingerprints['captureMessage:hi'][0] -= 1
+    reporter.capture('captureMessage', message='hi')
+    assert reporter.queue[-1]['extra'] == {'waterspout_suppressed': 5}
+
+
+def test_max_sends_and_bounded_queue():
+    client = StandInClient()
+    reporter = ErrorReporter(client, queue_size=5, max_sends=2)
+    for i in range(10):
+        reporter.capture('captureMessage', message=str(i))
+    assert reporter.stats()['dropped'] == 5
+    reporter.flush()
+    assert len(client.sent) == 2
+    reporter.stop()
+    assert len(client.sent) == 5
+    assert not reporter.queue
+
+
+def test_bounded_fingerprints():
+    client = StandInClient()
+    reporter = ErrorReporter(client, window=60, max_fingerprints=100)
+    for i in range(1000):
+        reporter.capture('captureMessage', message='user %d' % i)
+    assert len(reporter.fingerprints) == 100
+    assert 'captureMessage:user 999' in reporter.fingerprints
+    assert 'captureMessage:user 0' not in reporter.fingerprints
@@ -0,0 +1,68 @@
+import tornado.gen
+
+from tornado.ioloop import IOLoop
+
+from waterspout.app import Waterspout
+from waterspout.tasks import TaskQueue, task
+from waterspout.web import RequestHandler
+
+done = []
+
+
+class DeferHandler(RequestHandler):
+    def get(self):
+        self.defer(done.append, self.get_argument('name'))
+        assert done == []
+        self.write('ok')
+
+
+waterspout = Waterspout(__name__, handlers=[('/', DeferHandler)])
+
+
+def test_defer():
+    client = waterspout.TestClient()
+    assert client.get('/?name=whtsky').body == 'ok'
+    client.close()
+    assert done == ['whtsky']
+    assert client.application.tasks.stats()['completed'] == 1
+
+
+def test_priority_and_retries():
+    io_loop = IOLoop()
+    queue = TaskQueue(concurrency=1, retry_delay=0.01)
+    calls = []
+
+    @task(priority=10)
+    def urgent():
+        calls.append('urgent')
+
+    @task(retries=2)
+    @tornado.gen.coroutine
+    def flaky():
+        calls.append('flaky')
+        if calls.count('flaky') < 3:
+            raise ValueError()
+
+    def broken():
+        raise ValueError()
+
+    queue.put(calls.append, ('normal',))
+    queue.put(urgent)
+    queue.put(flaky)
+    queue.put(broken)
+    queue.start(io_loop)
+    io_loop.run_sync(lambda: queue.join(5))
+    io_loop.close()
+
+    assert calls == ['urgent', 'normal', 'flaky', 'flaky', 'flaky']
+    stats = queue.stats()
+    assert stats['completed'] == 3
+    assert stats['failed'] == 1
+    assert stats['retried'] == 2
+
+
+def test_bounded():
+    queue = TaskQueue(max_size=1)
+    assert queue.put(len, ([],))
+    assert not queue.put(len, ([],))
+    assert queue.stats()['dropped'] == 1
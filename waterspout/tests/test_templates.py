@@ -1,5 +1,9 @@
+import tornado.gen
+import tornado.ioloop
+
 from waterspout.app import Waterspout
 from waterspout.web import RequestHandler
+from waterspout.templating import FragmentCache
 
 
 class TestHandler(RequestHandler):
@@ -7,6 +11,24 @@ class TestHandler(RequestHandler):
         self.render("test.html", name="test")
 
 
+class FragmentHandler(RequestHandler):
+    def get(self):
+        self.render("fragment.html", name=self.get_argument("name"))
+
+
+@tornado.gen.coroutine
+def fetch_name(name):
+    io_loop = tornado.ioloop.IOLoop.current()
+    yield tornado.gen.Task(io_loop.add_callback)
+    raise tornado.gen.Return(name)
+
+
+class AsyncTestHandler(RequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        yield self.render_async("test.html", name=fetch_name("async"))
+
+
 def test_jinja():
     waterspout = Waterspout(__name__, handlers=[('/', TestHandler)])
     client = waterspout.TestClient()
@@ -20,3 +42,39 @@ def test_template_path():
     client = waterspout.TestClient()
     body = client.get('/').body
     assert body == "test2"
+
+
+def test_render_async():
+    waterspout = Waterspout(__name__, handlers=[('/', AsyncTestHandler)])
+    client = waterspout.TestClient()
+    body = client.get('/').body
+    assert body == "async"
+
+
+def test_fragment_cache():
+    waterspout = Waterspout(__name__, handlers=[('/', FragmentHandler)],
+                            autoescape=True)
+    client = waterspout.TestClient()
+    assert client.get('/?name=<a>').body.strip() == "<b>&lt;a&gt;</b>"
+    assert client.get('/?name=b').body.strip() == "<b>&lt;a&gt;</b>"
+    stats = client.application.caches['fragments'].stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+
+def test_fragment_cache_stampede():
+    cache = FragmentCache(ttl=60)
+    calls = []
+
+    def render():
+        calls.append(1)
+        return 'fragment %d' % len(calls)
+
+    assert cache.get_or_render('a', 0, render) == 'fragment 1'
+    cache.backend.add('fragment:a:lock', 1)
+    assert cache.get_or_render('a', None, render) == 'fragment 1'
+    assert cache.stale == 1
+    cache.backend.delete('fragment:a:lock')
+    assert cache.get_or_render('a', None, render) == 'fragment 2'
+    assert cache.get_or_render('a', None, render) == 'fragment 2'
+    assert cache.stats()['hits'] == 1
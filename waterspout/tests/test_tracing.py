@@ -0,0 +1,91 @@
+import os
+import json
+import tempfile
+
+from waterspout.app import Waterspout
+from waterspout.web import APIHandler
+from waterspout.tracing import (NULL_TRACE, Tracer, OTLPExporter,
+                                parse_traceparent)
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+collected = []
+
+
+class TraceHandler(APIHandler):
+    def get(self):
+        assert self.current_user == 'whtsky'
+        with self.span('custom', answer=42):
+            headers = self.trace_headers()
+        self.write({'headers': headers})
+
+
+class CollectorHandler(APIHandler):
+    def post(self):
+        collected.append(json.loads(self.request.body.decode('utf-8')))
+
+
+handlers = [('/', TraceHandler), ('/v1/traces', CollectorHandler)]
+
+
+def create(**config):
+    waterspout = Waterspout(__name__, handlers=handlers, cookie_secret='..',
+                            **config)
+    waterspout.user_loader(lambda session: 'whtsky')
+    return waterspout
+
+
+def test_parse_traceparent():
+    assert parse_traceparent('00-%s-%s-01' % (TRACE_ID, PARENT_ID)) == \
+        (TRACE_ID, PARENT_ID, True)
+    assert parse_traceparent('00-abc-def-01') is None
+
+
+def test_jsonl():
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    client = create(tracing_file=path).TestClient()
+    response = client.get('/', headers={
+        'traceparent': '00-%s-%s-01' % (TRACE_ID, PARENT_ID)
+    })
+    assert response.headers['X-Request-Id']
+    headers = json.loads(response.body)['headers']
+    client.close()
+    try:
+        with open(path) as f:
+            spans = dict((span['name'], span)
+                         for span in map(json.loads, f))
+    finally:
+        os.remove(path)
+    root = spans.pop('GET TraceHandler')
+    assert set(spans) == set(['session', 'current_user', 'custom',
+                              'json_encode', 'finish'])
+    assert all(span['trace_id'] == TRACE_ID for span in spans.values())
+    assert root['parent_id'] == PARENT_ID
+    assert root['attributes']['http.status_code'] == 200
+    assert spans['custom']['parent_id'] == root['span_id']
+    assert spans['custom']['attributes'] == {'answer': 42}
+    assert headers['traceparent'] == '00-%s-%s-01' % (
+        TRACE_ID, spans['custom']['span_id']
+    )
+
+
+def test_otlp():
+    client = create().TestClient()
+    assert client.application.tracer is None
+    tracer = Tracer(OTLPExporter(client.get_url('/v1/traces')))
+    client.application.tracer = tracer
+    client.get('/')
+    client.io_loop.add_future(tracer.flush(), client.stop)
+    client.wait()
+    client.close()
+    spans = collected[0]['resourceSpans'][0]['scopeSpans'][0]['spans']
+    assert len(spans) == 6
+    assert len(set(span['traceId'] for span in spans)) == 1
+
+
+def test_disabled():
+    client = create().TestClient()
+    assert json.loads(client.get('/').body)['headers'] == {}
+    assert NULL_TRACE.span('a') is NULL_TRACE.span('b')
+    client.close()
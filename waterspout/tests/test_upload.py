@@ -0,0 +1,99 @@
+import pytest
+
+from waterspout.app import App, Waterspout
+from waterspout.web import UploadHandler
+from waterspout.multipart import MultipartParser
+
+BOUNDARY = '1234'
+BODY = (
+    '--1234\r\n'
+    'Content-Disposition: form-data; name="title"\r\n'
+    '\r\n'
+    'miao\r\n'
+    '--1234\r\n'
+    'Content-Disposition: form-data; name="file"; filename="a.txt"\r\n'
+    'Content-Type: text/plain\r\n'
+    '\r\n'
+    + 'wang' * 100 + '\r\n'
+    '--1234--\r\n'
+).encode('utf-8')
+HEADERS = {'Content-Type': 'multipart/form-data; boundary=1234'}
+
+
+class FileHandler(UploadHandler):
+    max_body_size = 1024
+
+    def check_xsrf_cookie(self):
+        pass
+
+    def post(self):
+        upload = self.files['file'][0]
+        assert upload.filename == 'a.txt'
+        assert upload.content_type == 'text/plain'
+        assert upload.size == 400
+        self.write(self.get_argument('title'))
+        self.write(':%d' % len(upload.read()))
+
+
+class RawHandler(FileHandler):
+    def post(self):
+        self.write(self.body_file.read())
+
+
+waterspout = Waterspout(__name__, handlers=[
+    ('/', FileHandler),
+    ('/raw', RawHandler)
+], upload_spool_size=16, upload_body_limits={'RawHandler': 8})
+
+
+def test_multipart_parser():
+    parser = MultipartParser(BOUNDARY.encode('utf-8'))
+    for i in range(len(BODY)):
+        parser.feed(BODY[i:i + 1])
+    assert parser.complete
+    assert parser.arguments == {'title': [b'miao']}
+    upload = parser.files['file'][0]
+    assert upload.size == 400
+    assert upload.read() == b'wang' * 100
+    parser.close()
+
+
+def test_multipart_parser_invalid():
+    parser = MultipartParser(BOUNDARY.encode('utf-8'))
+    with pytest.raises(ValueError):
+        parser.feed(b'--1234xx')
+
+
+def test_upload():
+    client = waterspout.TestClient()
+    response = client.post('/', headers=HEADERS, body=BODY)
+    assert response.body == 'miao:400'
+
+
+def test_upload_malformed():
+    client = waterspout.TestClient()
+    response = client.post('/', headers=HEADERS,
+                           body=b'--1234xx' + BODY[8:])
+    assert response.code == 400
+    assert client.post('/', headers=HEADERS, body=BODY).body == 'miao:400'
+    client.close()
+
+
+def test_upload_limits():
+    client = waterspout.TestClient()
+    assert client.post('/raw', body='12345678').body == '12345678'
+    assert client.post('/raw', body='123456789').code == 413
+    assert client.post('/', headers=HEADERS, body=BODY * 3).code == 413
+
+
+lazy = App('lazy', __name__, [('/', FileHandler)])
+
+
+def test_lazy_upload():
+    app = Waterspout(__name__)
+    app.register_app('%s:lazy' % __name__, prefix='/lazy')
+    client = app.TestClient()
+    response = client.post('/lazy/', body=BODY, headers=HEADERS)
+    assert response.code == 200
+    assert response.body == 'miao:400'
+    client.close()
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import pytest
+
 
 def test_object_dict():
     from waterspout.utils import ObjectDict
@@ -45,7 +47,95 @@ def test_cached_property():
     assert num.n == num.n
 
 
+def test_cached_falsy_and_futures():
+    from tornado.concurrent import Future
+    from waterspout.utils import cached_property, cached_method
+    calls = []
+
+    class Handler(object):
+        @cached_property
+        def nothing(self):
+            calls.append('nothing')
+
+        @cached_method
+        def load(self, key):
+            calls.append(key)
+            future = Future()
+            if key == 'bad':
+                future.set_exception(ValueError())
+            else:
+                future.set_result(key)
+            return future
+
+    handler = Handler()
+    assert handler.nothing is None and handler.nothing is None
+    assert handler.load('a') is handler.load('a')
+    assert handler.load('a').result() == 'a'
+    handler.load('bad')
+    handler.load('bad')
+    assert calls == ['nothing', 'a', 'bad', 'bad']
+    assert handler.load([]) is not handler.load([])
+
+
 def test_smart_quote():
     from waterspout.utils import smart_quote
     assert smart_quote("http://whouz.com") == "http://whouz.com"
     assert smart_quote("喵.com") == '%E5%96%B5.com'
+    assert smart_quote("/a b?c=喵") == '/a%20b?c=%E5%96%B5'
+
+
+def test_quote_url_arg():
+    from tornado.escape import url_escape
+    from waterspout.utils import quote_url_arg
+    for value in ["abc", "a/b", "a b", "喵", "?&=%", 42]:
+        assert quote_url_arg(value) == url_escape(str(value), plus=False)
+
+
+def test_url_builder():
+    from tornado.web import URLSpec
+    from waterspout.utils import URLBuilder
+    builder = URLBuilder({
+        'user': URLSpec('/user/([^/]+)/(\\d+)', None, name='user'),
+        'index': URLSpec('/', None, name='index'),
+        'complex': URLSpec('/((?:a|b))', None, name='complex')
+    })
+    assert builder('index') == '/'
+    assert builder('user', '喵 a', 1) == '/user/%E5%96%B5%20a/1'
+    with pytest.raises(ValueError):
+        builder('user', 1)
+    with pytest.raises(ValueError):
+        builder('complex', 'a')
+
+
+def test_dump_session():
+    from waterspout.utils import dump_session, load_session
+    small = dump_session({'id': 1})
+    assert small == b'{"id":1}'
+    data = {'data': 'x' * 1000}
+    big = dump_session(data)
+    assert len(big) < 100
+    assert load_session(big) == data
+    assert load_session(small) == {'id': 1}
+
+
+def test_cookie_timestamp():
+    from tornado.web import create_signed_value
+    from waterspout.utils import cookie_timestamp
+    value = create_signed_value('secret', 'name', 'value',
+                                clock=lambda: 1400000000)
+    assert cookie_timestamp(value) == 1400000000
+
+
+def test_lru_cache_sizeof():
+    from waterspout.utils import LRUCache
+    cache = LRUCache(10, sizeof=len)
+    cache['a'] = 'xxxx'
+    cache['b'] = 'xxxx'
+    cache['a']
+    cache['c'] = 'xxxx'
+    assert 'b' not in cache and cache.size == 8
+    cache['a'] = 'x'
+    del cache['c']
+    assert cache.stats()['size'] == 1
+    cache['d'] = 'x' * 11
+    assert len(cache) == 0 and cache.size == 0
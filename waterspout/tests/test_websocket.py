@@ -0,0 +1,104 @@
+import json
+
+from tornado.websocket import websocket_connect
+
+from waterspout.app import Waterspout
+from waterspout.tracing import Tracer
+from waterspout.websocket import WebSocketHandler, websocket_frame
+
+done = []
+
+
+class ChatHandler(WebSocketHandler):
+    def open(self, room):
+        self.subscribe(room)
+        self.write_message({'user': self.current_user})
+
+    def on_message(self, message):
+        self.hub.publish(self.open_args[0], {'message': message})
+
+
+class DeferHandler(WebSocketHandler):
+    def open(self):
+        self.defer(done.append, 'open')
+
+
+waterspout = Waterspout(__name__, handlers=[('/chat/(.*)', ChatHandler),
+                                            ('/defer', DeferHandler)],
+                        cookie_secret='..')
+
+
+@waterspout.user_loader
+def load_user(session):
+    return 'whtsky'
+
+
+def connect(client, path):
+    url = client.get_url(path).replace('http', 'ws', 1)
+    websocket_connect(url, io_loop=client.io_loop, callback=client.stop)
+    return client.wait().result()
+
+
+def read(client, connection):
+    connection.read_message(client.stop)
+    return json.loads(client.wait().result())
+
+
+def test_websocket_frame():
+    assert websocket_frame('hi') == b'\x81\x02hi'
+    assert websocket_frame(b'\x00', binary=True) == b'\x82\x01\x00'
+    assert websocket_frame('a' * 200)[:4] == b'\x81\x7e\x00\xc8'
+
+
+def test_broadcast():
+    client = waterspout.TestClient()
+    hub = client.application.hub
+    alice = connect(client, '/chat/room')
+    bob = connect(client, '/chat/room')
+    eve = connect(client, '/chat/other')
+    assert read(client, alice) == {'user': 'whtsky'}
+    assert read(client, bob) == {'user': 'whtsky'}
+    assert read(client, eve) == {'user': 'whtsky'}
+    assert hub.stats()['connections'] == 3
+    assert client.application.admission.inflight == 0
+
+    alice.write_message('hello')
+    assert read(client, alice) == {'message': 'hello'}
+    assert read(client, bob) == {'message': 'hello'}
+    assert hub.stats()['sent'] == 2
+
+    eve.close()
+    client.io_loop.add_timeout(client.io_loop.time() + 0.1, client.stop)
+    client.wait()
+    assert len(hub.connections) == 2
+    assert 'other' not in hub.channels
+    client.close()
+
+
+def test_slow_consumer():
+    client = waterspout.TestClient()
+    hub = client.application.hub
+    connection = connect(client, '/chat/room')
+    read(client, connection)
+    handler, = hub.connections
+    handler._queued = handler.max_queued_frames
+    assert hub.publish('room', 'hello') == 0
+    assert hub.stats()['disconnected'] == 1
+    client.close()
+
+
+def test_finish_hooks():
+    client = waterspout.TestClient()
+    tracer = client.application.tracer = Tracer(None)
+    connection = connect(client, '/defer')
+    assert not tracer.buffer
+    connection.close()
+    client.io_loop.add_timeout(client.io_loop.time() + 0.1, client.stop)
+    client.wait()
+    assert done == ['open']
+    assert len(tracer.buffer) == 1
+
+    # A failed handshake is finished by Tornado too.
+    assert client.get('/defer').code == 400
+    assert len(tracer.buffer) == 2
+    client.close()
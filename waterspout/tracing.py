@@ -0,0 +1,354 @@
+"""
+Per-request tracing.
+
+Every traced request gets a :class:`Trace` holding a root span and a span
+for each phase: session decoding, user loading, rendering, JSON encoding
+and finishing the response.  Handlers add their own spans with
+``self.span(name)``.  Incoming W3C ``traceparent`` headers are continued,
+and ``self.trace_headers()`` returns the headers to send to other
+services.
+"""
+
+import time
+import json
+import random
+import logging
+
+from collections import deque
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+
+def _new_id(bits=64):
+    return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+
+def parse_traceparent(header):
+    """
+    Parse a W3C ``traceparent`` header.
+
+    :return: a ``(trace_id, parent_id, sampled)`` tuple, or ``None``.
+    """
+    parts = header.strip().split('-')
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+class Span(object):
+    """
+    A timed operation.  Use it as a context manager ::
+
+        with self.span('db.query', table='users'):
+            users = db.query(...)
+    """
+    __slots__ = ('trace', 'name', 'span_id', 'parent_id', 'start', 'end',
+                 'attributes')
+
+    def __init__(self, trace, name, parent_id, attributes):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.start = None
+        self.end = None
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.start = time.time()
+        self.trace._stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.end = time.time()
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        stack = self.trace._stack
+        if stack and stack[-1] is self:
+            stack.pop()
+        self.trace.spans.append(self)
+
+    def to_dict(self):
+        return dict(trace_id=self.trace.trace_id, span_id=self.span_id,
+                    parent_id=self.parent_id, name=self.name,
+                    start=self.start, end=self.end,
+                    duration=round(1000.0 * (self.end - self.start), 3),
+                    attributes=self.attributes)
+
+
+class Trace(object):
+    """
+    The spans of one request.
+
+    :param trace_id: the ID of the trace, continued from the client or new.
+    :param parent_id: (optional) the span ID of the client.
+    :param name: name of the root span.
+    :param start: when the request started, as a timestamp.
+    """
+
+    def __init__(self, trace_id, parent_id, name, start, attributes):
+        self.trace_id = trace_id
+        self.spans = []
+        self.root = Span(self, name, parent_id, attributes)
+        self.root.start = start
+        self._stack = [self.root]
+
+    def span(self, name, **attributes):
+        """
+        Return a new :class:`Span`, child of the current span.
+        """
+        return Span(self, name, self._stack[-1].span_id, attributes)
+
+    def headers(self):
+        """
+        Return the headers propagating this trace to another service.
+        """
+        return {'traceparent': '00-%s-%s-01' % (self.trace_id,
+                                                self._stack[-1].span_id)}
+
+    def finish(self, **attributes):
+        self.root.attributes.update(attributes)
+        self.root.end = time.time()
+        self.spans.append(self.root)
+
+
+class NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+class NullTrace(object):
+    """
+    The trace of requests which aren't traced.  Its spans do nothing.
+    """
+    trace_id = None
+    _span = NullSpan()
+
+    def span(self, name, **attributes):
+        return self._span
+
+    def headers(self):
+        return {}
+
+    def finish(self, **attributes):
+        pass
+
+
+NULL_TRACE = NullTrace()
+
+
+class JSONLinesExporter(object):
+    """
+    Writes spans to a file as JSON lines.
+
+    :param path: the path of the file.
+    :param executor:
+      (optional) an :class:`~waterspout.executor.ExecutorPool` writing the
+      file, so the IOLoop doesn't wait for the disk.
+    """
+
+    def __init__(self, path, executor=None):
+        self.path = path
+        self.executor = executor
+
+    def export(self, traces):
+        lines = [json.dumps(span.to_dict(), separators=(',', ':'))
+                 for trace in traces for span in trace.spans]
+        if self.executor is not None:
+            return self.executor.submit(self._write, lines)
+        self._write(lines)
+
+    def _write(self, lines):
+        with open(self.path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+class OTLPExporter(object):
+    """
+    Sends spans to an OpenTelemetry collector, with the JSON encoding of
+    the OTLP/HTTP protocol.
+
+    :param endpoint: the URL of the collector, like
+      ``http://127.0.0.1:4318/v1/traces``.
+    :param service_name: the ``service.name`` of the spans.
+    :param headers: (optional) headers to send, for authentication.
+    """
+
+    def __init__(self, endpoint, service_name='waterspout', headers=None):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.headers = headers or {}
+
+    def encode(self, traces):
+        spans = []
+        for trace in traces:
+            for span in trace.spans:
+                encoded = {
+                    'traceId': trace.trace_id,
+                    'spanId': span.span_id,
+                    'name': span.name,
+                    'kind': 2 if span is trace.root else 1,
+                    'startTimeUnixNano': str(int(span.start * 1e9)),
+                    'endTimeUnixNano': str(int(span.end * 1e9)),
+                    'attributes': [
+                        {'key': k, 'value': _otlp_value(v)}
+                        for k, v in span.attributes.items() if v is not None
+                    ]
+                }
+                if span.parent_id:
+                    encoded['parentSpanId'] = span.parent_id
+                spans.append(encoded)
+        return json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{
+                'key': 'service.name',
+                'value': {'stringValue': self.service_name}
+            }]},
+            'scopeSpans': [{'scope': {'name': 'waterspout'}, 'spans': spans}]
+        }]})
+
+    def export(self, traces):
+        from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+        headers = {'Content-Type': 'application/json'}
+        headers.update(self.headers)
+        return AsyncHTTPClient().fetch(HTTPRequest(
+            self.endpoint, method='POST', headers=headers,
+            body=self.encode(traces)
+        ))
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class Tracer(object):
+    """
+    Starts a trace for every sampled request, and exports finished traces
+    in batches every ``flush_interval`` seconds.
+
+    It is configured with these settings:
+
+    ``tracing_file``
+      path of a JSON lines file spans are written to.
+    ``tracing_endpoint``
+      URL of an OTLP/HTTP collector spans are sent to.
+    ``tracing_sample_rate``
+      the share of requests traced, 1 by default.  Requests whose
+      ``traceparent`` header is sampled are always traced.
+    ``tracing_service_name``
+      the service name sent to the collector.
+
+    :param exporter: an object whose ``export(traces)`` method exports
+      traces, and may return a future.
+    """
+
+    def __init__(self, exporter, sample_rate=1.0, flush_interval=1.0,
+                 buffer_size=10000):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+        self.flush_interval = flush_interval
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        self.exported = 0
+        self.dropped = 0
+        self._periodic = None
+
+    def start_trace(self, handler):
+        """
+        Return the trace of a request, or :data:`NULL_TRACE`.
+        """
+        request = handler.request
+        parent = request.headers.get('traceparent')
+        parent = parent and parse_traceparent(parent)
+        if parent is not None:
+            trace_id, parent_id, sampled = parent
+        else:
+            trace_id, parent_id, sampled = None, None, None
+        if not sampled and random.random() >= self.sample_rate:
+            return NULL_TRACE
+        handler.set_header('X-Request-Id', handler.request_id)
+        return Trace(
+            trace_id or _new_id(128), parent_id,
+            '%s %s' % (request.method, handler.__class__.__name__),
+            request._start_time, {
+                'http.method': request.method,
+                'http.target': request.uri,
+                'request_id': handler.request_id
+            }
+        )
+
+    def finish_trace(self, trace, handler):
+        """
+        Finish the trace of a request, and queue it for export.
+        """
+        if trace is NULL_TRACE:
+            return
+        trace.finish(**{'http.status_code': handler.get_status()})
+        if len(self.buffer) >= self.buffer_size:
+            self.dropped += 1
+            return
+        self.buffer.append(trace)
+
+    def flush(self):
+        """
+        Export the finished traces.
+
+        :return: the result of the exporter, which may be a future.
+        """
+        if not self.buffer:
+            return
+        traces = list(self.buffer)
+        self.buffer.clear()
+        try:
+            result = self.exporter.export(traces)
+        except Exception:
+            logging.exception("Failed to export traces")
+            return
+        self.exported += len(traces)
+        if result is not None:
+            IOLoop.current().add_future(result, self._exported)
+        return result
+
+    def _exported(self, future):
+        if future.exception() is not None:
+            logging.warning("Failed to export traces: %s" % future.exception())
+
+    def start(self, io_loop=None):
+        self._periodic = PeriodicCallback(
+            self.flush, self.flush_interval * 1000,
+            io_loop=io_loop or IOLoop.current()
+        )
+        self._periodic.start()
+        return self
+
+    def stop(self):
+        """
+        Stop exporting periodically, and export the remaining traces.
+        """
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+        return self.flush()
+
+    def stats(self):
+        """
+        Return a dictionary describing the tracer.
+        """
+        return dict(buffered=len(self.buffer), exported=self.exported,
+                    dropped=self.dropped)
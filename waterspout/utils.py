@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
+import json
+import time
+import zlib
+import logging
 import pkgutil
+import functools
 
-from tornado.escape import json_encode, json_decode
+from collections import OrderedDict
+
+from tornado.concurrent import is_future
+from tornado.escape import json_decode, utf8
 
 try:  # Py3k
     from urllib.parse import quote
@@ -34,6 +43,17 @@ def to_unicode(value):
     return value
 
 
+_UNSAFE = re.compile('[^%s]' % re.escape(UNQUOTE))
+_QUOTE_TABLE = [chr(i) if chr(i) in UNQUOTE else '%%%02X' % i
+                for i in range(256)]
+
+_URL_ARG_SAFE = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ' \
+                '0123456789_.-~/'
+_URL_ARG = re.compile('^[%s]*$' % re.escape(_URL_ARG_SAFE))
+_URL_ARG_TABLE = [chr(i) if chr(i) in _URL_ARG_SAFE else '%%%02X' % i
+                  for i in range(256)]
+
+
 def smart_quote(url):
     """
     Like urllib.parse.quote, but quote non-ascii words only.
@@ -42,8 +62,78 @@ def smart_quote(url):
         smart_quote("http://whouz.com")  # http://whouz.com
         smart_quote("喵.com")  # %E5%96%B5.com
     """
-    l = [s if s in UNQUOTE else quote(s) for s in url]
-    return ''.join(l)
+    if not _UNSAFE.search(url):
+        return url
+    if isinstance(url, unicode):
+        url = url.encode('utf-8')
+    return ''.join([_QUOTE_TABLE[b] for b in bytearray(url)])
+
+
+def quote_url_arg(value):
+    """
+    Quote a value to be used in a URL path, like
+    ``tornado.escape.url_escape(value, plus=False)``.
+    """
+    if isinstance(value, int):
+        return str(value)
+    if not isinstance(value, (unicode, bytes)):
+        value = str(value)
+    if isinstance(value, unicode):
+        if _URL_ARG.match(value):
+            return value
+        value = value.encode('utf-8')
+    return ''.join([_URL_ARG_TABLE[b] for b in bytearray(value)])
+
+
+def reverse_format(regex):
+    """
+    Return the format string building the paths matched by a compiled URL
+    pattern, and its number of arguments, or ``(None, None)`` if the
+    pattern is too complex to be reversed.
+    """
+    pattern = regex.pattern
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    if pattern.endswith('$'):
+        pattern = pattern[:-1]
+    if regex.groups != pattern.count('('):
+        return None, None
+    pieces = []
+    for fragment in pattern.split('('):
+        if ')' in fragment:
+            pieces.append('%s' + fragment[fragment.index(')') + 1:])
+        else:
+            pieces.append(fragment)
+    return ''.join(pieces), regex.groups
+
+
+class URLBuilder(object):
+    """
+    Builds URLs of named handlers from format strings compiled once ::
+
+        builder = URLBuilder(application.named_handlers)
+        builder('user', 42)  # /user/42
+
+    :param named_handlers: a dictionary mapping names to URLSpecs.
+    """
+
+    def __init__(self, named_handlers):
+        self.formats = {}
+        for name, spec in named_handlers.items():
+            self.formats[name] = reverse_format(spec.regex)
+
+    def __call__(self, name, *args):
+        try:
+            path, group_count = self.formats[name]
+        except KeyError:
+            raise KeyError("%s not found in named urls" % name)
+        if path is None:
+            raise ValueError("Cannot reverse url %s" % name)
+        if len(args) != group_count:
+            raise ValueError("required number of arguments not found")
+        if not args:
+            return path
+        return path % tuple([quote_url_arg(arg) for arg in args])
 
 
 class ObjectDict(dict):
@@ -68,6 +158,105 @@ class ObjectDict(dict):
         del self[name]
 
 
+class LRUCache(object):
+    """
+    A dictionary-like object holding at most ``capacity`` items.
+    The least recently used item is dropped when the cache is full ::
+
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache['a']
+        cache['c'] = 3
+        assert 'b' not in cache
+
+    When ``sizeof`` is given, ``capacity`` bounds the sum of the sizes of
+    the items instead of their number.
+
+    :param capacity: the maximum number of items, or their maximum size.
+    :param sizeof: (optional) a function returning the size of an item.
+    """
+
+    def __init__(self, capacity, sizeof=None):
+        self.capacity = capacity
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._size = 0
+
+    @property
+    def size(self):
+        """
+        The number of items, or the sum of their sizes.
+        """
+        if self.sizeof is None:
+            return len(self._data)
+        return self._size
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, _missing)
+        if value is _missing:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        data = self._data
+        old = data.pop(key, _missing)
+        data[key] = value
+        if self.sizeof is None:
+            if len(data) > self.capacity:
+                data.popitem(last=False)
+            return
+        if old is not _missing:
+            self._size -= self.sizeof(old)
+        self._size += self.sizeof(value)
+        while self._size > self.capacity and data:
+            self._size -= self.sizeof(data.popitem(last=False)[1])
+
+    def __delitem__(self, key):
+        if self.pop(key, _missing) is _missing:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, default=None):
+        value = self._data.pop(key, _missing)
+        if value is _missing:
+            return default
+        if self.sizeof is not None:
+            self._size -= self.sizeof(value)
+        return value
+
+    def clear(self):
+        self._data.clear()
+        self._size = 0
+
+    def stats(self):
+        """
+        Return a dictionary describing the usage of this cache.
+        """
+        return dict(size=self.size, capacity=self.capacity,
+                    hits=self.hits, misses=self.misses)
+
+
+_missing = object()
+
+
 def get_root_path(import_name):
     """
     Returns the path to a package or cwd if that cannot be found.  This
@@ -103,6 +292,12 @@ class cached_property(object):
                 # calculate something important here
                 return 42
 
+    Any result is cached, including ``None``.  A handler lives for one
+    request, so properties of handlers are cached for one request.
+    If the function returns a future, the future is cached, so concurrent
+    coroutines yielding the property share one call; a failed future is
+    forgotten, so the next access calls the function again.
+
     The class has to have a `__dict__` in order for this property to
     work.
     """
@@ -116,13 +311,182 @@ class cached_property(object):
     def __get__(self, obj, type=None):
         if obj is None:
             return self
-        value = obj.__dict__.get(self.__name__, None)
-        if value is None:
+        value = obj.__dict__.get(self.__name__, _missing)
+        if value is _missing:
             value = self.func(obj)
             obj.__dict__[self.__name__] = value
+            if is_future(value):
+                _forget_failure(obj.__dict__, self.__name__, value)
         return value
 
 
+def cached_method(method):
+    """
+    A decorator caching the results of a method per instance and
+    arguments.  Like :class:`cached_property`, any result is cached, and
+    futures are shared until they fail ::
+
+        class PostHandler(RequestHandler):
+            @cached_method
+            @tornado.gen.coroutine
+            def load_post(self, post_id):
+                post = yield db.get_post(post_id)
+                raise tornado.gen.Return(post)
+
+    Calls with unhashable arguments are not cached.
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = self.__dict__.get('_cached_methods')
+        if cache is None:
+            cache = self.__dict__['_cached_methods'] = {}
+        key = (name, args, tuple(sorted(kwargs.items())) if kwargs else ())
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            return method(self, *args, **kwargs)
+        value = cache[key] = method(self, *args, **kwargs)
+        if is_future(value):
+            _forget_failure(cache, key, value)
+        return value
+    return wrapper
+
+
+def _forget_failure(cache, key, future):
+    def forget(future):
+        if future.exception() is not None and cache.get(key) is future:
+            del cache[key]
+    future.add_done_callback(forget)
+
+
+SESSION_COOKIE = "__waterspout_sessions__"
+
+
+def dump_session(data, compress_threshold=512):
+    """
+    Serialize session data as compact JSON, compressed with zlib when
+    longer than ``compress_threshold`` bytes.
+    """
+    value = utf8(json.dumps(data, separators=(',', ':')))
+    if len(value) > compress_threshold:
+        value = zlib.compress(value)
+    return value
+
+
+def load_session(value):
+    """
+    Load session data serialized by :func:`dump_session`.
+    """
+    return json_decode(_session_json(value))
+
+
+def _session_json(value):
+    if value[:1] != b'{':
+        value = zlib.decompress(value)
+    return value
+
+
+def copy_json(value):
+    """
+    Copy the lists and dictionaries of a JSON value.
+    """
+    if isinstance(value, dict):
+        return dict((k, copy_json(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [copy_json(v) for v in value]
+    return value
+
+
+def cookie_timestamp(value):
+    """
+    Return the timestamp of a signed cookie value, in seconds.
+    """
+    value = utf8(value)
+    if value.startswith(b'2|'):
+        # 2|key_version|timestamp|name|value|signature, where each field
+        # but the signature is prefixed with its length.
+        rest = value[2:]
+        for _ in range(2):
+            length, rest = rest.split(b':', 1)
+            field, rest = rest[:int(length)], rest[int(length) + 1:]
+        return int(field)
+    return int(value.split(b'|')[1])
+
+
+class SessionCache(object):
+    """
+    Remembers verified session cookies, so a client sending the same
+    cookie again doesn't pay for its signature check, decompression and
+    parsing.
+
+    Entries are keyed by the raw cookie value.  An entry is used only if
+    the other chunks of the session are the same, ``cookie_secret``
+    didn't change, and the cookie hasn't expired.  The decoded session is
+    cached: a session reading it gets a shallow copy, in which only the
+    lists and dictionaries are copied, so changing a session doesn't
+    change the cache.
+
+    :param max_bytes:
+      the total size of the cached cookies and sessions, sessions counting
+      for the size of their JSON text.
+    :param max_age_days: the age of expired cookies, in days.
+    """
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_age_days=31):
+        self._data = LRUCache(max_bytes, sizeof=lambda entry: entry[0])
+        self.max_age = max_age_days * 86400
+
+    def get(self, handler, raw):
+        """
+        Return the entry of a raw cookie, or ``None``.
+        """
+        entry = self._data.get(raw)
+        if entry is None:
+            return None
+        _, secret, expires, others, value = entry
+        if (secret != handler.settings.get('cookie_secret') or
+                expires <= time.time()):
+            self._data.pop(raw)
+            return None
+        for i, other in enumerate(others, 1):
+            if handler.get_cookie(SESSION_COOKIE + str(i)) != other:
+                return None
+        return value
+
+    def set(self, handler, raw, value, size=0):
+        """
+        Cache ``value`` for a raw cookie, verified by ``handler``.
+
+        :param size: the size of ``value``, in bytes.
+        """
+        chunks = value[-1]
+        others = tuple(handler.get_cookie(SESSION_COOKIE + str(i))
+                       for i in range(1, chunks))
+        size += len(raw) + sum(len(o or '') for o in others)
+        self._data[raw] = (size, handler.settings.get('cookie_secret'),
+                           cookie_timestamp(raw) + self.max_age,
+                           others, value)
+
+    def invalidate(self, raw):
+        """
+        Forget the entry of a raw cookie, so it is verified again.
+        """
+        self._data.pop(raw)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return self._data.stats()
+
+
 class Session(ObjectDict):
     """
     The session object works pretty much like an ordinary dict ::
@@ -131,6 +495,18 @@ class Session(ObjectDict):
         print(session['name'])
         session.id = 6
 
+    Sessions are stored in signed cookies as compact JSON, compressed
+    when longer than the ``session_compress_threshold`` setting (512 bytes
+    by default), and split across numbered cookies when longer than the
+    ``session_cookie_size`` setting (2800 bytes by default, which
+    keeps signed cookies under 4KB).
+    A warning is logged for sessions longer than the
+    ``session_size_budget`` setting.
+
+    Cookies are only sent again when the session changes, or when they
+    are older than the ``session_refresh_interval`` setting (one day by
+    default).
+
     .. attention ::
       Session requires ``cookie_secret`` setting.
 
@@ -138,13 +514,63 @@ class Session(ObjectDict):
     """
 
     def __init__(self, handler):
-        self.__handler = handler
+        self.__dict__['_handler'] = handler
+        self.__dict__['_chunks'] = 0
+        self.__dict__['_value'] = None
+        self.__dict__['_timestamp'] = 0
 
         super(ObjectDict, self).__init__()
 
-        sessions = handler.get_secure_cookie("__waterspout_sessions__")
-        if sessions:
-            self.update(**json_decode(sessions))
+        raw = handler.get_cookie(SESSION_COOKIE)
+        if not raw:
+            return
+        cache = getattr(handler.application, 'session_cache', None)
+        if cache is not None:
+            entry = cache.get(handler, raw)
+            if entry is not None:
+                data, nested, value, timestamp, chunks = entry
+                self.update(data)
+                for key in nested:
+                    self[key] = copy_json(data[key])
+                self.__dict__.update(_value=value, _timestamp=timestamp,
+                                     _chunks=chunks)
+                return
+
+        value = handler.get_secure_cookie(SESSION_COOKIE, raw)
+        if value:
+            try:
+                value = self._join(value)
+                text = _session_json(value)
+                data = json_decode(text)
+            except (ValueError, zlib.error):
+                logging.warning("Invalid session cookie from %s" %
+                                handler.request.remote_ip)
+                return
+            self.update(data)
+            timestamp = cookie_timestamp(raw)
+            self.__dict__.update(_value=value, _timestamp=timestamp)
+            if cache is not None:
+                nested = tuple(key for key, item in data.items()
+                               if isinstance(item, (dict, list)))
+                cache.set(handler, raw, (copy_json(data), nested, value,
+                                         timestamp, self._chunks),
+                          len(value) + len(text))
+
+    def _join(self, value):
+        handler = self._handler
+        chunks = 1
+        if value[:1] == b'#':
+            _, chunks, value = value.split(b'#', 2)
+            chunks = int(chunks)
+            parts = [value]
+            for i in range(1, chunks):
+                part = handler.get_secure_cookie(SESSION_COOKIE + str(i))
+                if part is None:
+                    raise ValueError("Session cookie %d is missing" % i)
+                parts.append(part)
+            value = b''.join(parts)
+        self.__dict__['_chunks'] = chunks
+        return value
 
     def __getitem__(self, item):
         if item in self:
@@ -152,10 +578,30 @@ class Session(ObjectDict):
         return None
 
     def save(self):
-        handler = self.__handler
-        del self.__handler
-        sessions = json_encode(self)
-        handler.set_secure_cookie("__waterspout_sessions__", sessions)
+        handler = self.__dict__.pop('_handler')
+        settings = handler.settings
+        value = dump_session(
+            self, settings.get('session_compress_threshold', 512)
+        )
+        budget = settings.get('session_size_budget', None)
+        if budget and len(value) > budget:
+            logging.warning("Session of %d bytes exceeds the budget of %d "
+                            "bytes: %s" % (len(value), budget,
+                                           ', '.join(sorted(self.keys()))))
+
+        if value == self._value and time.time() - self._timestamp < \
+                settings.get('session_refresh_interval', 86400):
+            return
+
+        size = settings.get('session_cookie_size', 2800)
+        chunks = [value[i:i + size] for i in range(0, len(value), size)]
+        if len(chunks) > 1:
+            chunks[0] = b'#' + utf8(str(len(chunks))) + b'#' + chunks[0]
+        handler.set_secure_cookie(SESSION_COOKIE, chunks[0])
+        for i in range(1, len(chunks)):
+            handler.set_secure_cookie(SESSION_COOKIE + str(i), chunks[i])
+        for i in range(len(chunks), self._chunks):
+            handler.clear_cookie(SESSION_COOKIE + str(i))
 
 
 def import_string(import_name, silent=False):
@@ -182,8 +628,8 @@ def import_string(import_name, silent=False):
         else:
             return __import__(import_name)
         # __import__ is not able to handle unicode strings in the fromlist
-        # if the module is a package
-        if isinstance(obj, unicode):
+        # if the module is a package (Python 2 only)
+        if bytes is str and isinstance(obj, unicode):
             obj = obj.encode('utf-8')
         try:
             return getattr(__import__(module, None, None, [obj]), obj)
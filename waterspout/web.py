@@ -1,8 +1,24 @@
+import time
+import zlib
+import uuid
+import logging
+import calendar
+import datetime
+import tempfile
+import functools
+import email.utils
+
 import waterspout
+import tornado.gen
 import tornado.web
 import tornado.escape
+import tornado.httputil
+
+from tornado.concurrent import is_future
 
 from waterspout.utils import Session
+from waterspout.tracing import NULL_TRACE
+from waterspout.multipart import MultipartParser
 
 try:
     from raven.contrib.tornado import SentryMixin
@@ -11,6 +27,49 @@ except ImportError:
     SentryMixin = object
 
 
+CHECKSUMS = {
+    'crc32': (zlib.crc32, 0),
+    'adler32': (zlib.adler32, 1),
+}
+ETAG_HASHES = frozenset(['sha1']) | frozenset(CHECKSUMS)
+
+
+def conditional(etag=None, last_modified=None):
+    """
+    Decorator to answer conditional GET requests before the handler
+    method runs.  The functions are called with the handler and the
+    arguments of the method, and return a cheap version of the resource ::
+
+        class PostHandler(RequestHandler):
+            @conditional(etag=lambda self, post_id: get_version(post_id))
+            def get(self, post_id):
+                self.render('post.html', post=Post.get(post_id))
+
+    If the client already has this version, a 304 response is sent and
+    the method never runs.  Otherwise, the version is sent in the
+    ``Etag`` and ``Last-Modified`` headers, and no hash of the body is
+    computed.
+
+    :param etag: (optional) function returning the ETag.
+    :param last_modified:
+      (optional) function returning the modification time, as a datetime
+      or a timestamp.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.check_version(
+                etag=etag and etag(self, *args, **kwargs),
+                last_modified=last_modified and last_modified(
+                    self, *args, **kwargs
+                )
+            ):
+                return
+            return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 class WaterspoutHandler(tornado.web.RequestHandler, SentryMixin):
     """
     The most basic RequestHandler for Waterspout.
@@ -19,14 +78,130 @@ class WaterspoutHandler(tornado.web.RequestHandler, SentryMixin):
     def __init__(self, *args, **kwargs):
         super(WaterspoutHandler, self).__init__(*args, **kwargs)
         self.subdomain = self.request.host.split(".")[0]
+        tracer = getattr(self.application, 'tracer', None)
+        if tracer is not None:
+            self._trace = tracer.start_trace(self)
+
+    _trace = NULL_TRACE
+    _memory_snapshot = None
+    _admitted = False
+    _request_id = None
+    _deferred = None
 
     def set_default_headers(self):
         self._headers["Server"] = waterspout.server_name
 
+    def prepare(self):
+        """
+        Admit the request, or finish it with a cheap 429 or 503 response
+        when the client is rate limited or the worker is overloaded.
+        Nothing else (session, current user, templates) is touched before.
+        Admitted requests may then be sampled by the memory profiler.
+
+        Call ``super().prepare()`` if you override this method.
+        """
+        admission = getattr(self.application, 'admission', None)
+        if admission is not None:
+            rejected = admission.admit(self)
+            if rejected is not None:
+                status, headers = rejected
+                self.set_status(status)
+                for name, value in headers.items():
+                    self.set_header(name, value)
+                self.finish()
+                return
+            self._admitted = True
+        profiler = getattr(self.application, 'memory_profiler', None)
+        if profiler is not None:
+            self._memory_snapshot = profiler.begin(self)
+
+    def check_version(self, etag=None, last_modified=None):
+        """
+        Send the given version of the resource in the ``Etag`` and
+        ``Last-Modified`` headers, and finish the request with a 304
+        response if the client already has this version.
+
+        :param etag: (optional) the ETag of the resource.
+        :param last_modified:
+          (optional) the modification time of the resource, as a datetime
+          or a timestamp.
+        :return: ``True`` if a 304 response is sent.
+        """
+        if etag is not None:
+            etag = str(etag)
+            if not etag.startswith(('"', 'W/"')):
+                etag = '"%s"' % etag
+            self.set_header("Etag", etag)
+        if last_modified is not None:
+            if not isinstance(last_modified, datetime.datetime):
+                last_modified = datetime.datetime.utcfromtimestamp(
+                    last_modified
+                )
+            last_modified = last_modified.replace(microsecond=0)
+            self.set_header("Last-Modified", last_modified)
+        if self.request.method not in ("GET", "HEAD"):
+            return False
+
+        not_modified = False
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            if etag is not None:
+                tags = [tag.strip() for tag in if_none_match.split(",")]
+                not_modified = '*' in tags or etag.replace('W/', '') in [
+                    tag.replace('W/', '') for tag in tags
+                ]
+        elif last_modified is not None:
+            since = self.request.headers.get("If-Modified-Since")
+            date_tuple = since and email.utils.parsedate(since)
+            if date_tuple:
+                since = datetime.datetime.utcfromtimestamp(
+                    calendar.timegm(date_tuple)
+                )
+                not_modified = last_modified <= since
+        if not_modified:
+            self.set_status(304)
+            self.finish()
+        return not_modified
+
+    def compute_etag(self):
+        """
+        Compute the ETag of the body with the ``etag_hash`` setting:
+        ``sha1`` (the default), the faster ``crc32`` or ``adler32``, or
+        ``None`` to disable ETags.  Other values are refused when the
+        application is built.
+        """
+        algorithm = self.settings.get('etag_hash', 'sha1')
+        if algorithm == 'sha1':
+            return super(WaterspoutHandler, self).compute_etag()
+        if algorithm is None:
+            return None
+        checksum, value = CHECKSUMS[algorithm]
+        for part in self._write_buffer:
+            value = checksum(part, value)
+        return '"%08x"' % (value & 0xffffffff)
+
+    def _release(self):
+        if self._admitted:
+            self._admitted = False
+            self.application.admission.release(self)
+
+    def on_connection_close(self):
+        self._release()
+        if self._memory_snapshot is not None:
+            self._memory_snapshot = None
+            self.application.memory_profiler.discard()
+        super(WaterspoutHandler, self).on_connection_close()
+
     def _capture(self, call_name, data=None, **kwargs):
-        if not self.get_sentry_client():
+        reporter = getattr(self.application, 'error_reporter', None)
+        if reporter is None:
             return
-        super(SentryMixin, self)._capture(self, call_name, data, **kwargs)
+        context = self.get_default_context()
+        if isinstance(data, dict):
+            context.update(data)
+        elif data is not None:
+            context['extra']['extra_data'] = data
+        return reporter.capture(call_name, data=context, **kwargs)
 
     @property
     def session(self):
@@ -45,15 +220,219 @@ class WaterspoutHandler(tornado.web.RequestHandler, SentryMixin):
           Session requires ``cookie_secret`` setting.
         """
         if not hasattr(self, '_session'):
-            self._session = Session(self)
+            with self._trace.span('session'):
+                self._session = Session(self)
 
         return self._session
 
+    def get_current_user(self):
+        user_loader = self.application._user_loader
+        if user_loader:
+            session = self.session
+            with self._trace.span('current_user'):
+                return user_loader(session)
+
+    def span(self, name, **attributes):
+        """
+        Return a span of the trace of this request, timing a block of
+        code ::
+
+            with self.span('db.query', table='users'):
+                users = db.query(...)
+
+        It does nothing when the request isn't traced.
+        """
+        return self._trace.span(name, **attributes)
+
+    def trace_headers(self):
+        """
+        Return the headers continuing the trace of this request in another
+        service, like ``{'traceparent': ...}``.
+        """
+        return self._trace.headers()
+
+    @property
+    def request_id(self):
+        """
+        ID of the current request, taken from the ``X-Request-Id`` header
+        or generated.
+        """
+        if self._request_id is None:
+            self._request_id = self.request.headers.get("X-Request-Id") or \
+                uuid.uuid4().hex
+        return self._request_id
+
+    def get_browser_locale(self, default="en_US"):
+        """
+        Determine the user's locale from the ``Accept-Language`` header.
+        Results are cached per header value.
+        """
+        cache = getattr(self.application, 'locale_cache', None)
+        header = self.request.headers.get("Accept-Language")
+        if cache is None or not header:
+            return super(WaterspoutHandler, self).get_browser_locale(default)
+        key = (header, default)
+        locale = cache.get(key)
+        if locale is None:
+            locale = super(WaterspoutHandler, self).get_browser_locale(default)
+            cache[key] = locale
+        return locale
+
+    def reverse_url(self, name, *args):
+        """
+        Alias for `Waterspout.reverse_url`, using format strings compiled
+        when the application is built.
+        """
+        url_builder = getattr(self.application, 'url_builder', None)
+        if url_builder is None:
+            return super(WaterspoutHandler, self).reverse_url(name, *args)
+        return url_builder(name, *args)
+
+    @property
+    def resources(self):
+        """
+        Application-scoped resources added with
+        :meth:`Waterspout.add_resource
+        <waterspout.app.Waterspout.add_resource>`.
+        """
+        return self.application.resources
+
+    def run_in_executor(self, fn, *args, **kwargs):
+        """
+        Run ``fn(*args, **kwargs)`` on the ``default`` thread pool and
+        return a future, so blocking calls don't freeze the IOLoop ::
+
+            class HashHandler(RequestHandler):
+                @tornado.gen.coroutine
+                def post(self):
+                    hashed = yield self.run_in_executor(
+                        bcrypt.hashpw, self.get_argument('password'), salt
+                    )
+
+        Use ``self.application.executors[name].submit`` for other pools.
+        """
+        return self.application.executors['default'].submit(
+            fn, *args, **kwargs
+        )
+
+    def defer(self, fn, *args, **kwargs):
+        """
+        Run ``fn(*args, **kwargs)`` in the task queue of the application
+        once the response is sent, so it doesn't add to its latency ::
+
+            class CommentHandler(RequestHandler):
+                def post(self):
+                    comment = Comment.create(self.get_argument('text'))
+                    self.defer(notify_subscribers, comment.id)
+                    self.redirect('/')
+
+        ``fn`` may be a coroutine, and may be decorated with
+        :func:`~waterspout.tasks.task` to set its priority and retries.
+        """
+        if self._deferred is None:
+            self._deferred = []
+        self._deferred.append((fn, args, kwargs))
+
     def finish(self, chunk=None):
         """Finishes this response, ending the HTTP request."""
         if hasattr(self, '_session'):
             self.session.save()
-        super(WaterspoutHandler, self).finish(chunk)
+        try:
+            with self._trace.span('finish'):
+                super(WaterspoutHandler, self).finish(chunk)
+        finally:
+            self._end_request()
+        self._run_deferred()
+
+    def _end_request(self):
+        self._release()
+        if self._trace is not NULL_TRACE:
+            self.application.tracer.finish_trace(self._trace, self)
+            self._trace = NULL_TRACE
+        if self._memory_snapshot is not None:
+            snapshot, self._memory_snapshot = self._memory_snapshot, None
+            self.application.memory_profiler.end(self, snapshot)
+
+    def _run_deferred(self):
+        if self._deferred:
+            tasks = self.application.tasks
+            for fn, args, kwargs in self._deferred:
+                tasks.put(fn, args, kwargs)
+            self._deferred = None
+
+
+def _start_request(application, connection):
+    try:
+        return application.start_request(None, connection)
+    except TypeError:  # Tornado 4.0
+        return application.start_request(connection)
+
+
+@tornado.web.stream_request_body
+class LazyAppHandler(tornado.web.RequestHandler):
+    """
+    Placeholder of an app registered by import string.  On the first
+    request, the app is imported and its handlers replace this one, then
+    the request is dispatched again to them, and its body forwarded as it
+    arrives.
+
+    If the app can't be imported, requests get a 503 response, and the
+    import is tried again after ``retry_after`` seconds.
+    """
+    retry_after = 5
+
+    _delegate = None
+
+    def initialize(self, lazy_app):
+        self.lazy_app = lazy_app
+
+    def check_xsrf_cookie(self):
+        pass
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        lazy_app = self.lazy_app
+        installed = False
+        if lazy_app.retry_at <= time.time():
+            try:
+                lazy_app.install(self.application)
+                installed = True
+            except Exception:
+                logging.exception("Failed to load %s" % lazy_app.import_name)
+                lazy_app.retry_at = time.time() + self.retry_after
+        if not installed:
+            self.set_status(503)
+            self.set_header(
+                "Retry-After", str(int(lazy_app.retry_at - time.time()) + 1)
+            )
+            self.finish()
+            return
+        request = self.request
+        self._delegate = _start_request(self.application, request.connection)
+        start_line = tornado.httputil.RequestStartLine(
+            request.method, request.uri, request.version
+        )
+        prepared = self._delegate.headers_received(start_line, request.headers)
+        if prepared is not None:
+            yield prepared
+
+    def data_received(self, chunk):
+        if self._delegate is not None:
+            return self._delegate.data_received(chunk)
+
+    def _forward(self, *args, **kwargs):
+        self._delegate.finish()
+
+    get = post = put = patch = delete = head = options = _forward
+
+    def on_connection_close(self):
+        if self._delegate is not None:
+            self._delegate.on_connection_close()
+
+    def finish(self, chunk=None):
+        # Once dispatched, the request is answered by the app's handler.
+        if self._delegate is None:
+            super(LazyAppHandler, self).finish(chunk)
 
 
 class RequestHandler(WaterspoutHandler):
@@ -71,10 +450,47 @@ class RequestHandler(WaterspoutHandler):
         """
         self.write(self.render_string(template_name=template_name, **kwargs))
 
-    def get_current_user(self):
-        user_loader = self.application._user_loader
-        if user_loader:
-            return self.application._user_loader(self.session)
+    @tornado.gen.coroutine
+    def render_async(self, template_name, **kwargs):
+        """
+        Like :meth:`render`, but arguments may be futures.
+        All futures are resolved concurrently before rendering ::
+
+            class ProfileHandler(RequestHandler):
+                @tornado.gen.coroutine
+                def get(self, user_id):
+                    yield self.render_async(
+                        'profile.html',
+                        user=self.load_user(user_id),
+                        posts=self.load_posts(user_id)
+                    )
+
+        :param template_name:
+          name of template file
+        :param kwargs:
+          arguments passing to the template
+        """
+        html = yield self.render_string_async(template_name, **kwargs)
+        self.write(html)
+
+    @tornado.gen.coroutine
+    def render_string_async(self, template_name, **kwargs):
+        """
+        Like :meth:`render_string`, but arguments may be futures.
+        All futures are resolved concurrently before rendering.
+
+        :param template_name:
+          name of template file
+        :param kwargs:
+          arguments passing to the template
+        """
+        names = [name for name, value in kwargs.items() if is_future(value)]
+        if names:
+            values = yield [kwargs[name] for name in names]
+            kwargs.update(zip(names, values))
+        raise tornado.gen.Return(
+            self.render_string(template_name=template_name, **kwargs)
+        )
 
     @property
     def globals(self):
@@ -93,7 +509,6 @@ class RequestHandler(WaterspoutHandler):
             request=self.request,
             current_user=self.current_user,
             locale=self.locale,
-            _=self.locale.translate,
             static_url=self.static_url,
             xsrf_form_html=self.xsrf_form_html,
             reverse_url=self.reverse_url
@@ -112,8 +527,9 @@ class RequestHandler(WaterspoutHandler):
         """
         env = self.application.env
         env.globals.update(self.template_namespace)
-        var = env.get_template(template_name)
-        return var.render(**kwargs)
+        with self._trace.span('render', template=template_name):
+            var = env.get_template(template_name)
+            return var.render(**kwargs)
 
     def flash(self, message, category='message'):
         """Flashes a message to the next request.  In order to remove the
@@ -197,7 +613,8 @@ class APIHandler(WaterspoutHandler):
           Waterspout will write your chunk as JSONP if callback is not None.
         """
         if isinstance(chunk, (dict, list)):
-            chunk = tornado.escape.json_encode(chunk)
+            with self._trace.span('json_encode'):
+                chunk = tornado.escape.json_encode(chunk)
             if callback is None:
                 callback = self.get_argument('callback', None)
             if callback:
@@ -211,5 +628,164 @@ class APIHandler(WaterspoutHandler):
         super(APIHandler, self).write(chunk)
 
 
+@tornado.web.stream_request_body
+class UploadHandler(RequestHandler):
+    """
+    Handler class for receiving large request bodies.
+
+    The body is parsed while it is received: ``multipart/form-data``
+    fields are added to the request arguments, and uploaded files are
+    available in :attr:`files` as file objects spooled to disk when larger
+    than the ``upload_spool_size`` setting (1MB by default) ::
+
+        class AvatarHandler(UploadHandler):
+            max_body_size = 10 * 1024 * 1024
+
+            def post(self):
+                avatar = self.files['avatar'][0]
+                save_avatar(avatar.filename, avatar.read())
+
+    Other bodies are spooled to :attr:`body_file` the same way.
+
+    The body size is limited by the ``upload_body_limits`` setting, a
+    dictionary mapping handler class names to sizes in bytes, then by
+    ``max_body_size``, then by the ``upload_max_body_size`` setting
+    (100MB by default).
+
+    .. attention ::
+      As the body is not parsed before the XSRF check, send the XSRF token
+      in the ``X-XSRFToken`` header or in the query string.
+    """
+    max_body_size = None
+
+    #: The error of a malformed multipart body, answered with a 400.
+    parse_error = None
+
+    _parser = None
+    _body_file = None
+    _body_rewound = False
+
+    def get_max_body_size(self):
+        """
+        Return the maximum body size of this handler, in bytes.
+        """
+        settings = self.settings
+        limits = settings.get('upload_body_limits', None) or {}
+        limit = limits.get(self.__class__.__name__, self.max_body_size)
+        if limit is None:
+            limit = settings.get('upload_max_body_size', 100 * 1024 * 1024)
+        return limit
+
+    def prepare(self):
+        super(UploadHandler, self).prepare()
+        if self._finished:
+            return
+        limit = self.get_max_body_size()
+        if int(self.request.headers.get("Content-Length", 0)) > limit:
+            raise tornado.web.HTTPError(413)
+        self.request.connection.set_max_body_size(limit)
+
+        spool_size = self.settings.get('upload_spool_size', 1024 * 1024)
+        tmp_dir = self.settings.get('upload_tmp_dir', None)
+        content_type = self.request.headers.get("Content-Type", "")
+        if content_type.startswith("multipart/form-data"):
+            for field in content_type.split(";"):
+                k, sep, v = field.strip().partition("=")
+                if k == "boundary" and v:
+                    self._parser = MultipartParser(
+                        tornado.escape.utf8(v), spool_size, tmp_dir
+                    )
+                    break
+            else:
+                raise tornado.web.HTTPError(400, "Missing multipart boundary")
+        else:
+            self._body_file = tempfile.SpooledTemporaryFile(
+                max_size=spool_size, dir=tmp_dir
+            )
+
+    def data_received(self, chunk):
+        if self._parser is None:
+            self._body_file.write(chunk)
+            return
+        if self.parse_error is not None:
+            return
+        try:
+            self._parser.feed(chunk)
+        except ValueError as e:
+            # Errors raised here aren't turned into responses by Tornado:
+            # answer now, and Tornado closes the connection instead of
+            # reading the rest of the body.
+            self.parse_error = str(e)
+            self.send_error(400)
+            return
+        if self._parser.complete:
+            self._add_arguments()
+
+    def _add_arguments(self):
+        for name, values in self._parser.arguments.items():
+            self.request.body_arguments.setdefault(name, []).extend(values)
+            self.request.arguments.setdefault(name, []).extend(values)
+        self._parser.arguments = {}
+
+    @property
+    def files(self):
+        """
+        A dictionary mapping field names to lists of
+        :class:`~waterspout.multipart.UploadedFile`.
+        """
+        if self._parser is None:
+            return {}
+        if not self._parser.complete:
+            raise tornado.web.HTTPError(400, "Incomplete multipart body")
+        return self._parser.files
+
+    @property
+    def body_file(self):
+        """
+        A file object holding the body, if it is not multipart.
+        """
+        if self._body_file is not None and not self._body_rewound:
+            self._body_file.seek(0)
+            self._body_rewound = True
+        return self._body_file
+
+    def on_finish(self):
+        if self._parser is not None:
+            self._parser.close()
+        if self._body_file is not None:
+            self._body_file.close()
+        super(UploadHandler, self).on_finish()
+
+
 class StaticFileHandler(tornado.web.StaticFileHandler, WaterspoutHandler):
-    pass
+    """
+    Tornado's static file handler, counting the hits and misses of its
+    cache of file hashes.
+    """
+
+    hash_lookups = 0
+    hash_misses = 0
+
+    @classmethod
+    def get_version(cls, settings, path):
+        cls.hash_lookups += 1
+        return super(StaticFileHandler, cls).get_version(settings, path)
+
+    @classmethod
+    def get_content_version(cls, abspath):
+        cls.hash_misses += 1
+        return super(StaticFileHandler, cls).get_content_version(abspath)
+
+    def compute_etag(self):
+        type(self).hash_lookups += 1
+        return super(StaticFileHandler, self).compute_etag()
+
+    @classmethod
+    def hash_stats(cls):
+        """
+        Return a dictionary of hit and miss counters of the hash cache.
+        """
+        hits = max(cls.hash_lookups - cls.hash_misses, 0)
+        return dict(hits=hits, misses=cls.hash_misses,
+                    hit_rate=float(hits) / cls.hash_lookups
+                    if cls.hash_lookups else 0.0)
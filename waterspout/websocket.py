@@ -0,0 +1,278 @@
+import sys
+import struct
+
+import tornado.escape
+import tornado.websocket
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from waterspout.tracing import NULL_TRACE
+from waterspout.web import WaterspoutHandler
+
+
+def websocket_frame(message, binary=False, opcode=None):
+    """
+    Build an unmasked WebSocket frame, as sent by a server.
+
+    :param message:
+      the message.  Dictionaries are encoded as JSON.
+    :param binary: send ``message`` as a binary message.
+    :param opcode: (optional) the opcode of the frame.
+    """
+    if isinstance(message, dict):
+        message = tornado.escape.json_encode(message)
+    message = tornado.escape.utf8(message)
+    if opcode is None:
+        opcode = 0x2 if binary else 0x1
+    length = len(message)
+    if length < 126:
+        header = struct.pack("BB", 0x80 | opcode, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + message
+
+
+class Hub(object):
+    """
+    Keeps track of WebSocket connections and the channels they are
+    subscribed to ::
+
+        class ChatHandler(WebSocketHandler):
+            def open(self, room):
+                self.subscribe(room)
+
+            def on_message(self, message):
+                self.hub.publish(self.open_args[0], message)
+
+    A published message is encoded once, and the same frame is written
+    to every subscriber.  Connections that have more than
+    ``max_queued_frames`` frames waiting to be sent are closed, so a slow
+    consumer can't make the worker buffer messages forever.
+
+    When ``ping_interval`` is set, every connection is pinged every
+    ``ping_interval`` seconds by a single periodic callback, keeping idle
+    connections alive behind proxies.
+    """
+
+    def __init__(self, ping_interval=None):
+        self.connections = set()
+        self.channels = {}
+        self.ping_interval = ping_interval
+        self.published = 0
+        self.sent = 0
+        self.disconnected = 0
+        self._periodic = None
+        self._ping_frame = websocket_frame(b'', opcode=0x9)
+
+    def connect(self, handler):
+        self.connections.add(handler)
+
+    def disconnect(self, handler):
+        """
+        Forget a connection and unsubscribe it from all its channels.
+        """
+        self.connections.discard(handler)
+        for channel in handler._channels:
+            subscribers = self.channels.get(channel)
+            if subscribers is not None:
+                subscribers.discard(handler)
+                if not subscribers:
+                    del self.channels[channel]
+        handler._channels = ()
+
+    def subscribe(self, channel, handler):
+        self.channels.setdefault(channel, set()).add(handler)
+        if not handler._channels:
+            handler._channels = set()
+        handler._channels.add(channel)
+
+    def unsubscribe(self, channel, handler):
+        subscribers = self.channels.get(channel)
+        if subscribers is not None:
+            subscribers.discard(handler)
+            if not subscribers:
+                del self.channels[channel]
+        if handler._channels:
+            handler._channels.discard(channel)
+
+    def publish(self, channel, message, binary=False):
+        """
+        Send a message to every subscriber of ``channel``.
+
+        :param message:
+          the message.  Dictionaries are encoded as JSON.
+        :param binary: send ``message`` as a binary message.
+        :return: the number of subscribers the message is sent to.
+        """
+        subscribers = self.channels.get(channel)
+        if not subscribers:
+            return 0
+        self.published += 1
+        return self._send(list(subscribers), websocket_frame(message, binary))
+
+    def broadcast(self, message, binary=False):
+        """
+        Send a message to every connection.
+        """
+        self.published += 1
+        return self._send(list(self.connections),
+                          websocket_frame(message, binary))
+
+    def _send(self, handlers, frame):
+        sent = 0
+        for handler in handlers:
+            if handler.write_frame(frame):
+                sent += 1
+            else:
+                self.disconnected += 1
+        self.sent += sent
+        return sent
+
+    def ping(self):
+        """
+        Ping every connection.
+        """
+        for handler in list(self.connections):
+            handler.write_frame(self._ping_frame)
+
+    def start(self, io_loop=None):
+        """
+        Start pinging connections periodically.
+        """
+        if self.ping_interval:
+            self._periodic = PeriodicCallback(
+                self.ping, self.ping_interval * 1000,
+                io_loop=io_loop or IOLoop.current()
+            )
+            self._periodic.start()
+        return self
+
+    def stop(self):
+        """
+        Stop pinging connections, and close them.
+        """
+        if self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+        for handler in list(self.connections):
+            handler.close(1001)
+
+    def stats(self):
+        """
+        Return a dictionary describing the hub.
+        """
+        return dict(connections=len(self.connections),
+                    channels=len(self.channels), published=self.published,
+                    sent=self.sent, disconnected=self.disconnected)
+
+
+class WebSocketHandler(tornado.websocket.WebSocketHandler, WaterspoutHandler):
+    """
+    Base WebSocketHandler for Waterspout Application.
+
+    ``session`` and ``current_user`` are loaded from the cookies of the
+    handshake, and errors raised by ``open`` and ``on_message`` are sent
+    to Sentry.  Handshakes go through rate limiting and load shedding,
+    but open connections don't count as in-flight requests.
+
+    The trace of a connection is finished, and its deferred tasks are
+    run, once it is closed, or once its handshake fails.
+
+    .. attention ::
+      The session is never saved: it can't be changed once the connection
+      is open, as cookies can't be sent anymore.
+    """
+    #: Connections with more frames waiting to be sent are closed.
+    max_queued_frames = 1000
+
+    _channels = ()
+    _queued = 0
+
+    def __init__(self, *args, **kwargs):
+        super(WebSocketHandler, self).__init__(*args, **kwargs)
+        # Tornado 4.0 skips WaterspoutHandler.__init__.
+        self.subdomain = self.request.host.split(".")[0]
+        tracer = getattr(self.application, 'tracer', None)
+        if tracer is not None and self._trace is NULL_TRACE:
+            self._trace = tracer.start_trace(self)
+        if getattr(self.application, 'error_reporter', None) is not None:
+            self.open = self._reporting(self.open)
+            self.on_message = self._reporting(self.on_message)
+
+    def _reporting(self, method):
+        def wrapper(*args, **kwargs):
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                self._capture('captureException', exc_info=sys.exc_info())
+                raise
+        return wrapper
+
+    def prepare(self):
+        super(WebSocketHandler, self).prepare()
+        self._release()
+        # Connections outlive the handshake, and Tornado finishes them
+        # without WaterspoutHandler.finish: they aren't memory profiled.
+        if self._memory_snapshot is not None:
+            self._memory_snapshot = None
+            self.application.memory_profiler.discard()
+
+    def get(self, *args, **kwargs):
+        super(WebSocketHandler, self).get(*args, **kwargs)
+        if self.ws_connection is not None and not self.stream.closed():
+            self.hub.connect(self)
+
+    @property
+    def hub(self):
+        """
+        The :class:`Hub` of the application.
+        """
+        return self.application.hub
+
+    def subscribe(self, channel):
+        """
+        Subscribe this connection to ``channel``.
+        """
+        self.hub.subscribe(channel, self)
+
+    def unsubscribe(self, channel):
+        """
+        Unsubscribe this connection from ``channel``.
+        """
+        self.hub.unsubscribe(channel, self)
+
+    def write_frame(self, frame):
+        """
+        Write a frame built by :func:`websocket_frame`.
+        The connection is closed if it is too slow to receive frames.
+
+        :return: ``True`` if the frame is written.
+        """
+        stream = self.stream
+        if self.ws_connection is None or stream is None or stream.closed():
+            return False
+        if self._queued >= self.max_queued_frames:
+            stream.close()
+            return False
+        self._queued += 1
+        stream.write(frame, self._on_flushed)
+        return True
+
+    def _on_flushed(self):
+        self._queued = 0
+
+    def on_finish(self):
+        # Failed handshakes are finished by RequestHandler.finish.
+        self._end_request()
+        self._run_deferred()
+        super(WebSocketHandler, self).on_finish()
+
+    def on_connection_close(self):
+        hub = getattr(self.application, 'hub', None)
+        if hub is not None:
+            hub.disconnect(self)
+        super(WebSocketHandler, self).on_connection_close()
+        self._end_request()
+        self._run_deferred()